@@ -0,0 +1,70 @@
+"""@package AddressSet
+Implementation of a set of addresses backed by a boolean bitmap
+
+Shop addresses are small consecutive integers, so membership is a single lookup in a boolean array indexed by
+address. Addresses beyond the end of the bitmap are simply not members, the bitmap only grows on insertion.
+"""
+import numpy as np
+
+
+class AddressSet(object):
+
+    def __init__(self, addresses=(), size=0):
+        self.flags = np.zeros(size, dtype=bool)
+        self.count = 0
+        self.add_many(addresses)
+
+    def _grow(self, size):
+        if size > len(self.flags):
+            flags = np.zeros(max(size, 2*len(self.flags)), dtype=bool)
+            flags[:len(self.flags)] = self.flags
+            self.flags = flags
+
+    def add(self, address):
+        address = np.asarray(address).item()
+        self._grow(address + 1)
+        if not self.flags[address]:
+            self.flags[address] = True
+            self.count += 1
+
+    def add_many(self, addresses):
+        addresses = np.asarray(addresses, dtype=np.int64).ravel()
+        if len(addresses) == 0:
+            return
+        self._grow(addresses.max() + 1)
+        new = np.unique(addresses[~self.flags[addresses]])
+        self.flags[new] = True
+        self.count += len(new)
+
+    def discard(self, address):
+        if address in self:
+            self.flags[np.asarray(address).item()] = False
+            self.count -= 1
+
+    def contains_many(self, addresses):
+        addresses = np.asarray(addresses, dtype=np.int64)
+        inside = (addresses >= 0) & (addresses < len(self.flags))
+        result = np.zeros(addresses.shape, dtype=bool)
+        result[inside] = self.flags[addresses[inside]]
+        return result
+
+    def __contains__(self, address):
+        address = np.asarray(address).item()
+        return 0 <= address < len(self.flags) and bool(self.flags[address])
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for address in np.flatnonzero(self.flags):
+            yield int(address)
+
+    def to_array(self):
+        return np.flatnonzero(self.flags)
+
+    def get_state(self):
+        return {'flags': self.flags}
+
+    def set_state(self, state):
+        self.flags = np.array(state['flags'], dtype=bool)
+        self.count = int(np.count_nonzero(self.flags))
@@ -0,0 +1,326 @@
+"""@package Benchmark
+Implementation of a benchmark suite for the simulator
+
+A suite is a list of benchmarks, each with a grid of market sizes (customers, shops, days). Every case runs in
+its own headless worker process, so the peak resident set size it reports belongs to that case alone. A case is
+timed several times after an untimed setup and the fastest repeat is kept. The results of a suite are written
+to a JSON file together with the commit and the versions they were measured with, and two such files can be
+compared to find regressions between commits.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import numpy as np
+from ParameterSweep import DEFAULT_PARAMETERS, grid_spec
+from Profiling import peak_memory_mb
+
+SUITES = {'quick': [('run', grid_spec(num_customers=[100, 10000], num_shops=[5], num_days=[30], batched=[True])),
+                    ('run', grid_spec(num_customers=[100], num_shops=[5], num_days=[30], batched=[False])),
+                    ('verify_claim', grid_spec(num_customers=[1000], num_shops=[5], num_days=[5])),
+                    ('verify_claims', grid_spec(num_customers=[10000], num_shops=[5], num_days=[5])),
+                    ('deteriorate_customer_reputation', grid_spec(num_customers=[10000], num_shops=[5],
+                                                                  num_days=[5])),
+                    ('calculate_shop_reputation', grid_spec(num_customers=[10000], num_shops=[5], num_days=[5])),
+                    ('visualize_market', grid_spec(num_customers=[1000], num_shops=[5], num_days=[5])),
+                    ('startup', grid_spec(num_customers=[100], num_shops=[5], num_days=[1]))],
+          'full': [('run', grid_spec(num_customers=[100, 1000, 10000, 100000, 1000000], num_shops=[2, 100],
+                                     num_days=[30], batched=[True])),
+                   ('run', grid_spec(num_customers=[100, 1000, 10000], num_shops=[10000], num_days=[30],
+                                     batched=[True])),
+                   ('run', grid_spec(num_customers=[100, 1000, 10000], num_shops=[2, 100], num_days=[30],
+                                     batched=[False])),
+                   ('run', grid_spec(num_customers=[10000], num_shops=[5], num_days=[30, 365], batched=[True])),
+                   ('verify_claim', grid_spec(num_customers=[1000, 100000], num_shops=[2, 100], num_days=[5])),
+                   ('verify_claim', grid_spec(num_customers=[1000], num_shops=[10000], num_days=[5])),
+                   ('verify_claims', grid_spec(num_customers=[10000, 1000000], num_shops=[2, 100], num_days=[5])),
+                   ('verify_claims', grid_spec(num_customers=[10000], num_shops=[10000], num_days=[5])),
+                   ('deteriorate_customer_reputation', grid_spec(num_customers=[100, 10000, 1000000],
+                                                                 num_shops=[2, 100], num_days=[5])),
+                   ('deteriorate_customer_reputation', grid_spec(num_customers=[100, 10000], num_shops=[10000],
+                                                                 num_days=[5])),
+                   ('calculate_shop_reputation', grid_spec(num_customers=[10000, 1000000], num_shops=[2, 100],
+                                                           num_days=[5])),
+                   ('calculate_shop_reputation', grid_spec(num_customers=[10000], num_shops=[10000], num_days=[5])),
+                   ('visualize_market', grid_spec(num_customers=[100, 1000], num_shops=[2, 100], num_days=[5])),
+                   ('startup', grid_spec(num_customers=[100], num_shops=[5], num_days=[1, 30]))]}
+
+
+# Neutral customers draw a number of shop choices that grows with the number of shops, which is why the largest
+# markets are not crossed with the largest shop counts. Markets with more (customer, shop) pairs than the limit
+# keep their reputation in a sparse ledger.
+DENSE_LEDGER_LIMIT = 10**7
+# modules the command line simulator may only load when a run asks for plotting, profiling or a render process
+DEFERRED_MODULES = ('matplotlib', 'cProfile', 'pstats', 'multiprocessing')
+
+
+def _make_engine(params, sim_iters=None, batched=True):
+    from Customer import Customer
+    from Shop import Shop
+    from SimulationEngine import SimulationEngine
+    Customer.CUSTOMER_ID = 0
+    Shop.SHOP_ID = 0
+    parameters = dict(DEFAULT_PARAMETERS)
+    parameters.update(num_customers=params['num_customers'], num_shops=params['num_shops'],
+                      sim_iters=params['num_days'] if sim_iters is None else sim_iters)
+    sparse_ledger = params.get('sparse_ledger', params['num_customers']*params['num_shops'] > DENSE_LEDGER_LIMIT)
+    return SimulationEngine(batched=batched, sparse_ledger=sparse_ledger, render='headless', seed=params.get('seed', 0),
+                            **parameters)
+
+
+def _warmed_up_engine(params):
+    # a market that has run for num_days, so the ledger holds reputation for the contract benchmarks
+    sim_engine = _make_engine(params)
+    sim_engine.run()
+    return sim_engine
+
+
+def _time(function, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def bench_run(params, repeat):
+    samples = []
+    for _ in range(repeat):
+        sim_engine = _make_engine(params, batched=params.get('batched', True))
+        samples += _time(sim_engine.run, 1)
+    counters = sim_engine.smart_contract.get_counters()
+    seconds = min(samples)
+    return {'samples': samples,
+            'days_per_second': sim_engine.days_run / seconds,
+            'claims_per_second': counters['claims_made'] / seconds}
+
+
+def bench_verify_claim(params, repeat):
+    sim_engine = _warmed_up_engine(params)
+    smart_contract = sim_engine.smart_contract
+    customer_addresses = sim_engine.customers.addresses[:min(len(sim_engine.customers), 2000)].tolist()
+    shop_addresses = [sim_engine.shops[i % len(sim_engine.shops)].get_shop_address()
+                      for i in range(len(customer_addresses))]
+
+    def claim_and_verify():
+        for customer_address, shop_address in zip(customer_addresses, shop_addresses):
+            smart_contract.make_claim(shop_address, customer_address)
+            smart_contract.verify_claim(shop_address, customer_address)
+    samples = _time(claim_and_verify, repeat)
+    return {'samples': samples, 'claims_per_second': len(customer_addresses) / min(samples)}
+
+
+def bench_verify_claims(params, repeat):
+    sim_engine = _warmed_up_engine(params)
+    smart_contract = sim_engine.smart_contract
+    customer_addresses = sim_engine.customers.addresses
+    shop_addresses = np.array([shop.get_shop_address() for shop in sim_engine.shops])
+    shop_addresses = shop_addresses[np.arange(len(customer_addresses)) % len(shop_addresses)]
+
+    def claim_and_verify():
+        smart_contract.submit_claims(shop_addresses, customer_addresses)
+        smart_contract.verify_claims(shop_addresses, customer_addresses)
+    samples = _time(claim_and_verify, repeat)
+    return {'samples': samples, 'claims_per_second': len(customer_addresses) / min(samples)}
+
+
+def bench_deteriorate_customer_reputation(params, repeat):
+    sim_engine = _warmed_up_engine(params)
+    samples = _time(lambda: sim_engine.smart_contract.deteriorate_customer_reputation(sim_engine.address, 0.10),
+                    repeat)
+    return {'samples': samples, 'calls_per_second': 1.0 / min(samples)}
+
+
+def bench_calculate_shop_reputation(params, repeat):
+    sim_engine = _warmed_up_engine(params)
+    smart_contract = sim_engine.smart_contract
+    shop_addresses = [shop.get_shop_address() for shop in sim_engine.shops]
+
+    def calculate():
+        for shop_address in shop_addresses:
+            smart_contract.calculate_shop_reputation(shop_address)
+    samples = _time(calculate, repeat)
+    bulk_samples = _time(lambda: smart_contract.calculate_shop_reputations(shop_addresses), repeat)
+    return {'samples': samples, 'calls_per_second': len(shop_addresses) / min(samples),
+            'bulk_calls_per_second': len(shop_addresses) / min(bulk_samples)}
+
+
+def bench_visualize_market(params, repeat):
+    # the figure is built and drawn once untimed, a frame is the update of its bars from a snapshot
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from Visualization import MarketFigure
+    sim_engine = _warmed_up_engine(params)
+    snapshot = sim_engine._take_snapshot(params['num_days'])
+    market_figure = MarketFigure(snapshot)
+    market_figure.update(snapshot)
+    samples = _time(lambda: market_figure.update(snapshot), repeat)
+    plt.close(market_figure.figure)
+    return {'samples': samples, 'frames_per_second': 1.0 / min(samples)}
+
+
+def bench_startup(params, repeat):
+    # a short headless run of the command line simulator in a fresh interpreter, against importing it and
+    # against starting the interpreter alone; the case fails if importing it loads a deferred module
+    source = os.path.dirname(os.path.abspath(__file__))
+    loaded = subprocess.check_output([sys.executable, '-c', 'import sys, app_reusabilityToken_simulator; '
+                                      'print(" ".join(m for m in {!r} if m in sys.modules))'.format(DEFERRED_MODULES)],
+                                     cwd=source, universal_newlines=True).split()
+    if loaded:
+        raise RuntimeError('loaded at startup: {}'.format(', '.join(loaded)))
+
+    def python(*args):
+        subprocess.run([sys.executable] + list(args), cwd=source, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    command = ['app_reusabilityToken_simulator.py', '--render', 'headless', '--seed', '0',
+               '--num_customers', str(params['num_customers']), '--num_shops', str(params['num_shops']),
+               '--num_iterations', str(params['num_days'])]
+    samples = _time(lambda: python(*command), repeat)
+    import_samples = _time(lambda: python('-c', 'import app_reusabilityToken_simulator'), repeat)
+    interpreter_samples = _time(lambda: python('-c', 'pass'), repeat)
+    return {'samples': samples, 'runs_per_second': 1.0 / min(samples),
+            'import_seconds': min(import_samples), 'interpreter_seconds': min(interpreter_samples)}
+
+
+BENCHMARKS = {'run': bench_run,
+              'verify_claim': bench_verify_claim,
+              'verify_claims': bench_verify_claims,
+              'deteriorate_customer_reputation': bench_deteriorate_customer_reputation,
+              'calculate_shop_reputation': bench_calculate_shop_reputation,
+              'visualize_market': bench_visualize_market,
+              'startup': bench_startup}
+
+
+def run_case(name, params, repeat=3):
+    # runs inside the worker process, the simulator output is swallowed
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = BENCHMARKS[name](params, repeat)
+    result['seconds'] = min(result['samples'])
+    result['peak_rss_mb'] = peak_memory_mb()
+    return result
+
+
+def run_case_in_worker(name, params, repeat=3, timeout=None):
+    # a case that runs past the timeout is abandoned, the suite goes on with the next one
+    environment = dict(os.environ, MPLBACKEND='Agg')
+    try:
+        completed = subprocess.run([sys.executable, os.path.abspath(__file__), '--worker',
+                                    json.dumps({'name': name, 'params': params, 'repeat': repeat})],
+                                   cwd=os.path.dirname(os.path.abspath(__file__)), env=environment,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True,
+                                   timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return {'error': 'timed out after {}s'.format(timeout)}
+    if completed.returncode != 0:
+        return {'error': completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else 'failed'}
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(suite='quick', repeat=3, only=None, output_path=None, timeout=None):
+    results = []
+    for name, grid in SUITES[suite]:
+        if only and name not in only:
+            continue
+        for params in grid:
+            result = run_case_in_worker(name, params, repeat, timeout)
+            result.update(benchmark=name, params=params)
+            results.append(result)
+            print(format_result(result))
+    report = {'commit': _commit(),
+              'suite': suite,
+              'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'machine': {'platform': platform.platform(), 'processor': platform.processor(),
+                          'cpus': os.cpu_count()},
+              'python': platform.python_version(),
+              'numpy': np.__version__,
+              'results': results}
+    if output_path is not None:
+        with open(output_path, 'w') as f:
+            json.dump(report, f, indent=1)
+    return report
+
+
+def _case_label(result):
+    params = result['params']
+    label = '{} c={} s={} d={}'.format(result['benchmark'], params['num_customers'], params['num_shops'],
+                                       params['num_days'])
+    if 'batched' in params:
+        label += ' batched' if params['batched'] else ' scalar'
+    return label
+
+
+def format_result(result):
+    if 'error' in result:
+        return '{:<60}{}'.format(_case_label(result), result['error'])
+    rates = ['{}={:.4g}'.format(name, value) for name, value in sorted(result.items())
+             if name.endswith('_per_second')]
+    return '{:<60}{:>12.6f} s{:>9.1f} MB  {}'.format(_case_label(result), result['seconds'], result['peak_rss_mb'],
+                                                     ' '.join(rates))
+
+
+def compare(old_path, new_path, threshold=1.1):
+    # prints new/old time ratios of the cases in both files, returns the cases slower by more than threshold
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    old_results = dict((_case_label(r), r) for r in old['results'] if 'error' not in r)
+    regressions = []
+    print('{} -> {}'.format(old['commit'], new['commit']))
+    for result in new['results']:
+        label = _case_label(result)
+        if 'error' in result or label not in old_results:
+            continue
+        ratio = result['seconds'] / old_results[label]['seconds']
+        flag = ''
+        if ratio > threshold:
+            flag = 'slower'
+            regressions.append(label)
+        elif ratio < 1.0 / threshold:
+            flag = 'faster'
+        print('{:<60}{:>12.6f}{:>12.6f}{:>8.2f}  {}'.format(label, old_results[label]['seconds'],
+                                                            result['seconds'], ratio, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser('ReusabiliToken benchmarks')
+    parser.add_argument('--suite', type=str, default='quick', choices=sorted(SUITES), help='Benchmark suite')
+    parser.add_argument('--only', nargs='*', help='Run only these benchmarks')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed repeats per case, the fastest is kept')
+    parser.add_argument('--timeout', type=float, default=None, help='Seconds before a case is abandoned')
+    parser.add_argument('--output', type=str, default='benchmark.json', help='JSON file for the results')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='Compare two result files')
+    parser.add_argument('--threshold', type=float, default=1.1, help='Time ratio reported as a regression')
+    parser.add_argument('--worker', type=str, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker is not None:
+        case = json.loads(args.worker)
+        print(json.dumps(run_case(case['name'], case['params'], case['repeat'])))
+    elif args.compare is not None:
+        regressions = compare(args.compare[0], args.compare[1], args.threshold)
+        sys.exit(1 if regressions else 0)
+    else:
+        run_suite(args.suite, args.repeat, args.only, args.output, args.timeout)
+        print('results written to {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
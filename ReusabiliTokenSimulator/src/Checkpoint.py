@@ -0,0 +1,56 @@
+"""@package Checkpoint
+Implementation of checkpoint files for long simulation runs
+
+A checkpoint is a single uncompressed .npz file. The state of the engine is a nested dict; every numpy array in
+it is stored as its own npz entry under its path in the dict, everything else (counters, parameters, random
+generator states) is collected into one JSON document stored next to them. Loading never unpickles objects.
+"""
+import json
+import os
+import numpy as np
+
+_META_KEY = '__meta__'
+_SEPARATOR = '/'
+
+
+def _flatten(state, prefix, arrays, meta):
+    for name, value in state.items():
+        path = prefix + name
+        if isinstance(value, dict):
+            meta[path] = {}
+            _flatten(value, path + _SEPARATOR, arrays, meta)
+        elif isinstance(value, np.ndarray):
+            arrays[path] = value
+        elif isinstance(value, np.generic):
+            meta[path] = value.item()
+        else:
+            meta[path] = value
+
+
+def save_state(path, state):
+    # written to a temporary file first, so a run that dies while saving keeps its previous checkpoint
+    arrays = {}
+    meta = {}
+    _flatten(state, '', arrays, meta)
+    arrays[_META_KEY] = np.array(json.dumps(meta))
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(temporary_path, path)
+
+
+def load_state(path):
+    state = {}
+    with np.load(path, allow_pickle=False) as npz:
+        meta = json.loads(str(npz[_META_KEY]))
+        entries = [(name, npz[name]) for name in npz.files if name != _META_KEY]
+    for path, value in list(meta.items()) + entries:
+        names = path.split(_SEPARATOR)
+        node = state
+        for name in names[:-1]:
+            node = node.setdefault(name, {})
+        if isinstance(value, dict):
+            node.setdefault(names[-1], {})
+        else:
+            node[names[-1]] = value
+    return state
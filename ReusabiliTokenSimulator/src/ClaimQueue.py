@@ -0,0 +1,67 @@
+"""@package ClaimQueue
+Implementation of a queue of pending recycle claims
+
+Pending claims are kept as sorted (customer, shop) keys with the number of claims submitted for each pair, so
+any number of customers can have claims in flight at the same time and a whole batch is matched at once.
+"""
+import numpy as np
+from Ledger import SparseMatrix
+
+
+class ClaimQueue(object):
+
+    def __init__(self):
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.counts = np.zeros(0, dtype=np.int64)
+
+    @staticmethod
+    def make_keys(customer_addresses, shop_addresses):
+        return np.atleast_1d(SparseMatrix.make_keys(customer_addresses, shop_addresses))
+
+    def submit(self, customer_addresses, shop_addresses):
+        keys, counts = np.unique(self.make_keys(customer_addresses, shop_addresses), return_counts=True)
+        pos = np.searchsorted(self.keys, keys)
+        found = pos < len(self.keys)
+        found[found] = self.keys[pos[found]] == keys[found]
+        self.counts[pos[found]] += counts[found]
+        if not np.all(found):
+            self.keys = np.insert(self.keys, pos[~found], keys[~found])
+            self.counts = np.insert(self.counts, pos[~found], counts[~found])
+
+    def pending(self, customer_addresses, shop_addresses):
+        # number of pending claims for every (customer, shop) pair
+        keys = self.make_keys(customer_addresses, shop_addresses)
+        pos = np.searchsorted(self.keys, keys)
+        found = pos < len(self.keys)
+        found[found] = self.keys[pos[found]] == keys[found]
+        counts = np.zeros(len(keys), dtype=np.int64)
+        counts[found] = self.counts[pos[found]]
+        return counts
+
+    def remove(self, customer_addresses, shop_addresses):
+        # takes one pending claim off the queue for every entry, entries have to be pending
+        keys, counts = np.unique(self.make_keys(customer_addresses, shop_addresses), return_counts=True)
+        pos = np.searchsorted(self.keys, keys)
+        self.counts[pos] -= counts
+        self._compact()
+
+    def drop_customers(self, customer_addresses):
+        keep = ~np.isin(self.keys >> 32, np.asarray(customer_addresses, dtype=np.int64))
+        self.keys = self.keys[keep]
+        self.counts = self.counts[keep]
+
+    def _compact(self):
+        keep = self.counts > 0
+        if not np.all(keep):
+            self.keys = self.keys[keep]
+            self.counts = self.counts[keep]
+
+    def __len__(self):
+        return int(self.counts.sum())
+
+    def get_state(self):
+        return {'keys': self.keys, 'counts': self.counts}
+
+    def set_state(self, state):
+        self.keys = np.array(state['keys'])
+        self.counts = np.array(state['counts'])
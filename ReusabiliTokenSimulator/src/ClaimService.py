@@ -0,0 +1,396 @@
+"""@package ClaimService
+Implementation of an asyncio front end that feeds purchase and claim events into a smart contract
+
+Producers, point of sale feeds or connections on a Unix socket, submit single purchases, claims and
+verifications. They go into one bounded queue; a producer that finds it full waits, which is the backpressure
+towards the feeds. A single batcher task takes everything queued, up to max_batch requests, waiting at most
+max_delay for more once it has the first, and applies them to the contract in bulk. Purchases do not interact
+with claims, so all purchases of a batch are one customers_buy_with_coin call. Claims and verifications are
+grouped in waves: wave w holds the requests that follow w verifications of the same customer in the batch, and
+every wave is one submit_claims and one verify_claims call. A customer verifies at most once per call and its
+requests keep their order, so the contract ends up as if the requests had been made one after another. Every
+request gets a future with its result, and the time from submission to result of the most recent batches is
+kept for the latency percentiles.
+"""
+import asyncio
+import collections
+import time
+import numpy as np
+
+PURCHASE = 0
+CLAIM = 1
+VERIFY = 2
+REQUEST_NAMES = ('buy', 'claim', 'verify')
+
+
+class ClaimService(object):
+
+    def __init__(self, smart_contract, max_batch=4096, max_delay=0.002, queue_size=65536, latency_batches=1024):
+        self.smart_contract = smart_contract
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.queue = asyncio.Queue(queue_size)
+        self.batcher = None
+        # the latencies of a batch are one array, a long running service keeps those of the last latency_batches
+        self.latencies = collections.deque(maxlen=latency_batches)
+        self.num_batches = 0
+        self.num_requests = 0
+
+    def start(self):
+        self.batcher = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        # settles everything that was submitted before
+        await self.queue.join()
+        self.batcher.cancel()
+        try:
+            await self.batcher
+        except asyncio.CancelledError:
+            pass
+        self.batcher = None
+
+    async def submit(self, kind, shop_address, customer_address, num_coins=0):
+        # returns the future of the request once it is queued, waits while the queue is full
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((kind, shop_address, customer_address, num_coins, time.perf_counter(), future))
+        return future
+
+    async def buy_with_coin(self, customer_address, shop_address, num_coins):
+        return await (await self.submit(PURCHASE, shop_address, customer_address, num_coins))
+
+    async def make_claim(self, shop_address, customer_address):
+        return await (await self.submit(CLAIM, shop_address, customer_address))
+
+    async def verify_claim(self, shop_address, customer_address):
+        return await (await self.submit(VERIFY, shop_address, customer_address))
+
+    async def _run(self):
+        queue = self.queue
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await queue.get()]
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.max_batch:
+                if queue.empty():
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(queue.get(), remaining))
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    batch.append(queue.get_nowait())
+            try:
+                self._apply(batch)
+            except Exception as error:
+                for request in batch:
+                    if not request[5].done():
+                        request[5].set_exception(error)
+            for _ in batch:
+                queue.task_done()
+
+    def _apply(self, batch):
+        # every request is resolved right after the call that applies it, so if a later call raises, _run fails
+        # only the requests that were not applied
+        smart_contract = self.smart_contract
+        kinds, shops, customers, coins, submitted = [np.array(column) for column in list(zip(*batch))[:5]]
+        futures = [request[5] for request in batch]
+        purchases = np.flatnonzero(kinds == PURCHASE)
+        if len(purchases) > 0:
+            smart_contract.customers_buy_with_coin(customers[purchases], shops[purchases], coins[purchases])
+            _resolve(futures, purchases.tolist(), [None]*len(purchases))
+        waves = _waves(kinds, customers)
+        for wave in range(waves[kinds != PURCHASE].max(initial=-1) + 1):
+            claims = np.flatnonzero((waves == wave) & (kinds == CLAIM))
+            if len(claims) > 0:
+                smart_contract.submit_claims(shops[claims], customers[claims])
+                _resolve(futures, claims.tolist(), [True]*len(claims))
+            verifications = np.flatnonzero((waves == wave) & (kinds == VERIFY))
+            if len(verifications) > 0:
+                verified = smart_contract.verify_claims(shops[verifications], customers[verifications])
+                _resolve(futures, verifications.tolist(), list(zip(*[values.tolist() for values in verified])))
+        self.latencies.append(time.perf_counter() - submitted)
+        self.num_batches += 1
+        self.num_requests += len(batch)
+
+    def latency_percentiles(self, percentiles=(50, 90, 99, 99.9)):
+        # seconds from submission to result, over the requests of the kept batches since the last reset
+        if not self.latencies:
+            return {}
+        latencies = np.concatenate(self.latencies)
+        return dict(zip(percentiles, np.percentile(latencies, percentiles).tolist()))
+
+    def reset_statistics(self):
+        self.latencies.clear()
+        self.num_batches = 0
+        self.num_requests = 0
+
+    def report(self):
+        print('{} requests in {} batches, {:.1f} per batch'.format(
+            self.num_requests, self.num_batches, self.num_requests / float(max(1, self.num_batches))))
+        for percentile, seconds in self.latency_percentiles().items():
+            print('p{:<6}{:>10.3f} ms'.format(percentile, 1000*seconds))
+
+    async def serve_unix(self, path):
+        # one request per line, 'buy <customer> <shop> <coins>', 'claim <shop> <customer>' or
+        # 'verify <shop> <customer>'; answers come back in request order, so a connection can pipeline
+        return await asyncio.start_unix_server(self._handle_connection, path=path)
+
+    async def _handle_connection(self, reader, writer):
+        pending = asyncio.Queue(self.max_batch)
+        responder = asyncio.get_running_loop().create_task(_respond(pending, writer))
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                fields = line.split()
+                try:
+                    kind = REQUEST_NAMES.index(fields[0].decode())
+                    if kind == PURCHASE:
+                        future = await self.submit(kind, int(fields[2]), int(fields[1]), float(fields[3]))
+                    else:
+                        future = await self.submit(kind, int(fields[1]), int(fields[2]))
+                except (ValueError, IndexError):
+                    future = asyncio.get_running_loop().create_future()
+                    future.set_exception(ValueError('bad request {!r}'.format(line.strip())))
+                await pending.put(future)
+        finally:
+            await pending.put(None)
+            await responder
+
+
+def _resolve(futures, indices, results):
+    for index, result in zip(indices, results):
+        if not futures[index].done():
+            futures[index].set_result(result)
+
+
+def _waves(kinds, customers):
+    # the number of verifications of the same customer before every request of the batch
+    order = np.argsort(customers, kind='stable')
+    verifications = (kinds[order] == VERIFY).astype(np.int64)
+    before = np.cumsum(verifications) - verifications
+    first = np.r_[True, customers[order][1:] != customers[order][:-1]]
+    waves = np.empty(len(kinds), dtype=np.int64)
+    waves[order] = before - before[first][np.cumsum(first) - 1]
+    return waves
+
+
+async def _respond(pending, writer):
+    while True:
+        future = await pending.get()
+        if future is None:
+            break
+        try:
+            result = await future
+        except Exception as error:
+            # a bad request or a batch the contract rejected, the connection goes on with the next answer
+            writer.write('error {}: {}\n'.format(type(error).__name__, error).encode())
+        else:
+            if result is None or result is True:
+                writer.write(b'ok\n')
+            else:
+                writer.write('{:d} {!r} {!r}\n'.format(*result).encode())
+        if pending.empty():
+            await writer.drain()
+    await writer.drain()
+    writer.close()
+
+
+def make_events(num_events, num_customers, shop_addresses, seed=0, purchase_share=0.2, failure_share=0.01):
+    # a recycling feed: (kind, shop, customer, coins) rows, every claim is followed by its verification; a
+    # failure_share of the verifications names another shop, which fails and voids the customer's claims
+    rng = np.random.default_rng(seed)
+    num_purchases = int(num_events*purchase_share)
+    num_recycles = (num_events - num_purchases) // 2
+    customers = rng.integers(0, num_customers, num_purchases + num_recycles)
+    shops = np.asarray(shop_addresses)[rng.integers(0, len(shop_addresses), len(customers))]
+    kinds = np.r_[np.full(num_purchases, PURCHASE), np.full(num_recycles, CLAIM)]
+    order = rng.permutation(len(kinds))
+    failed = rng.random(len(kinds)) < failure_share
+    other_shops = np.asarray(shop_addresses)[rng.integers(0, len(shop_addresses), len(kinds))]
+    events = []
+    for kind, shop, customer, fails, other_shop in zip(kinds[order].tolist(), shops[order].tolist(),
+                                                       customers[order].tolist(), failed.tolist(),
+                                                       other_shops.tolist()):
+        if kind == PURCHASE:
+            events.append((PURCHASE, shop, customer, 100.0))
+        else:
+            events.append((CLAIM, shop, customer, 0.0))
+            events.append((VERIFY, other_shop if fails else shop, customer, 0.0))
+    return events
+
+
+async def generate_load(service, events, num_producers=64):
+    # producers share the feed by customer, each replays its events in order and waits for every result,
+    # like a till that waits for the contract before it serves the customer's next event
+    feeds = [[] for _ in range(num_producers)]
+    for event in events:
+        feeds[event[2] % num_producers].append(event)
+
+    async def produce(feed):
+        for kind, shop, customer, num_coins in feed:
+            await (await service.submit(kind, shop, customer, num_coins))
+
+    start = time.perf_counter()
+    await asyncio.gather(*[produce(feed) for feed in feeds])
+    return time.perf_counter() - start
+
+
+async def generate_unix_load(path, events, num_connections=8, window=256):
+    # the same feeds over Unix socket connections; each connection keeps up to window requests in flight
+    feeds = [[] for _ in range(num_connections)]
+    for event in events:
+        feeds[event[2] % num_connections].append(event)
+
+    async def produce(feed):
+        reader, writer = await asyncio.open_unix_connection(path)
+        in_flight = asyncio.Semaphore(window)
+        answers = []
+
+        async def read_answers():
+            for _ in feed:
+                answers.append(await reader.readline())
+                in_flight.release()
+
+        reading = asyncio.get_running_loop().create_task(read_answers())
+        for kind, shop, customer, num_coins in feed:
+            await in_flight.acquire()
+            if kind == PURCHASE:
+                writer.write('buy {} {} {}\n'.format(customer, shop, num_coins).encode())
+            else:
+                writer.write('{} {} {}\n'.format(REQUEST_NAMES[kind], shop, customer).encode())
+            await writer.drain()
+        await reading
+        writer.close()
+        return answers
+
+    start = time.perf_counter()
+    answers = await asyncio.gather(*[produce(feed) for feed in feeds])
+    return time.perf_counter() - start, answers
+
+
+def _make_contract(num_shops):
+    from ShopListOracle import ShopListOracle
+    from SimulationTimeOracle import SimulationTimeOracle
+    from SmartContract import SmartContract
+    smart_contract = SmartContract(0)
+    oracle = ShopListOracle()
+    oracle.register_shops(np.arange(num_shops))
+    smart_contract.set_oracle(0, oracle, SimulationTimeOracle())
+    smart_contract.set_coin_limit(0, 200000)
+    smart_contract.set_reputation_limit(0, 20000)
+    smart_contract.set_coins_per_reputation_token(0, 0.5)
+    return smart_contract
+
+
+def _check_against(reference, smart_contract):
+    assert reference.get_coin_map().keys() == smart_contract.get_coin_map().keys()
+    assert np.allclose(list(reference.get_coin_map().values()), list(smart_contract.get_coin_map().values()))
+    assert reference.get_reputation_map() == smart_contract.get_reputation_map()
+    assert reference.get_coin_purchase_map() == smart_contract.get_coin_purchase_map()
+    for name, value in reference.get_counters().items():
+        assert np.isclose(value, smart_contract.get_counters()[name]), name
+
+
+def _load_test(num_events=100000, num_customers=5000, num_shops=20, seed=0):
+    # the service has to leave the contract as sequential scalar calls do, for producers in process and for
+    # pipelined connections on a Unix socket
+    import os
+    import tempfile
+    events = make_events(num_events, num_customers, np.arange(num_shops), seed)
+    reference = _make_contract(num_shops)
+    start = time.perf_counter()
+    for kind, shop, customer, num_coins in events:
+        if kind == PURCHASE:
+            reference.customer_buys_with_coin(customer, shop, num_coins)
+        elif kind == CLAIM:
+            reference.make_claim(shop, customer)
+        else:
+            reference.verify_claim(shop, customer)
+    print('scalar calls: {} events in {:.2f}s'.format(len(events), time.perf_counter() - start))
+
+    async def in_process():
+        service = ClaimService(_make_contract(num_shops))
+        service.start()
+        elapsed = await generate_load(service, events, num_producers=256)
+        await service.stop()
+        return service, elapsed
+
+    service, elapsed = asyncio.run(in_process())
+    _check_against(reference, service.smart_contract)
+    print('in process: {} events in {:.2f}s'.format(len(events), elapsed))
+    service.report()
+
+    async def over_socket(path):
+        service = ClaimService(_make_contract(num_shops))
+        service.start()
+        server = await service.serve_unix(path)
+        elapsed, answers = await generate_unix_load(path, events)
+        server.close()
+        await server.wait_closed()
+        await service.stop()
+        return service, elapsed, answers
+
+    path = os.path.join(tempfile.mkdtemp(), 'claims.sock')
+    service, elapsed, answers = asyncio.run(over_socket(path))
+    os.remove(path)
+    _check_against(reference, service.smart_contract)
+    assert sum(len(connection_answers) for connection_answers in answers) == len(events)
+    assert not any(answer.startswith(b'error') for connection_answers in answers for answer in connection_answers)
+    print('unix socket: {} events in {:.2f}s'.format(len(events), elapsed))
+    service.report()
+
+
+def _error_test(num_shops=4):
+    # malformed lines and requests the contract raises on are answered with an error, the connection serves
+    # the requests after them
+    import os
+    import tempfile
+
+    async def over_socket(path):
+        smart_contract = _make_contract(num_shops)
+        service = ClaimService(smart_contract, max_delay=0)
+        service.start()
+        server = await service.serve_unix(path)
+        reader, writer = await asyncio.open_unix_connection(path)
+
+        async def ask(line):
+            writer.write(line)
+            await writer.drain()
+            return await reader.readline()
+        answers = [await ask(b'claim 1\n'), await ask(b'sell 1 2\n')]
+        smart_contract.submit_claims = _raise_key_error
+        answers.append(await ask(b'claim 1 7\n'))
+        # a purchase applied before the failing claim of its batch keeps its result
+        batch = [await service.submit(PURCHASE, 1, 7, 100), await service.submit(CLAIM, 1, 7)]
+        outcomes = await asyncio.gather(*batch, return_exceptions=True)
+        del smart_contract.submit_claims
+        answers.append(await ask(b'buy 7 1 100\n'))
+        writer.write_eof()
+        # the server closes the connection once it has answered everything
+        await reader.read()
+        writer.close()
+        server.close()
+        await server.wait_closed()
+        await service.stop()
+        return answers, outcomes
+
+    path = os.path.join(tempfile.mkdtemp(), 'claims.sock')
+    answers, outcomes = asyncio.run(over_socket(path))
+    os.remove(path)
+    assert outcomes[0] is None and isinstance(outcomes[1], KeyError), outcomes
+    assert [answer.split(b':')[0] for answer in answers] == [b'error ValueError', b'error ValueError',
+                                                              b'error KeyError', b'ok\n'], answers
+    print('errors answered: {}'.format(b' | '.join(answer.strip() for answer in answers).decode()))
+
+
+def _raise_key_error(shop_addresses, customer_addresses):
+    raise KeyError('no such claim')
+
+
+if __name__ == '__main__':
+    _load_test()
+    _error_test()
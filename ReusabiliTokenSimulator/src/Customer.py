@@ -3,17 +3,25 @@ Implementation of a generic Customer
 """
 from abc import ABCMeta, abstractmethod
 import numpy as np
+from RandomStreams import default_streams
+from CustomerBehaviour import COIN_THRESHOLD, COIN_SPEND, preferred_subsets
 
 
 class Customer(object):
     __metaclass__ = ABCMeta
     CUSTOMER_ID = 0
-    def __init__(self, type_):
+    def __init__(self, type_, random_streams=None):
+        if random_streams is None:
+            random_streams = default_streams()
+        self.choice_random = random_streams.buffer('choice')
+        self.recycle_random = random_streams.buffer('recycle')
         self.customer_id = Customer.CUSTOMER_ID
         Customer.CUSTOMER_ID += 1
         self.reputation = {}
         self.coins = 0
         self.recycle_prob = 0.9
+        self.coin_threshold = COIN_THRESHOLD
+        self.coin_spend = COIN_SPEND
         self.preferred_shop = -1
         self.type_ = type_
 
@@ -37,20 +45,19 @@ class Customer(object):
         return self.customer_id
 
     def choose_to_recycle(self):
-        res = np.random.binomial(1, self.recycle_prob, 1)
-        if res == 1:
+        if self.recycle_random.random() < self.recycle_prob:
             return True
         else:
             return False
 
     def choose_to_pay_by_coin(self):
-        if self.coins > 100:
+        if self.coins > self.coin_threshold:
                 return True
         else:
             return False
 
     def get_coin_spend(self):
-        return 100
+        return self.coin_spend
 
     def get_coin(self):
         return self.coins
@@ -71,31 +78,31 @@ class Customer(object):
 
 class GoodCustomer(Customer):
 
-    def __init__(self):
-        super(GoodCustomer, self).__init__('g')
+    def __init__(self, random_streams=None):
+        super(GoodCustomer, self).__init__('g', random_streams)
         self.recycle_prob = 0.9
 
     def choose_shop(self, num_shops):
         if self.preferred_shop == -1:
-            self.preferred_shop = np.random.randint(0, num_shops, 1)[0]
+            self.preferred_shop = self.choice_random.randint(num_shops)
 
         return self.preferred_shop
 
 
 class BadCustomer(Customer):
 
-    def __init__(self):
-        super(BadCustomer, self).__init__('b')
+    def __init__(self, random_streams=None):
+        super(BadCustomer, self).__init__('b', random_streams)
         self.recycle_prob = 0.1
 
     def choose_shop(self, num_shops):
-        return np.random.randint(0, num_shops, 1)[0]
+        return self.choice_random.randint(num_shops)
 
 
 class NeutralCustomer(Customer):
 
-    def __init__(self):
-        super(NeutralCustomer, self).__init__('n')
+    def __init__(self, random_streams=None):
+        super(NeutralCustomer, self).__init__('n', random_streams)
         self.recycle_prob = 0.60
         self.preferred_shops = []
         self.preference_ratio = 0.30
@@ -103,13 +110,14 @@ class NeutralCustomer(Customer):
     def choose_shop(self, num_shops):
 
         if len(self.preferred_shops) == 0:
-            chosen_shops = np.random.choice(np.arange(num_shops), int(max(1, np.ceil(self.preference_ratio*num_shops))),
-                                            replace=False)
-            for shop in chosen_shops:
+            # a random subset of the shops, the first entries of a random permutation
+            num_preferred = int(max(1, np.ceil(self.preference_ratio*num_shops)))
+            chosen_shops = preferred_subsets(self.choice_random.take(num_preferred)[None], num_shops)[0]
+            for shop in chosen_shops.tolist():
                 self.preferred_shops.append(shop)
 
         # choose one of the preferred shops at random
-        return np.random.choice(np.arange(len(self.preferred_shops)), 1, replace=False)[0]
+        return self.preferred_shops[self.choice_random.randint(len(self.preferred_shops))]
 
 
 
@@ -0,0 +1,195 @@
+"""@package CustomerBehaviour
+Implementation of customer types as behaviour kernels evaluated for all customers of a type at once
+
+A customer type is a CustomerBehaviour: the probability to recycle, the coins a purchase spends, the wallet above
+which the customer pays by coin, and a shop affinity kernel. A kernel works on the rows of a Population that
+belong to the type and is registered by name, so a population is described by plain parameters, for example in
+the --config file of the simulator:
+
+    "customer_types": [{"letter": "g", "affinity": "loyal", "recycle_prob": 0.9},
+                       {"letter": "s", "affinity": "subset", "recycle_prob": 0.75, "preference_ratio": 0.1,
+                        "coin_spend": 40, "coin_threshold": 250}],
+    "customer_distribution": [0.5, 0.5]
+
+Kernels draw from the choice stream in customer order: num_draws says how many uniform numbers each customer
+takes on a day and choose turns them into shops. A scalar loop over CustomerView objects runs the same kernels
+for one customer at a time and so consumes the stream exactly like the batched day.
+"""
+from abc import ABCMeta, abstractmethod
+import numpy as np
+
+COIN_THRESHOLD = 100
+COIN_SPEND = 100
+# entries of the (customers, shops) array new preference sets are shuffled in, bounds its size
+_PREFERENCE_BLOCK = 1 << 22
+
+
+class ShopAffinity(object, metaclass=ABCMeta):
+    """how the customers of a type pick their shop; rows index the population, first marks the customers that
+    have not chosen before"""
+    # whether the kernel keeps a set of preferred shops per customer in the population
+    preferred_sets = False
+
+    @abstractmethod
+    def num_draws(self, first, num_shops, behaviour):
+        pass
+
+    @abstractmethod
+    def choose(self, population, rows, first, draws, offsets, num_shops, behaviour):
+        # draws[offsets[i]:offsets[i] + num_draws] are the numbers of customer rows[i]
+        pass
+
+    @abstractmethod
+    def candidates(self, population, rows, num_shops, behaviour):
+        # the shops the customers spread their visits over, one row each, None for every shop
+        pass
+
+
+class LoyalAffinity(ShopAffinity):
+    """one shop drawn on the first day and visited ever after, like GoodCustomer"""
+
+    def num_draws(self, first, num_shops, behaviour):
+        return first.astype(np.int64)
+
+    def choose(self, population, rows, first, draws, offsets, num_shops, behaviour):
+        new = rows[first]
+        population.preferred_shops[new] = np.minimum((draws[offsets[first]]*num_shops).astype(np.int64),
+                                                     num_shops - 1)
+        return population.preferred_shops[rows]
+
+    def candidates(self, population, rows, num_shops, behaviour):
+        return population.preferred_shops[rows, None]
+
+
+class RandomAffinity(ShopAffinity):
+    """a new shop every day, like BadCustomer"""
+
+    def num_draws(self, first, num_shops, behaviour):
+        return np.ones(len(first), dtype=np.int64)
+
+    def choose(self, population, rows, first, draws, offsets, num_shops, behaviour):
+        return np.minimum((draws[offsets]*num_shops).astype(np.int64), num_shops - 1)
+
+    def candidates(self, population, rows, num_shops, behaviour):
+        return None
+
+
+class SubsetAffinity(ShopAffinity):
+    """a random subset of preference_ratio of the shops chosen on the first day, one of them every day, like
+    NeutralCustomer"""
+    preferred_sets = True
+
+    def num_draws(self, first, num_shops, behaviour):
+        return 1 + first*behaviour.num_preferences(num_shops)
+
+    def choose(self, population, rows, first, draws, offsets, num_shops, behaviour):
+        num_preferred = behaviour.num_preferences(num_shops)
+        new = np.flatnonzero(first)
+        for block in np.array_split(new, max(1, int(np.ceil(len(new)*num_shops / float(_PREFERENCE_BLOCK))))):
+            population.set_preferred_sets(rows[block], preferred_subsets(
+                draws[offsets[block, None] + np.arange(num_preferred)], num_shops))
+        daily_draws = draws[offsets + first*num_preferred]
+        choices = np.minimum((daily_draws*num_preferred).astype(np.int64), num_preferred - 1)
+        return population.preferred_sets[population.preferred_rows[rows], choices]
+
+    def candidates(self, population, rows, num_shops, behaviour):
+        return population.preferred_sets[population.preferred_rows[rows], :behaviour.num_preferences(num_shops)]
+
+
+def preferred_subsets(draws, num_shops):
+    # the first entries of a Fisher-Yates shuffle of the shops, one row of draws each, a number per entry
+    rows = np.arange(len(draws))
+    shops = np.tile(np.arange(num_shops, dtype=np.int32), (len(draws), 1))
+    for position in range(draws.shape[1]):
+        swap = position + np.minimum((draws[:, position]*(num_shops - position)).astype(np.int64),
+                                     num_shops - position - 1)
+        chosen = shops[rows, swap]
+        shops[rows, swap] = shops[rows, position]
+        shops[rows, position] = chosen
+    return shops[:, :draws.shape[1]]
+
+
+KERNELS = {'loyal': LoyalAffinity(),
+           'random': RandomAffinity(),
+           'subset': SubsetAffinity()}
+
+
+def register_kernel(name, kernel):
+    # makes a ShopAffinity available to customer types by name
+    KERNELS[name] = kernel
+
+
+class CustomerBehaviour(object):
+    """the parameters of one customer type"""
+
+    def __init__(self, letter, affinity, recycle_prob, coin_spend=COIN_SPEND, coin_threshold=COIN_THRESHOLD,
+                 preference_ratio=0.30):
+        if len(letter) != 1:
+            raise ValueError('a customer type is named by a single letter, not {!r}'.format(letter))
+        if affinity not in KERNELS:
+            raise ValueError('unknown shop affinity {!r}, known are {}'.format(affinity, ', '.join(sorted(KERNELS))))
+        self.letter = letter
+        self.affinity = affinity
+        self.kernel = KERNELS[affinity]
+        self.recycle_prob = float(recycle_prob)
+        self.coin_spend = float(coin_spend)
+        self.coin_threshold = float(coin_threshold)
+        self.preference_ratio = float(preference_ratio)
+
+    def num_preferences(self, num_shops):
+        return int(max(1, np.ceil(self.preference_ratio*num_shops)))
+
+    def get_config(self):
+        return {'letter': self.letter,
+                'affinity': self.affinity,
+                'recycle_prob': self.recycle_prob,
+                'coin_spend': self.coin_spend,
+                'coin_threshold': self.coin_threshold,
+                'preference_ratio': self.preference_ratio}
+
+
+# good, bad and neutral customers
+DEFAULT_CUSTOMER_TYPES = ({'letter': 'g', 'affinity': 'loyal', 'recycle_prob': 0.9},
+                          {'letter': 'b', 'affinity': 'random', 'recycle_prob': 0.1},
+                          {'letter': 'n', 'affinity': 'subset', 'recycle_prob': 0.60, 'preference_ratio': 0.30})
+
+
+def make_behaviours(customer_types=None):
+    # CustomerBehaviour objects or their parameters as dicts, the good, bad and neutral customers by default
+    if customer_types is None:
+        customer_types = DEFAULT_CUSTOMER_TYPES
+    behaviours = [customer_type if isinstance(customer_type, CustomerBehaviour) else CustomerBehaviour(**customer_type)
+                  for customer_type in customer_types]
+    letters = [behaviour.letter for behaviour in behaviours]
+    if len(set(letters)) != len(letters):
+        raise ValueError('customer type letters have to be distinct: {}'.format(', '.join(letters)))
+    return behaviours
+
+
+def _compare_with_scalar(num_customers=1000, num_shops=20, sim_iters=40, seed=11):
+    # a population defined by parameters only runs the same in the scalar loop over CustomerView objects and in
+    # the batched day, and the batched day does it at array speed
+    import time
+    from SimulationEngine import SimulationEngine
+
+    customer_types = [{'letter': 'g', 'affinity': 'loyal', 'recycle_prob': 0.9},
+                      {'letter': 'b', 'affinity': 'random', 'recycle_prob': 0.1, 'coin_threshold': 50},
+                      {'letter': 'n', 'affinity': 'subset', 'recycle_prob': 0.6},
+                      {'letter': 's', 'affinity': 'subset', 'recycle_prob': 0.75, 'preference_ratio': 0.1,
+                       'coin_spend': 40, 'coin_threshold': 250}]
+    parameters = (num_customers, num_shops, sim_iters, 200000, 20000, 0.5, 30)
+    summaries = []
+    for batched in (False, True):
+        start = time.time()
+        sim_engine = SimulationEngine(*parameters, batched=batched, render='headless', seed=seed,
+                                      customer_distribution=(0.2, 0.2, 0.3, 0.3), customer_types=customer_types)
+        sim_engine.run()
+        summaries.append(sim_engine.summary())
+        print('{}: {:.2f}s'.format('batched' if batched else 'scalar', time.time() - start))
+    for name, value in summaries[0].items():
+        assert np.isclose(value, summaries[1][name]), name
+    print('scalar and batched runs match: {}'.format(summaries[1]))
+
+
+if __name__ == '__main__':
+    _compare_with_scalar()
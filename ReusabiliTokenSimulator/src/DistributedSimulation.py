@@ -0,0 +1,346 @@
+"""@package DistributedSimulation
+Implementation of a simulation with customers partitioned over worker processes
+
+Every worker owns a contiguous slice of the customers: their coins, their reputation and a smart contract ledger
+for them. A day takes two messages to each worker. The first has the worker draw the shop choices, coin purchases
+and recycle decisions of its customers and answer how many of them recycle. The second tells it where its claims
+start among the claims of the market; the worker verifies them and sends the coordinator its per shop deltas
+(coins collected, reputation totals, recycle counts, shops that became known). The coordinator runs the dues
+payments, check_payments and the blacklisting on its own contract, and sends the blacklisted shops along with
+the next day.
+
+All workers read the same random streams as a single SimulationEngine. A worker only holds the rows of its own
+customers and advances the streams past the numbers of the other customers without drawing them, so for a given
+seed the run matches the batched single process engine, whatever the number of workers.
+"""
+import multiprocessing
+import numpy as np
+from Ledger import DenseLedger, SparseLedger
+from Population import Population
+from RandomStreams import RandomStreams
+from Shop import Shop
+from ShopListOracle import ShopListOracle
+from SimulationTimeOracle import SimulationTimeOracle
+from SmartContract import SmartContract
+
+DECAY_VALUE = 0.10
+
+
+def _owner_address(random_streams):
+    return random_streams.generator('address').integers(200000, 3300000, 1)
+
+
+def _configure(smart_contract, address, params):
+    smart_contract.set_coin_limit(address, params['coin_limit'])
+    smart_contract.set_reputation_limit(address, params['rep_limit'])
+    smart_contract.set_reward_curve_coefficient(address, params['reward_curve_coefficient'])
+    smart_contract.set_payment_duration(address, params['payment_due'])
+    smart_contract.set_coins_per_reputation_token(address, params['coin_rep_factor'])
+
+
+class Partition(object):
+    """the customers [start, stop) of a market, with a contract whose ledger addresses them from 0"""
+
+    def __init__(self, params, start, stop):
+        self.start = start
+        self.stop = stop
+        self.shop_addresses = np.asarray(params['shop_addresses'], dtype=np.int64)
+        self.random_streams = RandomStreams(params['seed'])
+        # only the owned customers are kept, the draws of the others are skipped
+        self.population = Population(params['num_customers'], params['customer_distribution'], self.random_streams,
+                                     params['customer_types'], owned=slice(start, stop))
+        self.customer_addresses = np.arange(stop - start, dtype=np.int64)
+        self.address = _owner_address(self.random_streams)
+        self.time_oracle = SimulationTimeOracle()
+        shop_list_oracle = ShopListOracle()
+        shop_list_oracle.register_shops(self.shop_addresses)
+        ledger_type = SparseLedger if params['sparse_ledger'] else DenseLedger
+        self.smart_contract = SmartContract(self.address[0], ledger_type(stop - start,
+                                                                         int(self.shop_addresses.max()) + 1,
+                                                                         lazy_decay=params['lazy_decay']))
+        self.smart_contract.set_oracle(self.address, shop_list_oracle, self.time_oracle)
+        _configure(self.smart_contract, self.address, params)
+        self.reported_shops = set()
+        self.chosen_shops = None
+        self.shop_coins = None
+        self.recycling = None
+
+    def choose(self, blacklisted_shops):
+        # the first half of a day of the batched engine for the owned customers, up to the recycle decisions;
+        # returns how many of them recycle, which places their claims in the claim stream
+        population = self.population
+        shop_addresses = self.shop_addresses
+        num_shops = len(shop_addresses)
+        self.time_oracle.increment_time()
+        self.smart_contract.black_listed_shops.add_many(blacklisted_shops)
+
+        self.chosen_shops = population.draw_shop_choices(num_shops)
+        buy_with_coins = population.coins > population.coin_thresholds
+        spent = population.coin_spends[buy_with_coins]
+        self.smart_contract.customers_buy_with_coin(self.customer_addresses[buy_with_coins],
+                                                    shop_addresses[self.chosen_shops[buy_with_coins]], spent)
+        self.shop_coins = np.bincount(self.chosen_shops[buy_with_coins], weights=spent, minlength=num_shops)
+        self.recycling = population.draw_recycling()
+        return len(self.recycling)
+
+    def verify(self, claims_before, num_claims, claim_failure_probability):
+        # the rest of the day up to the dues payments of the coordinator; the claims of the market are numbered
+        # in customer order and the owned ones are claims_before onwards
+        population = self.population
+        smart_contract = self.smart_contract
+        shop_addresses = self.shop_addresses
+        recycling = self.recycling
+        claim_random = self.random_streams.buffer('claims')
+        claim_random.skip(claims_before)
+        failed = claim_random.take(len(recycling)) < claim_failure_probability
+        claim_random.skip(num_claims - claims_before - len(recycling))
+        recycled_shops = shop_addresses[self.chosen_shops[recycling]]
+        smart_contract.submit_claims(recycled_shops, recycling)
+        verifying_shops = np.where(failed, self.address[0], recycled_shops)
+        res, coins, reps = smart_contract.verify_claims(verifying_shops, recycling)
+        verified = recycling[res]
+        population.coins[verified] += coins[res]
+        population.transfer_reputation(verified, recycled_shops[res], reps[res], smart_contract.reputation_limit)
+
+        new_payment_shops = [shop for shop in smart_contract.shop_payment_times if shop not in self.reported_shops]
+        self.reported_shops.update(new_payment_shops)
+        report = {'shop_coins': self.shop_coins,
+                  'shop_reputation': smart_contract.calculate_shop_reputations(shop_addresses),
+                  'recycles': np.bincount(self.chosen_shops[recycling], minlength=len(shop_addresses)),
+                  'known_shops': smart_contract.known_shops.to_array(),
+                  'payment_shops': np.array(new_payment_shops, dtype=np.int64),
+                  'failed_claims': int(np.count_nonzero(failed)),
+                  'counters': smart_contract.get_counters()}
+        smart_contract.deteriorate_customer_reputation(self.address, value=DECAY_VALUE)
+        return report
+
+    def summary(self):
+        ledger = self.smart_contract.ledger
+        customer_reputation = self.smart_contract.calculate_customer_reputations(self.customer_addresses)
+        types = self.population.types
+        return {'customer_coins': float(ledger.coins[:ledger.num_customers].sum()),
+                'shop_reputation': float(self.smart_contract.calculate_shop_reputations(self.shop_addresses).sum()),
+                'coin_purchases': int(ledger.purchases[:ledger.num_customers].sum()),
+                'reputation_sums': np.bincount(types, weights=customer_reputation,
+                                               minlength=len(self.population.letters)),
+                'type_counts': np.bincount(types, minlength=len(self.population.letters)),
+                'letters': self.population.letters.tolist(),
+                'counters': self.smart_contract.get_counters()}
+
+
+_COMMANDS = ('choose', 'verify', 'summary')
+
+
+def _serve(connection, params, start, stop):
+    # worker process: answers ('choose', args), ('verify', args), ('summary', ()) and ('stop', ())
+    partition = Partition(params, start, stop)
+    while True:
+        command, arguments = connection.recv()
+        if command not in _COMMANDS:
+            break
+        connection.send(getattr(partition, command)(*arguments))
+    connection.close()
+
+
+class _LocalWorker(object):
+    """a partition in the coordinator process, for num_workers=0"""
+
+    def __init__(self, params, start, stop):
+        self.partition = Partition(params, start, stop)
+        self.result = None
+
+    def send(self, message):
+        command, arguments = message
+        if command in _COMMANDS:
+            self.result = getattr(self.partition, command)(*arguments)
+
+    def recv(self):
+        return self.result
+
+    def close(self):
+        pass
+
+
+class CoordinatorContract(SmartContract):
+    """holds no customers, its shop reputation is the sum the workers reported for the day"""
+
+    def __init__(self, owner_address):
+        super(CoordinatorContract, self).__init__(owner_address, DenseLedger(0, 0))
+        self.shop_reputation = {}
+
+    def calculate_shop_reputation(self, shop_address):
+        return self.shop_reputation.get(shop_address, 0.0)
+
+    def calculate_shop_reputations(self, shop_addresses):
+        return np.array([self.shop_reputation.get(shop, 0.0) for shop in np.asarray(shop_addresses).tolist()])
+
+
+class DistributedSimulation(object):
+
+    def __init__(self, num_customers, num_shops, sim_iters, coin_limit, rep_limit, coin_rep_factor, payment_due,
+                 num_workers=2, customer_distribution=(0.2, 0.2, 0.6), seed=None, reward_curve_coefficient=0.0005,
+                 sparse_ledger=False, lazy_decay=False, customer_types=None):
+        self.num_customers = num_customers
+        self.num_shops = num_shops
+        self.sim_iters = sim_iters
+        self.payment_due = payment_due
+        self.days_run = 0
+        # workers have to agree on the streams, so an unseeded run fixes its entropy here
+        self.random_streams = RandomStreams(seed)
+        self.seed = self.random_streams.seed_sequence.entropy if seed is None else seed
+        self.shops = [Shop() for _ in range(num_shops)]
+        self.shop_addresses = np.array([shop.get_shop_address() for shop in self.shops])
+        self.address = _owner_address(self.random_streams)
+        self.time_oracle = SimulationTimeOracle()
+        self.shop_list_oracle = ShopListOracle()
+        self.shop_list_oracle.register_shops(self.shop_addresses)
+        self.smart_contract = CoordinatorContract(self.address[0])
+        self.smart_contract.set_oracle(self.address, self.shop_list_oracle, self.time_oracle)
+        params = {'num_customers': num_customers,
+                  'customer_distribution': list(customer_distribution),
+                  'customer_types': customer_types,
+                  'seed': self.seed,
+                  'shop_addresses': self.shop_addresses,
+                  'coin_limit': coin_limit,
+                  'rep_limit': rep_limit,
+                  'coin_rep_factor': coin_rep_factor,
+                  'payment_due': payment_due,
+                  'reward_curve_coefficient': reward_curve_coefficient,
+                  'sparse_ledger': sparse_ledger,
+                  'lazy_decay': lazy_decay}
+        _configure(self.smart_contract, self.address, params)
+        self.recycles = np.zeros(num_shops, dtype=np.int64)
+        self.worker_counters = {}
+
+        bounds = np.linspace(0, num_customers, max(1, num_workers) + 1).astype(np.int64).tolist()
+        self.workers = []
+        self.processes = []
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            if num_workers == 0:
+                self.workers.append(_LocalWorker(params, start, stop))
+                continue
+            connection, worker_connection = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_serve, args=(worker_connection, params, start, stop))
+            process.daemon = True
+            process.start()
+            self.workers.append(connection)
+            self.processes.append(process)
+
+    def run(self, claim_failure_probability=0.00001):
+        for day in range(self.sim_iters):
+            self.time_oracle.increment_time()
+            if self.smart_contract.valid_shops_left(self.shop_addresses) is False:
+                print('\n' + '*' * 15 + '\n')
+                print('Tough luck. No shop earned enough coin to pay their dues.')
+                print('The experiment ran for {} days.'.format(day))
+                print('\n' + '*' * 15 + '\n')
+                self.days_run = day
+                return
+
+            # the shops blacklisted so far, workers reject their claims from this day on
+            blacklisted = self.smart_contract.black_listed_shops.to_array()
+            for worker in self.workers:
+                worker.send(('choose', (blacklisted,)))
+            num_claims = [worker.recv() for worker in self.workers]
+            claims_before = np.cumsum(num_claims) - num_claims
+            for worker, before in zip(self.workers, claims_before.tolist()):
+                worker.send(('verify', (before, sum(num_claims), claim_failure_probability)))
+            reports = [worker.recv() for worker in self.workers]
+            self._merge(reports)
+
+            if day != 0 and np.mod(day, self.payment_due):
+                for shop in self.shops:
+                    shop.pay_dues_to_smart_contract(self.smart_contract)
+
+                self.smart_contract.check_payments(self.address, day)
+
+        print('\n' + '*' * 15 + '\n')
+        print('Customers recycled their goods and shops paid their dues.')
+        print('The experiment ran successfully for {} days.'.format(self.sim_iters))
+        self.days_run = self.sim_iters
+        print('\n' + '*' * 15 + '\n')
+
+    def _merge(self, reports):
+        # the per shop deltas of all partitions, in partition order
+        time = self.time_oracle.get_time()
+        smart_contract = self.smart_contract
+        shop_reputation = np.zeros(self.num_shops)
+        failed_claims = 0
+        for index, report in enumerate(reports):
+            for shop, coins in zip(self.shops, report['shop_coins'].tolist()):
+                shop.buy_with_coins(coins)
+            shop_reputation += report['shop_reputation']
+            self.recycles += report['recycles']
+            smart_contract.known_shops.add_many(report['known_shops'])
+            for shop_address in report['payment_shops'].tolist():
+                smart_contract.shop_payment_times.setdefault(shop_address, time)
+            failed_claims += report['failed_claims']
+            self.worker_counters[index] = report['counters']
+        smart_contract.shop_reputation = dict(zip(self.shop_addresses.tolist(), shop_reputation.tolist()))
+        if failed_claims > 0:
+            print('{} claims failed'.format(failed_claims))
+
+    def get_counters(self):
+        counters = dict(self.smart_contract.get_counters())
+        for worker_counters in self.worker_counters.values():
+            for name, value in worker_counters.items():
+                counters[name] += value
+        return counters
+
+    def summary(self):
+        for worker in self.workers:
+            worker.send(('summary', ()))
+        parts = [worker.recv() for worker in self.workers]
+        reputation_sums = sum(part['reputation_sums'] for part in parts)
+        type_counts = sum(part['type_counts'] for part in parts)
+        summary = {'days_run': self.days_run,
+                   'survived': self.days_run == self.sim_iters,
+                   'blacklisted_shops': len(self.smart_contract.black_listed_shops),
+                   'customer_coins': float(sum(part['customer_coins'] for part in parts)),
+                   'coin_purchases': int(sum(part['coin_purchases'] for part in parts)),
+                   'shop_coins': float(sum(shop.get_coin_count() for shop in self.shops)),
+                   'shop_reputation': sum(part['shop_reputation'] for part in parts)}
+        for t, letter in enumerate(parts[0]['letters']):
+            summary['mean_reputation_' + letter] = \
+                float(reputation_sums[t] / type_counts[t]) if type_counts[t] > 0 else 0.0
+        return summary
+
+    def close(self):
+        for worker in self.workers:
+            worker.send(('stop', ()))
+            worker.close()
+        for process in self.processes:
+            process.join()
+        self.workers = []
+        self.processes = []
+
+
+def _compare_with_engine(num_workers=2, num_customers=20000, num_shops=20, sim_iters=60, payment_due=10, seed=7):
+    # a distributed run has to end where the batched single process engine ends for the same seed
+    import time
+    from SimulationEngine import SimulationEngine
+
+    parameters = (num_customers, num_shops, sim_iters, 200000, 20000, 0.5, payment_due)
+    start = time.time()
+    engine = SimulationEngine(*parameters, batched=True, render='headless', seed=seed)
+    engine.run()
+    engine_time = time.time() - start
+    start = time.time()
+    simulation = DistributedSimulation(*parameters, num_workers=num_workers, seed=seed)
+    simulation.run()
+    simulation_time = time.time() - start
+    summary = simulation.summary()
+    counters = simulation.get_counters()
+    simulation.close()
+
+    for name, value in engine.summary().items():
+        assert np.isclose(value, summary[name]), name
+    for name, value in engine.smart_contract.get_counters().items():
+        assert np.isclose(value, counters[name]), name
+    print('{} workers: {:.2f}s, single process: {:.2f}s, results match'.format(num_workers, simulation_time,
+                                                                             engine_time))
+
+
+if __name__ == '__main__':
+    for workers in (0, 1, 2, 4):
+        _compare_with_engine(num_workers=workers)
@@ -0,0 +1,63 @@
+"""@package EventScheduler
+Implementation of a discrete event scheduler keyed on simulation time
+
+Events are (time, kind, shop) entries in a binary heap. Events due at the same time run in the order of their
+kind, then in the order they were scheduled. Advancing the scheduler pops only the events that are due, so a
+day without events costs one comparison with the top of the heap, and a stretch of days without events can be
+skipped in one step.
+"""
+import heapq
+import numpy as np
+
+# kinds, in the order events due at the same time are handled
+DUES = 0
+DEADLINE = 1
+DECAY = 2
+EVENT_NAMES = ('dues', 'deadline', 'decay')
+
+
+class EventScheduler(object):
+
+    def __init__(self):
+        self.events = []
+        self.sequence = 0
+
+    def schedule(self, time, kind, shop=-1):
+        heapq.heappush(self.events, (time, kind, self.sequence, shop))
+        self.sequence += 1
+
+    def next_time(self, ignore=()):
+        # time of the next event whose kind is not in ignore
+        if not ignore:
+            return self.events[0][0] if self.events else None
+        times = [event[0] for event in self.events if event[1] not in ignore]
+        return min(times) if times else None
+
+    def pop_due(self, time):
+        # yields (time, kind, shop) of every event due up to and including time, in order; events scheduled by
+        # the caller while iterating are picked up if they are due as well
+        events = self.events
+        while events and events[0][0] <= time:
+            event_time, kind, _, shop = heapq.heappop(events)
+            yield event_time, kind, shop
+
+    def advance(self, time_oracle, time, handler):
+        # moves the time oracle to every event time up to time, lets handler(kind, shop) run the event, and
+        # skips the idle time in between
+        for event_time, kind, shop in self.pop_due(time):
+            time_oracle.time = event_time
+            handler(kind, shop)
+        time_oracle.time = time
+
+    def __len__(self):
+        return len(self.events)
+
+    def get_state(self):
+        events = sorted(self.events)
+        return {'events': np.array(events, dtype=np.int64).reshape(len(events), 4),
+                'sequence': self.sequence}
+
+    def set_state(self, state):
+        self.events = [tuple(event) for event in np.asarray(state['events']).tolist()]
+        heapq.heapify(self.events)
+        self.sequence = int(state['sequence'])
@@ -0,0 +1,437 @@
+"""@package Ledger
+Implementation of array backed ledgers for the smart contract
+
+Customer and shop addresses are used directly as array indices. The per customer and per shop vectors
+(coins, coin purchases, coins collected at shops) are dense in every ledger, the customer x shop reputation
+and recycle counts are stored either as dense matrices or as sorted (customer, shop) keys.
+Per customer and per shop reputation totals are maintained alongside every reputation update, so reading
+them does not scan the matrix.
+
+Reputation decay is one in place pass over the stored values. With lazy_decay the ledger instead keeps a
+global reputation_scale that every stored value is multiplied with when read, so a day's decay is O(1).
+"""
+from abc import ABCMeta, abstractmethod
+import numpy as np
+
+
+# stored values are folded back into the matrix before the lazy decay scale underflows
+_MIN_REPUTATION_SCALE = 1e-100
+_DECAY_CHUNK = 1 << 16
+
+
+def _decay_in_place(values, value):
+    # values -= values*value without a full size temporary; values may be a view into a larger matrix, so it
+    # is worked through in blocks of rows instead of a flattened copy
+    if values.ndim == 1:
+        values = values[:, None]
+    rows = max(1, _DECAY_CHUNK // max(1, values.shape[1]))
+    for start in range(0, len(values), rows):
+        chunk = values[start:start + rows]
+        chunk -= chunk*value
+
+
+def _gather(vector, addresses, size):
+    addresses = np.asarray(addresses, dtype=np.int64)
+    known = addresses < size
+    values = np.zeros(len(addresses), dtype=vector.dtype)
+    values[known] = vector[addresses[known]]
+    return values
+
+
+def _grown_size(size, required):
+    return max(required, 2*size, 16)
+
+
+def _grow_vector(vector, required):
+    if required <= len(vector):
+        return vector
+    grown = np.zeros(_grown_size(len(vector), required), dtype=vector.dtype)
+    grown[:len(vector)] = vector
+    return grown
+
+
+class Ledger(object):
+    __metaclass__ = ABCMeta
+
+    def __init__(self, num_customers=0, num_shops=0, lazy_decay=False):
+        self.lazy_decay = lazy_decay
+        self.reputation_scale = 1.0
+        self.reputation_nonnegative = True
+        self.num_customers = 0
+        self.num_shops = 0
+        self.coins = np.zeros(num_customers)
+        self.coin_accounts = np.zeros(num_customers, dtype=bool)
+        self.purchases = np.zeros(num_customers, dtype=np.int64)
+        self.shop_coins = np.zeros(num_shops)
+        self.shop_accounts = np.zeros(num_shops, dtype=bool)
+        self.customer_reputation_totals = np.zeros(num_customers)
+        self.shop_reputation_totals = np.zeros(num_shops)
+        self.ensure_customers(num_customers)
+        self.ensure_shops(num_shops)
+
+    def ensure_customers(self, num_customers):
+        if num_customers <= self.num_customers:
+            return
+        self.coins = _grow_vector(self.coins, num_customers)
+        self.coin_accounts = _grow_vector(self.coin_accounts, num_customers)
+        self.purchases = _grow_vector(self.purchases, num_customers)
+        self.customer_reputation_totals = _grow_vector(self.customer_reputation_totals, num_customers)
+        self._grow_matrix(num_customers, self.num_shops)
+        self.num_customers = num_customers
+
+    def ensure_shops(self, num_shops):
+        if num_shops <= self.num_shops:
+            return
+        self.shop_coins = _grow_vector(self.shop_coins, num_shops)
+        self.shop_accounts = _grow_vector(self.shop_accounts, num_shops)
+        self.shop_reputation_totals = _grow_vector(self.shop_reputation_totals, num_shops)
+        self._grow_matrix(self.num_customers, num_shops)
+        self.num_shops = num_shops
+
+    def ensure(self, customer_addresses, shop_addresses):
+        if np.size(customer_addresses) > 0:
+            self.ensure_customers(int(np.max(customer_addresses)) + 1)
+        if np.size(shop_addresses) > 0:
+            self.ensure_shops(int(np.max(shop_addresses)) + 1)
+
+    def coin_balance(self, customer_address):
+        if customer_address >= self.num_customers:
+            return 0
+        return self.coins[customer_address]
+
+    def transfer_coins(self, customer_addresses, num_coins):
+        self.ensure(customer_addresses, [])
+        np.add.at(self.coins, customer_addresses, num_coins)
+        self.coin_accounts[customer_addresses] = True
+
+    def record_purchases(self, customer_addresses, shop_addresses, num_coins, num_purchases=1):
+        self.ensure(customer_addresses, shop_addresses)
+        np.subtract.at(self.coins, customer_addresses, num_coins)
+        self.coin_accounts[customer_addresses] = True
+        np.add.at(self.shop_coins, shop_addresses, num_coins)
+        self.shop_accounts[shop_addresses] = True
+        np.add.at(self.purchases, customer_addresses, num_purchases)
+
+    def reputation_of(self, customer_addresses, shop_addresses):
+        return self._stored_reputation(customer_addresses, shop_addresses)*self.reputation_scale
+
+    def set_reputation(self, customer_addresses, shop_addresses, reputation):
+        self.ensure(customer_addresses, shop_addresses)
+        stored = reputation/self.reputation_scale
+        delta = stored - self._stored_reputation(customer_addresses, shop_addresses)
+        self._store_reputation(customer_addresses, shop_addresses, stored)
+        np.add.at(self.customer_reputation_totals, customer_addresses, delta)
+        np.add.at(self.shop_reputation_totals, shop_addresses, delta)
+        if np.any(np.asarray(reputation) < 0):
+            self.reputation_nonnegative = False
+
+    def decay_reputation(self, value):
+        if self.reputation_nonnegative and value <= 1:
+            # reputation >= reputation*value holds for every entry, so every entry decays
+            if self.lazy_decay:
+                self.reputation_scale -= self.reputation_scale*value
+                if self.reputation_scale < _MIN_REPUTATION_SCALE:
+                    self.materialize_reputation()
+            else:
+                _decay_in_place(self._reputation_values(), value)
+                _decay_in_place(self.customer_reputation_totals[:self.num_customers], value)
+                _decay_in_place(self.shop_reputation_totals[:self.num_shops], value)
+            return
+
+        self.materialize_reputation()
+        reputation = self._reputation_values()
+        curr_rep = reputation*value
+        decrement = np.where(reputation >= curr_rep, curr_rep, 0)
+        reputation -= decrement
+        customer_decrement, shop_decrement = self._reputation_sums(decrement)
+        self.customer_reputation_totals[:self.num_customers] -= customer_decrement
+        self.shop_reputation_totals[:self.num_shops] -= shop_decrement
+
+    def materialize_reputation(self):
+        # apply a pending lazy decay scale to the stored values
+        if self.reputation_scale == 1.0:
+            return
+        self._reputation_values()[...] *= self.reputation_scale
+        self.customer_reputation_totals *= self.reputation_scale
+        self.shop_reputation_totals *= self.reputation_scale
+        self.reputation_scale = 1.0
+
+    def customer_reputation(self, customer_address):
+        if customer_address >= self.num_customers:
+            return 0
+        return self.customer_reputation_totals[customer_address]*self.reputation_scale
+
+    def shop_reputation(self, shop_address):
+        if shop_address >= self.num_shops:
+            return 0
+        return self.shop_reputation_totals[shop_address]*self.reputation_scale
+
+    def customer_reputations(self, customer_addresses):
+        return _gather(self.customer_reputation_totals, customer_addresses, self.num_customers)*self.reputation_scale
+
+    def shop_reputations(self, shop_addresses):
+        return _gather(self.shop_reputation_totals, shop_addresses, self.num_shops)*self.reputation_scale
+
+    def customer_purchases(self, customer_addresses):
+        return _gather(self.purchases, customer_addresses, self.num_customers)
+
+    def customer_coins(self, customer_addresses):
+        return _gather(self.coins, customer_addresses, self.num_customers)
+
+    def reputation_entries(self):
+        customers, shops, values = self._stored_reputation_entries()
+        return customers, shops, values*self.reputation_scale
+
+    def recompute_reputation_totals(self):
+        return self._reputation_sums(self._reputation_values())
+
+    def reputation_totals_error(self):
+        # largest relative deviation between the running totals and a full recompute of the reputation matrix
+        customer_totals, shop_totals = self.recompute_reputation_totals()
+        customer_error = (np.abs(self.customer_reputation_totals[:self.num_customers] - customer_totals) /
+                          np.maximum(np.abs(customer_totals), 1))
+        shop_error = np.abs(self.shop_reputation_totals[:self.num_shops] - shop_totals) / np.maximum(np.abs(shop_totals), 1)
+        return max(customer_error.max(initial=0), shop_error.max(initial=0))
+
+    def coin_map(self):
+        customers = np.flatnonzero(self.coin_accounts[:self.num_customers])
+        return dict(zip(customers.tolist(), self.coins[customers].tolist()))
+
+    def purchase_map(self):
+        customers = np.flatnonzero(self.purchases[:self.num_customers])
+        return dict(zip(customers.tolist(), self.purchases[customers].tolist()))
+
+    def shop_coin_map(self):
+        shops = np.flatnonzero(self.shop_accounts[:self.num_shops])
+        return dict(zip(shops.tolist(), self.shop_coins[shops].tolist()))
+
+    def reputation_map(self):
+        return self._nested_map(*self.reputation_entries())
+
+    def recycle_map(self):
+        return self._nested_map(*self.recycle_entries())
+
+    @staticmethod
+    def _nested_map(customers, shops, values):
+        nested = {}
+        for customer, shop, value in zip(customers.tolist(), shops.tolist(), values.tolist()):
+            nested.setdefault(customer, {})[shop] = value
+        return nested
+
+    def get_state(self):
+        # plain arrays and numbers, trimmed to the customers and shops in use
+        num_customers, num_shops = self.num_customers, self.num_shops
+        state = {'lazy_decay': self.lazy_decay,
+                 'reputation_scale': self.reputation_scale,
+                 'reputation_nonnegative': self.reputation_nonnegative,
+                 'num_customers': num_customers,
+                 'num_shops': num_shops,
+                 'coins': self.coins[:num_customers],
+                 'coin_accounts': self.coin_accounts[:num_customers],
+                 'purchases': self.purchases[:num_customers],
+                 'customer_reputation_totals': self.customer_reputation_totals[:num_customers],
+                 'shop_coins': self.shop_coins[:num_shops],
+                 'shop_accounts': self.shop_accounts[:num_shops],
+                 'shop_reputation_totals': self.shop_reputation_totals[:num_shops]}
+        state.update(self._matrix_state())
+        return state
+
+    def set_state(self, state):
+        self.lazy_decay = bool(state['lazy_decay'])
+        self.reputation_scale = float(state['reputation_scale'])
+        self.reputation_nonnegative = bool(state['reputation_nonnegative'])
+        self.num_customers = int(state['num_customers'])
+        self.num_shops = int(state['num_shops'])
+        for name in ('coins', 'coin_accounts', 'purchases', 'customer_reputation_totals', 'shop_coins',
+                     'shop_accounts', 'shop_reputation_totals'):
+            setattr(self, name, np.array(state[name]))
+        self._set_matrix_state(state)
+
+    @abstractmethod
+    def _grow_matrix(self, num_customers, num_shops):
+        pass
+
+    @abstractmethod
+    def _matrix_state(self):
+        pass
+
+    @abstractmethod
+    def _set_matrix_state(self, state):
+        pass
+
+    @abstractmethod
+    def _stored_reputation(self, customer_addresses, shop_addresses):
+        pass
+
+    @abstractmethod
+    def _store_reputation(self, customer_addresses, shop_addresses, reputation):
+        pass
+
+    @abstractmethod
+    def _reputation_values(self):
+        pass
+
+    @abstractmethod
+    def _reputation_sums(self, values):
+        pass
+
+    @abstractmethod
+    def increment_recycles(self, customer_addresses, shop_addresses, count=1):
+        pass
+
+    @abstractmethod
+    def _stored_reputation_entries(self):
+        pass
+
+    @abstractmethod
+    def recycle_entries(self):
+        pass
+
+
+class DenseLedger(Ledger):
+    """customer x shop matrices, suited for markets with a moderate number of shops"""
+
+    def __init__(self, num_customers=0, num_shops=0, lazy_decay=False):
+        self.reputation = np.zeros((num_customers, num_shops))
+        self.recycles = np.zeros((num_customers, num_shops), dtype=np.int32)
+        super(DenseLedger, self).__init__(num_customers, num_shops, lazy_decay)
+
+    def _grow_matrix(self, num_customers, num_shops):
+        rows, cols = self.reputation.shape
+        if num_customers <= rows and num_shops <= cols:
+            return
+        if num_customers > rows:
+            rows = _grown_size(rows, num_customers)
+        if num_shops > cols:
+            cols = _grown_size(cols, num_shops)
+        for name in ('reputation', 'recycles'):
+            old = getattr(self, name)
+            grown = np.zeros((rows, cols), dtype=old.dtype)
+            grown[:old.shape[0], :old.shape[1]] = old
+            setattr(self, name, grown)
+
+    def _matrix_state(self):
+        return {'reputation': self.reputation[:self.num_customers, :self.num_shops],
+                'recycles': self.recycles[:self.num_customers, :self.num_shops]}
+
+    def _set_matrix_state(self, state):
+        self.reputation = np.array(state['reputation'])
+        self.recycles = np.array(state['recycles'])
+
+    def _stored_reputation(self, customer_addresses, shop_addresses):
+        return self.reputation[customer_addresses, shop_addresses]
+
+    def _store_reputation(self, customer_addresses, shop_addresses, reputation):
+        self.reputation[customer_addresses, shop_addresses] = reputation
+
+    def _reputation_values(self):
+        # the customers and shops in use, the matrix itself is allocated with room to grow
+        return self.reputation[:self.num_customers, :self.num_shops]
+
+    def _reputation_sums(self, values):
+        return values.sum(axis=1), values.sum(axis=0)
+
+    def increment_recycles(self, customer_addresses, shop_addresses, count=1):
+        self.ensure(customer_addresses, shop_addresses)
+        self.recycles[customer_addresses, shop_addresses] += count
+        return self.recycles[customer_addresses, shop_addresses]
+
+    def _stored_reputation_entries(self):
+        customers, shops = np.nonzero(self.recycles)
+        return customers, shops, self.reputation[customers, shops]
+
+    def recycle_entries(self):
+        customers, shops = np.nonzero(self.recycles)
+        return customers, shops, self.recycles[customers, shops]
+
+
+class SparseMatrix(object):
+    """(row, column) -> value store kept as keys sorted in row major (CSR) order"""
+
+    def __init__(self, dtype):
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.values = np.zeros(0, dtype=dtype)
+
+    @staticmethod
+    def make_keys(rows, cols):
+        return (np.asarray(rows, dtype=np.int64) << 32) | np.asarray(cols, dtype=np.int64)
+
+    def _find(self, keys):
+        pos = np.searchsorted(self.keys, keys)
+        found = pos < len(self.keys)
+        found[found] = self.keys[pos[found]] == keys[found]
+        return pos, found
+
+    def get(self, rows, cols):
+        keys = np.atleast_1d(self.make_keys(rows, cols))
+        pos, found = self._find(keys)
+        values = np.zeros(len(keys), dtype=self.values.dtype)
+        values[found] = self.values[pos[found]]
+        return values if np.ndim(rows) > 0 else values[0]
+
+    def set(self, rows, cols, values):
+        keys = np.atleast_1d(self.make_keys(rows, cols))
+        values = np.broadcast_to(np.asarray(values, dtype=self.values.dtype), keys.shape)
+        pos, found = self._find(keys)
+        self.values[pos[found]] = values[found]
+        if not np.all(found):
+            keys = np.concatenate([self.keys, keys[~found]])
+            merged = np.concatenate([self.values, values[~found]])
+            order = np.argsort(keys, kind='stable')
+            self.keys = keys[order]
+            self.values = merged[order]
+
+    def to_coo(self):
+        return self.keys >> 32, self.keys & 0xffffffff, self.values
+
+    def get_state(self):
+        return {'keys': self.keys, 'values': self.values}
+
+    def set_state(self, state):
+        self.keys = np.array(state['keys'])
+        self.values = np.array(state['values'])
+
+
+class SparseLedger(Ledger):
+    """COO/CSR reputation and recycle counts, suited for markets with many shops"""
+
+    def __init__(self, num_customers=0, num_shops=0, lazy_decay=False):
+        self.reputation = SparseMatrix(np.float64)
+        self.recycles = SparseMatrix(np.int32)
+        super(SparseLedger, self).__init__(num_customers, num_shops, lazy_decay)
+
+    def _grow_matrix(self, num_customers, num_shops):
+        pass
+
+    def _matrix_state(self):
+        return {'reputation': self.reputation.get_state(), 'recycles': self.recycles.get_state()}
+
+    def _set_matrix_state(self, state):
+        self.reputation.set_state(state['reputation'])
+        self.recycles.set_state(state['recycles'])
+
+    def _stored_reputation(self, customer_addresses, shop_addresses):
+        return self.reputation.get(customer_addresses, shop_addresses)
+
+    def _store_reputation(self, customer_addresses, shop_addresses, reputation):
+        self.reputation.set(customer_addresses, shop_addresses, reputation)
+
+    def _reputation_values(self):
+        return self.reputation.values
+
+    def _reputation_sums(self, values):
+        customers, shops, _ = self.reputation.to_coo()
+        return (np.bincount(customers, weights=values, minlength=self.num_customers),
+                np.bincount(shops, weights=values, minlength=self.num_shops))
+
+    def increment_recycles(self, customer_addresses, shop_addresses, count=1):
+        self.ensure(customer_addresses, shop_addresses)
+        visits = self.recycles.get(customer_addresses, shop_addresses) + count
+        self.recycles.set(customer_addresses, shop_addresses, visits)
+        return visits
+
+    def _stored_reputation_entries(self):
+        return self.reputation.to_coo()
+
+    def recycle_entries(self):
+        return self.recycles.to_coo()
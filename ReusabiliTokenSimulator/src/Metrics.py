@@ -0,0 +1,191 @@
+"""@package Metrics
+Implementation of a per day metrics stream for simulation runs
+
+At the end of every simulated day the MetricsRecorder writes one row into a preallocated NumPy structured array.
+Flows (coins, claims, blacklistings) are the change of the smart contract counters over the day, levels (shop
+reputation, blacklisted shops, the reputation distribution per customer type) are read at the end of the day.
+The distribution has columns for every customer type of the engine, so the row layout is fixed when the recorder
+starts.
+Full buffers are handed to the sinks in one chunk, so a day costs one row assignment plus the reputation
+quantiles. Sinks keep the rows in memory, append them to a CSV file, write columnar .npz chunks or fill a
+memory mapped .npy file.
+"""
+import csv
+import glob
+import numpy as np
+
+FLOWS = ('coins_issued', 'coins_spent', 'claims_made', 'claims_verified', 'claims_failed', 'blacklist_events',
+         'payments')
+LEVELS = ('blacklisted_shops', 'shop_reputation', 'wallet_coins')
+QUANTILES = (10, 50, 90)
+
+
+def row_dtype(letters):
+    # a row for a population with customer types named by letters
+    distribution = (['reputation_mean_' + t for t in letters] +
+                    ['reputation_p{}_{}'.format(q, t) for t in letters for q in QUANTILES])
+    return np.dtype([('day', np.int64)] + [(name, np.float64) for name in FLOWS + LEVELS + tuple(distribution)])
+
+
+class MetricsRecorder(object):
+
+    def __init__(self, sinks=(), buffer_days=64):
+        self.sinks = list(sinks)
+        self.buffer_days = buffer_days
+        self.buffer = None
+        self.size = 0
+        self.previous = dict.fromkeys(FLOWS, 0)
+        self.letters = None
+        self.type_indices = None
+
+    def start(self, sim_engine):
+        # flows of the first recorded day are counted from here, also when a run is resumed
+        self.previous = sim_engine.smart_contract.get_counters()
+        population = sim_engine.customers
+        self.letters = population.letters.tolist()
+        self.type_indices = [np.flatnonzero(population.types == t) for t in range(len(self.letters))]
+        dtype = row_dtype(self.letters)
+        if self.buffer is None or self.buffer.dtype != dtype:
+            self.flush()
+            self.buffer = np.zeros(self.buffer_days, dtype=dtype)
+
+    def record(self, sim_engine, day):
+        smart_contract = sim_engine.smart_contract
+        population = sim_engine.customers
+        counters = smart_contract.get_counters()
+
+        row = self.buffer[self.size]
+        row['day'] = day
+        for name in FLOWS:
+            row[name] = counters[name] - self.previous[name]
+        self.previous = counters
+        shop_addresses = [shop.get_shop_address() for shop in sim_engine.shops]
+        row['blacklisted_shops'] = len(smart_contract.black_listed_shops)
+        row['shop_reputation'] = smart_contract.calculate_shop_reputations(shop_addresses).sum()
+        row['wallet_coins'] = population.coins.sum()
+        reputation = smart_contract.calculate_customer_reputations(population.addresses)
+        for t, indices in zip(self.letters, self.type_indices):
+            if len(indices) == 0:
+                continue
+            values = reputation[indices]
+            row['reputation_mean_' + t] = values.mean()
+            for q, value in zip(QUANTILES, np.percentile(values, QUANTILES)):
+                row['reputation_p{}_{}'.format(q, t)] = value
+
+        self.size += 1
+        if self.size == len(self.buffer):
+            self.flush()
+
+    def flush(self):
+        if self.buffer is None or self.size == 0:
+            return
+        chunk = self.buffer[:self.size].copy()
+        for sink in self.sinks:
+            sink.write(chunk)
+        self.buffer[:] = 0
+        self.size = 0
+
+    def close(self):
+        self.flush()
+        for sink in self.sinks:
+            sink.close()
+
+
+class MetricsSink(object):
+
+    def write(self, chunk):
+        pass
+
+    def close(self):
+        pass
+
+
+class MemorySink(MetricsSink):
+    """keeps all chunks, rows() yields them one day at a time"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, chunk):
+        self.chunks.append(chunk)
+
+    def table(self):
+        return np.concatenate(self.chunks) if self.chunks else np.zeros(0, dtype=row_dtype(()))
+
+    def rows(self):
+        for chunk in self.chunks:
+            for row in chunk:
+                yield dict(zip(chunk.dtype.names, row.tolist()))
+
+
+class CsvSink(MetricsSink):
+    """the header is written with the first chunk, whose columns depend on the customer types"""
+
+    def __init__(self, path):
+        self.file = open(path, 'w', newline='')
+        self.writer = csv.writer(self.file)
+        self.header_written = False
+
+    def write(self, chunk):
+        if not self.header_written:
+            self.writer.writerow(chunk.dtype.names)
+            self.header_written = True
+        self.writer.writerows(chunk.tolist())
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class ChunkSink(MetricsSink):
+    """columnar chunks, one prefix.<n>.npz file with an array per column for every flushed buffer"""
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.num_chunks = 0
+
+    def write(self, chunk):
+        np.savez('{}.{:06d}.npz'.format(self.prefix, self.num_chunks),
+                 **dict((name, chunk[name]) for name in chunk.dtype.names))
+        self.num_chunks += 1
+
+
+def read_chunks(prefix):
+    columns = {}
+    for path in sorted(glob.glob(glob.escape(prefix) + '.*.npz')):
+        with np.load(path) as chunk:
+            for name in chunk.files:
+                columns.setdefault(name, []).append(chunk[name])
+    return dict((name, np.concatenate(values)) for name, values in columns.items())
+
+
+class MemmapSink(MetricsSink):
+    """an .npy file sized for max_days rows and created with the first chunk, filled in place; rows_written tells
+    how many are valid"""
+
+    def __init__(self, path, max_days):
+        self.path = path
+        self.max_days = max_days
+        self.table = None
+        self.rows_written = 0
+
+    def write(self, chunk):
+        if self.table is None:
+            self.table = np.lib.format.open_memmap(self.path, mode='w+', dtype=chunk.dtype, shape=(self.max_days,))
+        self.table[self.rows_written:self.rows_written + len(chunk)] = chunk
+        self.rows_written += len(chunk)
+
+    def close(self):
+        if self.table is not None:
+            self.table.flush()
+
+
+def make_recorder(metrics):
+    # a recorder, a sink, a list of sinks, or a path: .csv gets a CsvSink, anything else columnar chunks
+    if metrics is None or isinstance(metrics, MetricsRecorder):
+        return metrics
+    if isinstance(metrics, MetricsSink):
+        return MetricsRecorder([metrics])
+    if isinstance(metrics, str):
+        return MetricsRecorder([CsvSink(metrics) if metrics.endswith('.csv') else ChunkSink(metrics)])
+    return MetricsRecorder(metrics)
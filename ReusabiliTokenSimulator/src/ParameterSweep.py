@@ -0,0 +1,147 @@
+"""@package ParameterSweep
+Implementation of a parameter sweep runner
+
+Every configuration of a sweep is an independent SimulationEngine run with its own seed, so the runs are spread
+over a process pool and the sweep scales with the number of cores. Each run contributes one row (its parameters
+and SimulationEngine.summary()) to the result table.
+"""
+import argparse
+import contextlib
+import csv
+import io
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+DEFAULT_PARAMETERS = {'num_customers': 100,
+                      'num_shops': 5,
+                      'sim_iters': 100,
+                      'coin_limit': 200000,
+                      'rep_limit': 20000,
+                      'coin_rep_factor': 0.50,
+                      'payment_due': 30,
+                      'customer_distribution': (0.2, 0.2, 0.6)}
+
+
+def grid_spec(**axes):
+    # every combination of the given parameter values
+    names = sorted(axes)
+    return [dict(zip(names, values)) for values in itertools.product(*[axes[name] for name in names])]
+
+
+def random_spec(num_samples, seed=0, **ranges):
+    # (low, high) tuples are sampled uniformly (integers if both ends are ints), lists are sampled from
+    rng = np.random.default_rng(seed)
+    configs = [{} for _ in range(num_samples)]
+    for name in sorted(ranges):
+        spec = ranges[name]
+        if isinstance(spec, tuple):
+            low, high = spec
+            if isinstance(low, int) and isinstance(high, int):
+                values = rng.integers(low, high + 1, num_samples).tolist()
+            else:
+                values = rng.uniform(low, high, num_samples).tolist()
+        else:
+            values = [spec[i] for i in rng.integers(0, len(spec), num_samples)]
+        for config, value in zip(configs, values):
+            config[name] = value
+    return configs
+
+
+def run_config(config, seed, batched=True):
+    # runs in a worker process, so the global id counters are reset for every run
+    from Customer import Customer
+    from Shop import Shop
+    from SimulationEngine import SimulationEngine
+    Customer.CUSTOMER_ID = 0
+    Shop.SHOP_ID = 0
+    parameters = dict(DEFAULT_PARAMETERS)
+    parameters.update(config)
+    with contextlib.redirect_stdout(io.StringIO()):
+        sim_engine = SimulationEngine(batched=batched, render='headless', seed=seed, **parameters)
+        sim_engine.run()
+    row = dict(config)
+    row['seed'] = seed
+    row.update(sim_engine.summary())
+    return row
+
+
+def _run_config_args(args):
+    return run_config(*args)
+
+
+def run_sweep(configs, num_workers=None, seed=0, batched=True, output_path=None):
+    seeds = [int(s.generate_state(1)[0]) for s in np.random.SeedSequence(seed).spawn(len(configs))]
+    args = [(config, run_seed, batched) for config, run_seed in zip(configs, seeds)]
+    if num_workers == 1:
+        rows = [_run_config_args(a) for a in args]
+    else:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            rows = list(executor.map(_run_config_args, args, chunksize=max(1, len(args) // (8*(num_workers or 8)))))
+    if output_path is not None:
+        write_table(rows, output_path)
+    return rows
+
+
+def write_table(rows, output_path):
+    columns = []
+    for row in rows:
+        columns += [name for name in row if name not in columns]
+    with open(output_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+
+
+def _parse_value(text):
+    if '/' in text:
+        return tuple(float(v) for v in text.split('/'))
+    for cast in (int, float):
+        try:
+            return cast(text)
+        except ValueError:
+            pass
+    return text
+
+
+def _parse_assignments(assignments):
+    parsed = {}
+    for assignment in assignments or []:
+        name, values = assignment.split('=', 1)
+        parsed[name] = values
+    return parsed
+
+
+def main():
+    parser = argparse.ArgumentParser('ReusabiliToken parameter sweep')
+    parser.add_argument('--grid', nargs='*', help='name=v1,v2,... (customer_distribution as g/b/n)')
+    parser.add_argument('--random', nargs='*', help='name=low:high or name=v1,v2,...')
+    parser.add_argument('--samples', type=int, default=10, help='Number of random samples')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for sampling and for the per-run seeds')
+    parser.add_argument('--workers', type=int, default=None, help='Number of worker processes')
+    parser.add_argument('--scalar', action='store_true', help='Use the scalar instead of the batched engine')
+    parser.add_argument('--output', type=str, default='sweep.csv', help='CSV file for the result table')
+    args = parser.parse_args()
+
+    configs = [{}]
+    if args.grid:
+        grid = _parse_assignments(args.grid)
+        configs = grid_spec(**{name: [_parse_value(v) for v in values.split(',')] for name, values in grid.items()})
+    if args.random:
+        ranges = {}
+        for name, values in _parse_assignments(args.random).items():
+            if ':' in values:
+                ranges[name] = tuple(_parse_value(v) for v in values.split(':'))
+            else:
+                ranges[name] = [_parse_value(v) for v in values.split(',')]
+        samples = random_spec(args.samples, args.seed, **ranges)
+        configs = [dict(config, **sample) for config in configs for sample in samples]
+
+    rows = run_sweep(configs, num_workers=args.workers, seed=args.seed, batched=not args.scalar,
+                     output_path=args.output)
+    print('{} runs written to {}'.format(len(rows), args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,261 @@
+"""@package Population
+Implementation of a compact customer population
+
+All customers of a market are stored as typed arrays instead of one Customer object each. The behaviour of a
+customer type (see CustomerBehaviour) is evaluated for all customers of the type at once. Code that wants per
+customer access iterates the population and gets CustomerView objects, which offer the Customer interface on
+top of the arrays and run the same kernels on a single customer, so a scalar loop over views behaves like the
+batched day.
+"""
+import numpy as np
+from Customer import Customer
+from CustomerBehaviour import make_behaviours
+from Ledger import SparseMatrix
+
+# customers whose types are drawn at once, bounds the temporary (customers, types) array
+_TYPE_BLOCK = 1 << 20
+# numbers of the choice stream a day takes at once, bounds the draws of the first day of large markets
+_DRAW_BLOCK = 1 << 22
+
+
+class Population(object):
+
+    def __init__(self, num_customers, customer_distribution, random_streams, customer_types=None, owned=None):
+        # with a slice of owned customers only their rows are kept, the draws of the other customers of the
+        # market are skipped so the streams end up where they would for the whole population
+        self.random_streams = random_streams
+        self.choice_random = random_streams.buffer('choice')
+        self.recycle_random = random_streams.buffer('recycle')
+        self.behaviours = make_behaviours(customer_types)
+        if len(customer_distribution) != len(self.behaviours):
+            raise ValueError('customer_distribution has {} shares for {} customer types'.format(
+                len(customer_distribution), len(self.behaviours)))
+        self.letters = np.array([behaviour.letter for behaviour in self.behaviours])
+        owned = slice(0, num_customers) if owned is None else owned
+        # customer addresses are handed out from the same counter as for Customer objects
+        self.first_address = Customer.CUSTOMER_ID + owned.start
+        Customer.CUSTOMER_ID += num_customers
+        self.addresses = np.arange(self.first_address, self.first_address + owned.stop - owned.start, dtype=np.int64)
+        self._draw_types(random_streams.generator('population'), customer_distribution, num_customers, owned)
+        self.coins = np.zeros(len(self.types))
+        self.preferred_shops = np.full(len(self.types), -1, dtype=np.int32)
+        self.preferred_sets = None
+        self.has_preferences = np.zeros(len(self.types), dtype=bool)
+        self._index_types()
+        self.reputation = SparseMatrix(np.float64)
+
+    def _draw_types(self, generator, customer_distribution, num_customers, owned):
+        # the types of the owned customers and how many customers of each type come before and after them,
+        # drawn in blocks that give the same types as a single draw for the whole market
+        types = []
+        self.others_before = np.zeros(len(self.behaviours), dtype=np.int64)
+        self.others_after = np.zeros(len(self.behaviours), dtype=np.int64)
+        for start in range(0, num_customers, _TYPE_BLOCK):
+            stop = min(start + _TYPE_BLOCK, num_customers)
+            block = np.argmax(generator.multinomial(1, customer_distribution, stop - start), axis=1).astype(np.int8)
+            types.append(block[max(owned.start, start) - start:max(min(owned.stop, stop) - start, 0)])
+            self.others_before += np.bincount(block[:max(min(owned.start, stop) - start, 0)],
+                                              minlength=len(self.behaviours))
+            self.others_after += np.bincount(block[max(owned.stop, start) - start:], minlength=len(self.behaviours))
+        self.types = np.concatenate(types) if types else np.zeros(0, dtype=np.int8)
+        # the other customers choose for the first time on the first day of the market
+        self.others_chose = False
+
+    def _index_types(self):
+        # per customer parameters of its type, the rows of every type, and the rows of preferred_sets that
+        # belong to customers whose kernel keeps a preference set, in customer order
+        self.recycle_probs = np.array([b.recycle_prob for b in self.behaviours])[self.types]
+        self.coin_thresholds = np.array([b.coin_threshold for b in self.behaviours])[self.types]
+        self.coin_spends = np.array([b.coin_spend for b in self.behaviours])[self.types]
+        self.type_rows = [np.flatnonzero(self.types == t) for t in range(len(self.behaviours))]
+        keeps_sets = np.array([b.kernel.preferred_sets for b in self.behaviours])[self.types]
+        self.preferred_rows = np.full(len(self.types), -1, dtype=np.int64)
+        self.preferred_rows[keeps_sets] = np.arange(np.count_nonzero(keeps_sets))
+
+    def __len__(self):
+        return len(self.types)
+
+    def __getitem__(self, index):
+        return CustomerView(self, index)
+
+    def __iter__(self):
+        for index in range(len(self.types)):
+            yield CustomerView(self, index)
+
+    def type_counts(self):
+        return np.bincount(self.types, minlength=len(self.behaviours))
+
+    def type_letters(self):
+        return self.letters[self.types]
+
+    def get_config(self):
+        return [behaviour.get_config() for behaviour in self.behaviours]
+
+    def set_preferred_sets(self, indices, preferred_sets):
+        # sets of different types can differ in size, shorter ones are padded with -1
+        width = preferred_sets.shape[1]
+        if self.preferred_sets is None:
+            num_rows = np.count_nonzero(self.preferred_rows >= 0)
+            self.preferred_sets = np.full((num_rows, width), -1, dtype=np.int32)
+        elif self.preferred_sets.shape[1] < width:
+            padding = np.full((len(self.preferred_sets), width - self.preferred_sets.shape[1]), -1, dtype=np.int32)
+            self.preferred_sets = np.hstack([self.preferred_sets, padding])
+        rows = self.preferred_rows[indices]
+        self.preferred_sets[rows, :width] = preferred_sets
+        self.preferred_sets[rows, width:] = -1
+
+    def draw_shop_choices(self, num_shops):
+        # consumes the choice stream in customer order, exactly like the choose_shop calls of the scalar loop; the
+        # customers are taken in runs whose numbers fit in one block of the stream
+        first = ~self.has_preferences
+        counts = np.zeros(len(self.types), dtype=np.int64)
+        for rows, behaviour in zip(self.type_rows, self.behaviours):
+            counts[rows] = behaviour.kernel.num_draws(first[rows], num_shops, behaviour)
+        ends = np.cumsum(counts)
+        self.choice_random.skip(self._draws_of_others(self.others_before, num_shops))
+
+        chosen_shops = np.full(len(self.types), -1, dtype=np.int64)
+        start = 0
+        while start < len(self.types):
+            base = ends[start] - counts[start]
+            stop = max(start + 1, int(np.searchsorted(ends, base + _DRAW_BLOCK, side='right')))
+            draws = self.choice_random.take(int(ends[stop - 1] - base))
+            for rows, behaviour in zip(self.type_rows, self.behaviours):
+                rows = rows[np.searchsorted(rows, start):np.searchsorted(rows, stop)]
+                if len(rows) > 0:
+                    chosen_shops[rows] = behaviour.kernel.choose(self, rows, first[rows], draws,
+                                                                 ends[rows] - counts[rows] - base, num_shops, behaviour)
+            start = stop
+        self.choice_random.skip(self._draws_of_others(self.others_after, num_shops))
+        self.has_preferences[:] = True
+        self.others_chose = True
+        return chosen_shops
+
+    def _draws_of_others(self, type_counts, num_shops):
+        # a kernel draws the same amount for every customer of its type that is choosing for the first time or not
+        first = np.array([not self.others_chose])
+        return sum(int(count)*int(behaviour.kernel.num_draws(first, num_shops, behaviour)[0])
+                   for count, behaviour in zip(type_counts.tolist(), self.behaviours) if count > 0)
+
+    def draw_recycling(self):
+        # the customers that recycle today, one number of the recycle stream each
+        self.recycle_random.skip(int(self.others_before.sum()))
+        recycling = np.flatnonzero(self.recycle_random.take(len(self.types)) < self.recycle_probs)
+        self.recycle_random.skip(int(self.others_after.sum()))
+        return recycling
+
+    def get_state(self):
+        return {'first_address': self.first_address,
+                'types': self.types,
+                'coins': self.coins,
+                'preferred_shops': self.preferred_shops,
+                'has_preferences': self.has_preferences,
+                'preferred_sets': self.preferred_sets if self.preferred_sets is not None else np.zeros((0, 0), np.int32),
+                'reputation': self.reputation.get_state()}
+
+    def set_state(self, state):
+        self.types = np.array(state['types'])
+        num_customers = len(self.types)
+        self.first_address = int(state['first_address'])
+        self.addresses = np.arange(self.first_address, self.first_address + num_customers, dtype=np.int64)
+        self.coins = np.array(state['coins'])
+        self.preferred_shops = np.array(state['preferred_shops'])
+        self.has_preferences = np.array(state['has_preferences'])
+        self._index_types()
+        self.preferred_sets = np.array(state['preferred_sets']) if state['preferred_sets'].size > 0 else None
+        self.reputation.set_state(state['reputation'])
+
+    def reputation_of(self, indices, shop_addresses):
+        return self.reputation.get(indices, shop_addresses)
+
+    def transfer_reputation(self, indices, shop_addresses, reputation, reputation_limit):
+        # mirrors the customer side bookkeeping of the scalar loop: capped at the limit, otherwise accumulated
+        current = self.reputation.get(indices, shop_addresses)
+        self.reputation.set(indices, shop_addresses,
+                            np.where(current > reputation_limit, reputation_limit, current + reputation))
+
+
+class CustomerView(object):
+    """one customer of a Population, with the interface of Customer"""
+
+    def __init__(self, population, index):
+        self.population = population
+        self.index = index
+
+    @property
+    def customer_id(self):
+        return int(self.population.addresses[self.index])
+
+    @property
+    def type_(self):
+        return str(self.population.letters[self.population.types[self.index]])
+
+    @property
+    def coins(self):
+        return self.population.coins[self.index]
+
+    @property
+    def recycle_prob(self):
+        return self.population.recycle_probs[self.index]
+
+    @property
+    def preferred_shop(self):
+        return int(self.population.preferred_shops[self.index])
+
+    @property
+    def preferred_shops(self):
+        row = self.population.preferred_rows[self.index]
+        if row < 0 or not self.population.has_preferences[self.index]:
+            return []
+        return [shop for shop in self.population.preferred_sets[row].tolist() if shop >= 0]
+
+    def transfer_coin(self, coin_count):
+        self.population.coins[self.index] += coin_count
+
+    def set_coin(self, coins):
+        self.population.coins[self.index] = coins
+
+    def transfer_reputation(self, reputation, shop_address):
+        self.set_reputation(shop_address, self.get_reputation(shop_address) + reputation)
+
+    def set_reputation(self, shop_address, reputation):
+        self.population.reputation.set(self.index, shop_address, reputation)
+
+    def get_address(self):
+        return self.customer_id
+
+    def choose_to_recycle(self):
+        if self.population.recycle_random.random() < self.recycle_prob:
+            return True
+        else:
+            return False
+
+    def choose_to_pay_by_coin(self):
+        if self.coins > self.population.coin_thresholds[self.index]:
+            return True
+        else:
+            return False
+
+    def get_coin_spend(self):
+        return self.population.coin_spends[self.index]
+
+    def get_coin(self):
+        return self.coins
+
+    def get_reputation(self, shop_address):
+        return self.population.reputation.get(self.index, shop_address)
+
+    def get_type(self):
+        return self.type_
+
+    def choose_shop(self, num_shops):
+        # the kernel of the customer type on a single row, drawing its numbers from the choice stream
+        population = self.population
+        behaviour = population.behaviours[population.types[self.index]]
+        rows = np.array([self.index])
+        first = ~population.has_preferences[rows]
+        draws = population.choice_random.take(int(behaviour.kernel.num_draws(first, num_shops, behaviour)[0]))
+        chosen_shop = behaviour.kernel.choose(population, rows, first, draws, np.zeros(1, dtype=np.int64), num_shops,
+                                              behaviour)
+        population.has_preferences[self.index] = True
+        return int(chosen_shop[0])
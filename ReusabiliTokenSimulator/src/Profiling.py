@@ -0,0 +1,123 @@
+"""@package Profiling
+Implementation of per phase timing for the simulation loop
+
+The engine wraps every phase of a simulated day in profiler.phase(name). With profiling on, a PhaseTimer adds
+the wall time of each phase and counts how often it ran; a phase that is entered again while it is open is timed
+once, from its outermost entry. With profiling off the engine holds a NullTimer, whose phase() hands back one
+shared context manager that does nothing. Call counts of contract methods are taken by wrapping the methods of
+one instance, so classes and unprofiled instances are left untouched.
+"""
+import functools
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+class _NullPhase(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_PHASE = _NullPhase()
+
+
+class NullTimer(object):
+    enabled = False
+
+    def phase(self, name):
+        return _NULL_PHASE
+
+    def count_calls(self, obj, method_names):
+        pass
+
+    def report(self):
+        pass
+
+
+class _Phase(object):
+    """one per phase name and timer; entering a phase that is already open only counts the outermost entry"""
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+        self.start = 0.0
+        self.depth = 0
+
+    def __enter__(self):
+        if self.depth == 0:
+            self.start = time.perf_counter()
+        self.depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.depth -= 1
+        if self.depth == 0:
+            self.timer.add(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class PhaseTimer(object):
+    enabled = True
+
+    def __init__(self):
+        self.times = {}
+        self.counts = {}
+        self.phases = {}
+
+    def phase(self, name):
+        if name not in self.phases:
+            self.phases[name] = _Phase(self, name)
+        return self.phases[name]
+
+    def add(self, name, seconds):
+        self.times[name] = self.times.get(name, 0.0) + seconds
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+    def count_calls(self, obj, method_names):
+        # replaces the methods on the instance by wrappers that are timed as phases named Class.method
+        for method_name in method_names:
+            method = getattr(obj, method_name)
+            setattr(obj, method_name, self._timed(method, '{}.{}'.format(type(obj).__name__, method_name)))
+
+    def _timed(self, method, name):
+        @functools.wraps(method)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.add(name, time.perf_counter() - start)
+        return timed
+
+    def summary(self):
+        return {'times': dict(self.times), 'counts': dict(self.counts), 'peak_memory_mb': peak_memory_mb()}
+
+    def report(self):
+        total = sum(seconds for name, seconds in self.times.items() if '.' not in name)
+        print('{:<40}{:>12}{:>10}{:>8}'.format('phase', 'seconds', 'calls', '%'))
+        for name in sorted(self.times, key=self.times.get, reverse=True):
+            print('{:<40}{:>12.4f}{:>10}{:>8.1f}'.format(name, self.times[name], self.counts[name],
+                                                       100.0*self.times[name]/total if total > 0 else 0.0))
+        peak = peak_memory_mb()
+        if peak is not None:
+            print('peak memory: {:.1f} MB'.format(peak))
+
+
+def peak_memory_mb():
+    # peak resident set size of this process, ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1 << 20) if sys.platform == 'darwin' else peak / (1 << 10)
+
+
+def make_profiler(profile):
+    return PhaseTimer() if profile else NullTimer()
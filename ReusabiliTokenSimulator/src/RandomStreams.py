@@ -0,0 +1,115 @@
+"""@package RandomStreams
+Implementation of seedable random number streams for the simulation
+
+Every subsystem draws from its own np.random.Generator, derived from one seed with SeedSequence spawn keys, so
+a run is reproducible from its seed and runs with different seeds can be executed in parallel. Scalar
+consumers read uniform numbers from a RandomBuffer, which draws them from the generator in blocks, and skip the
+numbers of other consumers by advancing the generator.
+"""
+import numpy as np
+
+# the position of a name is its spawn key, new subsystems have to be appended
+SUBSYSTEMS = ('population', 'address', 'choice', 'recycle', 'claims', 'fast_forward')
+
+
+class RandomBuffer(object):
+
+    def __init__(self, generator, block_size=4096):
+        self.generator = generator
+        self.block_size = block_size
+        self.block = np.zeros(0)
+        self.position = 0
+
+    def _refill(self):
+        self.block = self.generator.random(self.block_size)
+        self.position = 0
+
+    def random(self):
+        if self.position == len(self.block):
+            self._refill()
+        value = self.block[self.position]
+        self.position += 1
+        return value
+
+    def randint(self, high):
+        # an integer in [0, high)
+        return min(int(self.random()*high), high - 1)
+
+    def take(self, n):
+        # the next n numbers of the stream, in the same order single reads would return them
+        values = np.empty(n)
+        filled = 0
+        while filled < n:
+            if self.position == len(self.block):
+                if n - filled >= self.block_size:
+                    values[filled:] = self.generator.random(n - filled)
+                    break
+                self._refill()
+            count = min(n - filled, len(self.block) - self.position)
+            values[filled:filled + count] = self.block[self.position:self.position + count]
+            self.position += count
+            filled += count
+        return values
+
+    def skip(self, n):
+        # moves past the next n numbers without drawing them, a double takes one step of the bit generator
+        if n <= len(self.block) - self.position:
+            self.position += n
+            return
+        self.generator.bit_generator.advance(n - (len(self.block) - self.position))
+        self.block = np.zeros(0)
+        self.position = 0
+
+    def integers(self, high, n):
+        return np.minimum((self.take(n)*high).astype(np.int64), high - 1)
+
+
+class RandomStreams(object):
+
+    def __init__(self, seed=None, block_size=4096):
+        self.seed_sequence = np.random.SeedSequence(seed)
+        self.block_size = block_size
+        self.generators = {}
+        self.buffers = {}
+
+    def child_sequence(self, *spawn_key):
+        return np.random.SeedSequence(self.seed_sequence.entropy,
+                                      spawn_key=self.seed_sequence.spawn_key + tuple(spawn_key))
+
+    def generator(self, name):
+        if name not in self.generators:
+            self.generators[name] = np.random.Generator(np.random.PCG64(self.child_sequence(SUBSYSTEMS.index(name))))
+        return self.generators[name]
+
+    def buffer(self, name):
+        if name not in self.buffers:
+            self.buffers[name] = RandomBuffer(self.generator(name), self.block_size)
+        return self.buffers[name]
+
+    def get_state(self):
+        # the entropy recreates the streams of an unseeded run, the generator and buffer states continue them
+        return {'entropy': self.seed_sequence.entropy,
+                'generators': dict((name, generator.bit_generator.state)
+                                   for name, generator in self.generators.items()),
+                'buffers': dict((name, {'block': buffer.block, 'position': buffer.position})
+                                for name, buffer in self.buffers.items())}
+
+    def set_state(self, state):
+        self.seed_sequence = np.random.SeedSequence(state['entropy'])
+        for name, generator_state in state['generators'].items():
+            self.generator(name).bit_generator.state = generator_state
+        for name, buffer_state in state['buffers'].items():
+            buffer = self.buffer(name)
+            buffer.block = np.array(buffer_state['block'])
+            buffer.position = int(buffer_state['position'])
+
+
+_default_streams = None
+
+
+def default_streams():
+    # unseeded streams for objects that are created outside of a SimulationEngine
+    global _default_streams
+    if _default_streams is None:
+        _default_streams = RandomStreams()
+    return _default_streams
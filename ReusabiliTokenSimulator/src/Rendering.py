@@ -0,0 +1,185 @@
+"""@package Rendering
+Implementation of render policies for the simulation loop
+
+The simulation hands a renderer plain numpy snapshots of the market at day boundaries. Only the renderers that
+actually draw import matplotlib (through Visualization), and only once they draw their first frame, so a
+headless run never loads it.
+"""
+import queue
+import time
+import numpy as np
+
+
+def take_snapshot(smart_contract, customer_addresses, customer_types, shop_addresses, shop_coins, day):
+    return {'day': day,
+            'customer_types': customer_types,
+            'customer_reputation': smart_contract.calculate_customer_reputations(customer_addresses),
+            'shop_reputation': smart_contract.calculate_shop_reputations(shop_addresses),
+            'coin_purchases': smart_contract.get_coin_purchases(customer_addresses),
+            'shop_coins': np.asarray(shop_coins, dtype=float),
+            'reputation_limit': smart_contract.reputation_limit}
+
+
+class Renderer(object):
+    wants_final_frame = False
+
+    def start(self):
+        pass
+
+    def wants_frame(self, day):
+        return False
+
+    def submit(self, snapshot):
+        pass
+
+    def finish(self, snapshot):
+        pass
+
+
+class HeadlessRenderer(Renderer):
+    pass
+
+
+class _Drawer(object):
+
+    def __init__(self, pause=0.05, output_path=None):
+        self.pause = pause
+        self.output_path = output_path
+        self.market_figure = None
+
+    def draw(self, snapshot):
+        from Visualization import MarketFigure
+        import matplotlib.pyplot as plt
+        if self.market_figure is None:
+            # blitting only pays off on screen, saved frames are drawn in full anyway
+            self.market_figure = MarketFigure(snapshot, blit=self.output_path is None)
+            if self.output_path is None:
+                plt.show(block=False)
+        self.market_figure.update(snapshot)
+        if self.output_path is not None:
+            self.market_figure.figure.savefig(self.output_path.format(day=snapshot['day']))
+        else:
+            self.market_figure.figure.canvas.start_event_loop(self.pause)
+
+    def show(self):
+        import matplotlib.pyplot as plt
+        if self.output_path is None:
+            plt.ioff()
+            plt.show()
+
+
+class IntervalRenderer(Renderer):
+    """draws every n-th day in the simulation process"""
+
+    def __init__(self, every=1, pause=0.05, output_path=None):
+        self.every = every
+        self.drawer = _Drawer(pause, output_path)
+
+    def start(self):
+        if self.drawer.output_path is None:
+            import matplotlib.pyplot as plt
+            plt.ion()
+
+    def wants_frame(self, day):
+        return day % self.every == 0
+
+    def submit(self, snapshot):
+        self.drawer.draw(snapshot)
+
+
+class FinalRenderer(Renderer):
+    """draws the market once, after the last simulated day"""
+    wants_final_frame = True
+
+    def __init__(self, output_path=None):
+        self.drawer = _Drawer(output_path=output_path)
+
+    def finish(self, snapshot):
+        self.drawer.draw(snapshot)
+        self.drawer.show()
+
+
+def _render_snapshots(snapshots, pause, output_path):
+    drawer = _Drawer(pause, output_path)
+    if output_path is None:
+        import matplotlib.pyplot as plt
+        plt.ion()
+    while True:
+        snapshot = snapshots.get()
+        if snapshot is None:
+            break
+        drawer.draw(snapshot)
+    drawer.show()
+
+
+class ProcessRenderer(Renderer):
+    """draws in a separate process; frames are dropped instead of stalling the simulation when it falls behind"""
+
+    def __init__(self, every=1, pause=0.05, output_path=None, max_pending=2):
+        self.every = every
+        self.pause = pause
+        self.output_path = output_path
+        import multiprocessing
+        self.snapshots = multiprocessing.Queue(max_pending)
+        self.process = None
+        self.dropped_frames = 0
+
+    def start(self):
+        import multiprocessing
+        self.process = multiprocessing.Process(target=_render_snapshots,
+                                               args=(self.snapshots, self.pause, self.output_path))
+        self.process.daemon = True
+        self.process.start()
+
+    def wants_frame(self, day):
+        return day % self.every == 0
+
+    def submit(self, snapshot):
+        try:
+            self.snapshots.put_nowait(snapshot)
+        except queue.Full:
+            self.dropped_frames += 1
+
+    def finish(self, snapshot):
+        if self.process is not None:
+            self.snapshots.put(None)
+            self.process.join()
+
+
+def watch(source, pause=0.05, output_path=None):
+    # draws the days a SharedMarket.SharedMarketWriter publishes, from another process, until the run finishes;
+    # the simulation never waits for the drawing, days published while a frame is drawn are skipped
+    from SharedMarket import SharedMarketReader
+    reader = SharedMarketReader(source)
+    drawer = _Drawer(pause, output_path)
+    if output_path is None:
+        import matplotlib.pyplot as plt
+        plt.ion()
+    drawn_day = -1
+    while True:
+        finished = reader.finished()
+        if reader.day() > drawn_day:
+            snapshot = reader.snapshot()
+            drawer.draw(snapshot)
+            drawn_day = snapshot['day']
+        elif finished:
+            break
+        else:
+            time.sleep(pause)
+    reader.close()
+    drawer.show()
+
+
+def make_renderer(policy):
+    # 'headless', 'live' (every day), 'end', 'process' or the number of days between frames
+    if policy is None or policy == 'headless':
+        return HeadlessRenderer()
+    if isinstance(policy, Renderer):
+        return policy
+    if policy == 'live':
+        return IntervalRenderer(1)
+    if policy == 'end':
+        return FinalRenderer()
+    if policy == 'process':
+        return ProcessRenderer()
+    return IntervalRenderer(int(policy))
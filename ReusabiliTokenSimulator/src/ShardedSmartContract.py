@@ -0,0 +1,396 @@
+"""@package ShardedSmartContract
+Implementation of a smart contract that can be driven from several threads
+
+Customer state is split over shards by customer address: shard address % num_shards owns the customer and
+stores it at the local address address // num_shards in its own SmartContract, ledger and claim queue. Every
+shard has its own lock, so claims of customers in different shards are processed concurrently. Known and
+blacklisted shops are shared by the shards, which only read them, and are changed under the shop lock. A shard
+notes the first claim at a shop in payment times of its own, which are merged into the payment times of the
+contract under the shop lock. Shop reputation and coin purchases are per shard and merged when they are read.
+A checkpoint holds the state of every shard; fast forwarding is not supported.
+"""
+import threading
+import numpy as np
+from Ledger import DenseLedger
+from SmartContract import SmartContract
+
+
+class ShardedSmartContract(SmartContract):
+
+    def __init__(self, owner_address, num_shards=4, ledger_type=DenseLedger, lazy_decay=False):
+        super(ShardedSmartContract, self).__init__(owner_address)
+        # customer state lives in the shards
+        self.ledger = None
+        self.num_shards = num_shards
+        self.shards = [SmartContract(owner_address, ledger_type(lazy_decay=lazy_decay)) for _ in range(num_shards)]
+        self.locks = [threading.Lock() for _ in range(num_shards)]
+        self.shop_lock = threading.Lock()
+        for shard in self.shards:
+            shard.known_shops = self.known_shops
+            shard.black_listed_shops = self.black_listed_shops
+
+    def _broadcast(self, method, *args):
+        for shard, lock in zip(self.shards, self.locks):
+            with lock:
+                getattr(shard, method)(*args)
+
+    def _split(self, customer_addresses):
+        # yields shard index, positions of its entries and their local customer addresses
+        customer_addresses = np.asarray(customer_addresses, dtype=np.int64)
+        shard_ids = customer_addresses % self.num_shards
+        for shard_id in np.unique(shard_ids):
+            idx = np.flatnonzero(shard_ids == shard_id)
+            yield shard_id, idx, customer_addresses[idx] // self.num_shards
+
+    def set_oracle(self, sender_address, shop_oracle, time_oracle):
+        super(ShardedSmartContract, self).set_oracle(sender_address, shop_oracle, time_oracle)
+        self._broadcast('set_oracle', sender_address, shop_oracle, time_oracle)
+
+    def set_ledger(self, sender_address, ledger):
+        raise NotImplementedError('a sharded contract keeps one ledger per shard')
+
+    def set_transaction_log(self, sender_address, transaction_log):
+        raise NotImplementedError('a sharded contract does not keep a transaction log')
+
+    def set_consistency_checks(self, sender_address, tolerance=1e-6):
+        super(ShardedSmartContract, self).set_consistency_checks(sender_address, tolerance)
+        self._broadcast('set_consistency_checks', sender_address, tolerance)
+
+    def check_reputation_totals(self):
+        errors = []
+        for shard, lock in zip(self.shards, self.locks):
+            with lock:
+                errors.append(shard.check_reputation_totals())
+        return max(errors)
+
+    def set_coin_limit(self, sender_address, coin_limit):
+        super(ShardedSmartContract, self).set_coin_limit(sender_address, coin_limit)
+        self._broadcast('set_coin_limit', sender_address, coin_limit)
+
+    def set_reputation_limit(self, sender_address, reputation_limit):
+        super(ShardedSmartContract, self).set_reputation_limit(sender_address, reputation_limit)
+        self._broadcast('set_reputation_limit', sender_address, reputation_limit)
+
+    def set_reward_curve_coefficient(self, sender_address, coefficient):
+        super(ShardedSmartContract, self).set_reward_curve_coefficient(sender_address, coefficient)
+        self._broadcast('set_reward_curve_coefficient', sender_address, coefficient)
+
+    def set_coins_per_reputation_token(self, sender_address, factor):
+        super(ShardedSmartContract, self).set_coins_per_reputation_token(sender_address, factor)
+        self._broadcast('set_coins_per_reputation_token', sender_address, factor)
+
+    def set_payment_duration(self, sender_address, duration):
+        super(ShardedSmartContract, self).set_payment_duration(sender_address, duration)
+        self._broadcast('set_payment_duration', sender_address, duration)
+
+    def check_payments(self, sender_address, current_time):
+        with self.shop_lock:
+            return super(ShardedSmartContract, self).check_payments(sender_address, current_time)
+
+    def make_payment(self, shop_address, payment):
+        payment_due = self.calculate_shop_reputation(shop_address)
+        with self.shop_lock:
+            if shop_address not in self.known_shops or payment < payment_due:
+                return False
+            if self.time_oracle is not None:
+                self.shop_payment_times[shop_address] = self.time_oracle.get_time()
+                self.counters['payments'] += 1
+
+    def _register_shops(self, shop_addresses):
+        # shops are looked up at the oracle before the shards see them, so the shards only read the shop state
+        shop_addresses = np.unique(np.asarray(shop_addresses, dtype=np.int64))
+        if self.shop_oracle is None or self.known_shops.contains_many(shop_addresses).all():
+            return
+        with self.shop_lock:
+            self._verify_shops_for_claims(shop_addresses)
+
+    def make_claim(self, shop_address, customer_address):
+        self.submit_claims([shop_address], [customer_address])
+        return True
+
+    def submit_claims(self, shop_addresses, customer_addresses):
+        shop_addresses = np.asarray(shop_addresses, dtype=np.int64)
+        for shard_id, idx, local_addresses in self._split(customer_addresses):
+            with self.locks[shard_id]:
+                self.shards[shard_id].submit_claims(shop_addresses[idx], local_addresses)
+
+    def verify_claim(self, shop_address, customer_address):
+        results, coins, reps = self.verify_claims(np.ravel(shop_address)[:1], [customer_address])
+        if results[0]:
+            return True, coins[0], reps[0]
+        return False, -1, -1
+
+    def verify_claims(self, shop_addresses, customer_addresses):
+        return self._per_shard('verify_claims', shop_addresses, customer_addresses)
+
+    def settle_claims(self, shop_addresses, customer_addresses):
+        return self._per_shard('settle_claims', shop_addresses, customer_addresses)
+
+    def _per_shard(self, method, shop_addresses, customer_addresses):
+        shop_addresses = np.asarray(shop_addresses, dtype=np.int64)
+        results = np.zeros(len(shop_addresses), dtype=bool)
+        coins = np.full(len(shop_addresses), -1.0)
+        reps = np.full(len(shop_addresses), -1.0)
+        self._register_shops(shop_addresses)
+        for shard_id, idx, local_addresses in self._split(customer_addresses):
+            shard = self.shards[shard_id]
+            with self.locks[shard_id]:
+                results[idx], coins[idx], reps[idx] = getattr(shard, method)(shop_addresses[idx], local_addresses)
+                payment_times = shard.shop_payment_times
+                shard.shop_payment_times = {}
+            if payment_times:
+                self._merge_payment_times(payment_times)
+        return results, coins, reps
+
+    def _merge_payment_times(self, payment_times):
+        # the first claim at a shop starts its payment period, later times only come from make_payment; called
+        # after the shard lock is released, so the shop lock is never taken inside a shard lock
+        with self.shop_lock:
+            for shop_address, time in payment_times.items():
+                if shop_address not in self.shop_payment_times:
+                    self.shop_payment_times[shop_address] = time
+
+    def customer_buys_with_coin(self, customer_address, shop_address, num_coins):
+        self.customers_buy_with_coin([customer_address], [shop_address], num_coins)
+
+    def customers_buy_with_coin(self, customer_addresses, shop_addresses, num_coins, num_purchases=1):
+        shop_addresses = np.asarray(shop_addresses, dtype=np.int64)
+        num_coins = np.broadcast_to(num_coins, shop_addresses.shape)
+        num_purchases = np.broadcast_to(num_purchases, shop_addresses.shape)
+        for shard_id, idx, local_addresses in self._split(customer_addresses):
+            with self.locks[shard_id]:
+                self.shards[shard_id].customers_buy_with_coin(local_addresses, shop_addresses[idx], num_coins[idx],
+                                                              num_purchases[idx])
+
+    def fast_forward_claims(self, sender_address, shop_addresses, customer_addresses, claim_counts, failed_counts,
+                            days, decay_value, coin_targets=None):
+        raise NotImplementedError('a sharded contract cannot fast forward, run the engine day by day')
+
+    def deteriorate_customer_reputation(self, sender_address, value=0.05):
+        if sender_address != self.owner_address:
+            return False
+        self._broadcast('deteriorate_customer_reputation', sender_address, value)
+
+    def calculate_shop_reputation(self, shop_address):
+        return self.calculate_shop_reputations([shop_address])[0]
+
+    def calculate_customer_reputation(self, customer_address):
+        return self.calculate_customer_reputations([customer_address])[0]
+
+    def calculate_shop_reputations(self, shop_addresses):
+        # merge step: every shard holds the share of the shop reputation earned by its customers
+        totals = np.zeros(len(shop_addresses))
+        for shard, lock in zip(self.shards, self.locks):
+            with lock:
+                totals += shard.calculate_shop_reputations(shop_addresses)
+        return totals
+
+    def calculate_customer_reputations(self, customer_addresses):
+        return self._gather_customers('calculate_customer_reputations', customer_addresses, float)
+
+    def get_coin_purchases(self, customer_addresses):
+        return self._gather_customers('get_coin_purchases', customer_addresses, np.int64)
+
+    def _gather_customers(self, method, customer_addresses, dtype):
+        values = np.zeros(len(customer_addresses), dtype=dtype)
+        for shard_id, idx, local_addresses in self._split(customer_addresses):
+            with self.locks[shard_id]:
+                values[idx] = getattr(self.shards[shard_id], method)(local_addresses)
+        return values
+
+    def _merged_map(self, method):
+        merged = {}
+        for shard_id, (shard, lock) in enumerate(zip(self.shards, self.locks)):
+            with lock:
+                shard_map = getattr(shard, method)()
+            for local_address, value in shard_map.items():
+                merged[local_address*self.num_shards + shard_id] = value
+        return merged
+
+    def get_coin_map(self):
+        return self._merged_map('get_coin_map')
+
+    def get_reputation_map(self):
+        return self._merged_map('get_reputation_map')
+
+    def get_coin_purchase_map(self):
+        return self._merged_map('get_coin_purchase_map')
+
+    def get_counters(self):
+        # blacklisting and payments are counted by this contract, claims and coins by the shards
+        counters = super(ShardedSmartContract, self).get_counters()
+        for shard, lock in zip(self.shards, self.locks):
+            with lock:
+                for name, value in shard.get_counters().items():
+                    counters[name] += value
+        return counters
+
+    def get_state(self):
+        # the shop state of this contract and the customer state of every shard, keyed by the shard index; the
+        # shards share the known and blacklisted shops, which are stored once
+        with self.shop_lock:
+            payment_shops = np.array(list(self.shop_payment_times), dtype=np.int64)
+            state = {'counters': super(ShardedSmartContract, self).get_counters(),
+                     'known_shops': self.known_shops.get_state(),
+                     'black_listed_shops': self.black_listed_shops.get_state(),
+                     'payment_shops': payment_shops,
+                     'payment_times': np.array([self.shop_payment_times[shop] for shop in payment_shops.tolist()],
+                                               dtype=np.int64),
+                     'shards': {}}
+        for shard_id, (shard, lock) in enumerate(zip(self.shards, self.locks)):
+            with lock:
+                shard_state = shard.get_state()
+            del shard_state['known_shops'], shard_state['black_listed_shops']
+            state['shards'][str(shard_id)] = shard_state
+        return state
+
+    def set_state(self, state):
+        if len(state['shards']) != self.num_shards:
+            raise ValueError('the state has {} shards, the contract {}'.format(len(state['shards']), self.num_shards))
+        with self.shop_lock:
+            self.known_shops.set_state(state['known_shops'])
+            self.black_listed_shops.set_state(state['black_listed_shops'])
+            self.shop_payment_times = dict(zip(state['payment_shops'].tolist(), state['payment_times'].tolist()))
+            self.counters.update(state.get('counters', {}))
+        for shard_id, (shard, lock) in enumerate(zip(self.shards, self.locks)):
+            with lock:
+                shard.set_state(dict(state['shards'][str(shard_id)], known_shops=state['known_shops'],
+                                     black_listed_shops=state['black_listed_shops']))
+
+    def pending_claim_count(self):
+        return sum(len(shard.pending_claims) for shard in self.shards)
+
+
+def _stress_test(num_threads=4, num_customers=20000, num_shops=20, num_claims=400000, batch_size=5000, seed=0):
+    # every thread feeds the claims of its own region of customers while one more thread pays dues and checks
+    # payments; the sharded contract has to end up with the same state as a plain contract that processed all
+    # batches one after another, and no thread may fail
+    import time
+    from ShopListOracle import ShopListOracle
+    from SimulationTimeOracle import SimulationTimeOracle
+
+    rng = np.random.default_rng(seed)
+    regions = np.array_split(np.arange(num_customers), num_threads)
+    num_batches = max(1, num_claims // (num_threads*batch_size))
+    batches = [[(rng.integers(0, num_shops, batch_size), rng.choice(region, batch_size))
+                for _ in range(num_batches)] for region in regions]
+
+    def make_contract(contract):
+        oracle = ShopListOracle()
+        oracle.register_shops(np.arange(num_shops))
+        contract.set_oracle(0, oracle, SimulationTimeOracle())
+        contract.set_reputation_limit(0, 20000)
+        return contract
+
+    reference = make_contract(SmartContract(0))
+    issued = 0.0
+    for thread_batches in batches:
+        for shops, customers in thread_batches:
+            reference.submit_claims(shops, customers)
+            issued += reference.verify_claims(shops, customers)[1].clip(0).sum()
+
+    sharded = make_contract(ShardedSmartContract(0, num_shards=num_threads))
+    thread_coins = [0.0]*num_threads
+    errors = []
+    feeding = threading.Event()
+    feeding.set()
+
+    def feed(thread_id):
+        try:
+            for shops, customers in batches[thread_id]:
+                sharded.submit_claims(shops, customers)
+                results, coins, reps = sharded.verify_claims(shops, customers)
+                thread_coins[thread_id] += coins[results].sum()
+        except Exception as error:
+            errors.append(error)
+
+    def pay_dues():
+        # payments at time 0 leave the payment times where the first claims put them
+        try:
+            while feeding.is_set():
+                for shop in range(num_shops):
+                    sharded.make_payment(shop, np.inf)
+                sharded.check_payments(0, 0)
+        except Exception as error:
+            errors.append(error)
+
+    start = time.time()
+    threads = [threading.Thread(target=feed, args=(i,)) for i in range(num_threads)]
+    payer = threading.Thread(target=pay_dues)
+    payer.start()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    feeding.clear()
+    payer.join()
+
+    assert not errors, errors
+    coin_map = sharded.get_coin_map()
+    reference_coins = reference.get_coin_map()
+    shops = np.arange(num_shops)
+    customers = np.arange(num_customers)
+    assert coin_map.keys() == reference_coins.keys()
+    assert np.isclose(sum(coin_map.values()), sum(thread_coins))
+    assert np.isclose(sum(thread_coins), issued)
+    assert np.allclose([coin_map[c] for c in coin_map], [reference_coins[c] for c in coin_map])
+    assert np.allclose(sharded.calculate_shop_reputations(shops), reference.calculate_shop_reputations(shops))
+    assert np.isclose(sharded.calculate_shop_reputations(shops).sum(),
+                      sharded.calculate_customer_reputations(customers).sum())
+    assert sharded.get_reputation_map() == reference.get_reputation_map()
+    assert sharded.check_reputation_totals() < 1e-9
+    assert sharded.pending_claim_count() == 0
+    assert sharded.shop_payment_times == reference.shop_payment_times
+    assert all(len(shard.shop_payment_times) == 0 for shard in sharded.shards)
+    assert len(sharded.black_listed_shops) == 0
+    claims = num_threads*num_batches*batch_size
+    print('{} threads: {} claims in {:.2f}s ({:.0f} claims/s), totals conserved'.format(
+        num_threads, claims, elapsed, claims/elapsed))
+    return claims/elapsed
+
+
+def _checkpoint_test(num_shards=3, num_customers=100, num_shops=5, seed=1):
+    # a sharded contract saved in a checkpoint and loaded into a new one goes on where it left off
+    import os
+    import tempfile
+    from Checkpoint import save_state, load_state
+    from ShopListOracle import ShopListOracle
+    from SimulationTimeOracle import SimulationTimeOracle
+
+    def make_contract():
+        contract = ShardedSmartContract(0, num_shards=num_shards)
+        oracle = ShopListOracle()
+        oracle.register_shops(np.arange(num_shops))
+        contract.set_oracle(0, oracle, SimulationTimeOracle())
+        return contract
+
+    rng = np.random.default_rng(seed)
+    saved = make_contract()
+    for _ in range(5):
+        shops, customers = rng.integers(0, num_shops, 300), rng.integers(0, num_customers, 300)
+        saved.submit_claims(shops, customers)
+        saved.verify_claims(shops, customers)
+    saved.customers_buy_with_coin(np.arange(10), np.zeros(10, dtype=np.int64), 5.0, num_purchases=2)
+    saved.submit_claims([1, 2], [3, 4])
+    path = os.path.join(tempfile.mkdtemp(), 'sharded.npz')
+    save_state(path, saved.get_state())
+    loaded = make_contract()
+    loaded.set_state(load_state(path))
+    os.remove(path)
+    assert loaded.get_coin_map() == saved.get_coin_map()
+    assert loaded.get_reputation_map() == saved.get_reputation_map()
+    assert loaded.get_coin_purchase_map() == saved.get_coin_purchase_map()
+    assert loaded.get_counters() == saved.get_counters()
+    assert loaded.shop_payment_times == saved.shop_payment_times
+    assert (loaded.verify_claims([1, 2], [3, 4])[1] == saved.verify_claims([1, 2], [3, 4])[1]).all()
+    print('{} shards restored from a checkpoint'.format(num_shards))
+
+
+if __name__ == '__main__':
+    _checkpoint_test()
+    # throughput only grows with the threads on as many cores, the checks hold on any number of them
+    import os
+    rates = dict((threads, _stress_test(num_threads=threads)) for threads in (1, 2, 4, 8))
+    print('{} cores, speedup over one thread: {}'.format(os.cpu_count(), ', '.join(
+        '{}: {:.2f}x'.format(threads, rate / rates[1]) for threads, rate in sorted(rates.items()))))
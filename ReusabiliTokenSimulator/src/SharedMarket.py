@@ -0,0 +1,304 @@
+"""@package SharedMarket
+Implementation of a market state that other processes read without copies
+
+At the end of a day the simulation writes the reputation matrix, the coin vectors and the per shop aggregates
+into one of two buffers of a shared block, a multiprocessing.shared_memory segment or an np.memmap file, and
+then makes that buffer the active one. Readers map the same block and work on the active buffer in place.
+
+Each buffer carries a sequence number that is odd while the buffer is written (a seqlock). A reader notes the
+sequence before it reads and checks it afterwards; if the writer came back to the buffer in between, the read is
+repeated. The writer never takes a lock and never waits, the next day always goes to the buffer the readers
+were not sent to.
+
+The reputation matrix is published as the ledger stores it: a day with lazy decay copies the stored values but
+never scales the matrix, they are multiplied with the reputation scale in the meta of the buffer when they are
+read. A SimulationEngine that created its segment closes and unlinks it when the run ends; readers that have it
+mapped keep their view, a memmap file is kept.
+"""
+import os
+import time
+import numpy as np
+
+# header: magic, customers, shops, matrix flag, active buffer, finished flag, one sequence per buffer
+_MAGIC = 0x52544b4d
+_HEADER = 8
+_ACTIVE = 4
+_FINISHED = 5
+_SEQUENCE = 6
+# meta of a buffer: day, reputation limit, reputation scale
+_META = 3
+
+
+def _fields(num_customers, num_shops, matrix):
+    return (('meta', np.float64, (_META,)),
+            ('customer_coins', np.float64, (num_customers,)),
+            ('customer_reputation', np.float64, (num_customers,)),
+            ('coin_purchases', np.int64, (num_customers,)),
+            ('shop_reputation', np.float64, (num_shops,)),
+            ('shop_coins', np.float64, (num_shops,)),
+            ('reputation', np.float64, (num_customers if matrix else 0, num_shops)))
+
+
+def _aligned(size):
+    return (size + 7) // 8 * 8
+
+
+def _block_size(num_customers, num_shops, matrix):
+    size = 8*_HEADER + _aligned(num_customers)
+    for _, dtype, shape in _fields(num_customers, num_shops, matrix):
+        size += 2*_aligned(int(np.prod(shape))*np.dtype(dtype).itemsize)
+    return size
+
+
+def _attach_segment(name):
+    # before Python 3.13 attaching registers the segment with the resource tracker, which unlinks it when the
+    # reader exits; only the writer owns the segment
+    from multiprocessing import shared_memory, resource_tracker
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        register = resource_tracker.register
+        resource_tracker.register = lambda *args: None
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+
+class SharedMarket(object):
+    """the layout of a shared block: header, customer type letters, then two buffers of market arrays"""
+
+    def _map(self, block, num_customers, num_shops, matrix):
+        self.block = block
+        self.header = np.ndarray(_HEADER, dtype=np.int64, buffer=block)
+        offset = 8*_HEADER
+        self.customer_types = np.ndarray(num_customers, dtype=np.int8, buffer=block, offset=offset)
+        offset += _aligned(num_customers)
+        self.buffers = []
+        for _ in range(2):
+            arrays = {}
+            for name, dtype, shape in _fields(num_customers, num_shops, matrix):
+                arrays[name] = np.ndarray(shape, dtype=dtype, buffer=block, offset=offset)
+                offset += _aligned(arrays[name].nbytes)
+            self.buffers.append(arrays)
+        self.num_customers = num_customers
+        self.num_shops = num_shops
+        self.matrix = matrix
+
+    def day(self):
+        # the last published day, -1 before the first
+        active = int(self.header[_ACTIVE])
+        return int(self.buffers[active]['meta'][0]) if self.header[_SEQUENCE + active] > 1 else -1
+
+    def finished(self):
+        return bool(self.header[_FINISHED])
+
+
+class SharedMarketWriter(SharedMarket):
+    """publishes the market of a SimulationEngine, in a shared memory segment or, with a path, a memmap file"""
+
+    def __init__(self, num_customers, num_shops, path=None, name=None, reputation_matrix=True, every=1):
+        size = _block_size(num_customers, num_shops, reputation_matrix)
+        self.path = path
+        self.segment = None
+        if path is not None:
+            block = np.memmap(path, dtype=np.uint8, mode='w+', shape=(size,))
+        else:
+            from multiprocessing import shared_memory
+            self.segment = shared_memory.SharedMemory(name=name, create=True, size=size)
+            block = self.segment.buf
+        self._map(block, num_customers, num_shops, reputation_matrix)
+        self.name = path if path is not None else self.segment.name
+        self.every = every
+        self.header[:] = 0
+        self.header[:4] = (_MAGIC, num_customers, num_shops, int(reputation_matrix))
+        self.types_written = False
+
+    def publish(self, sim_engine, day):
+        if day % self.every != 0:
+            return
+        if not self.types_written:
+            self.customer_types[:] = sim_engine.customers.type_letters().astype('S1').view(np.int8)
+            self.types_written = True
+        smart_contract = sim_engine.smart_contract
+        ledger = smart_contract.ledger
+        customer_addresses = sim_engine.customers.addresses
+        shop_addresses = [shop.get_shop_address() for shop in sim_engine.shops]
+
+        # write the buffer readers are not sent to, odd sequence while it is written
+        target = 1 - int(self.header[_ACTIVE]) if self.header[_SEQUENCE] + self.header[_SEQUENCE + 1] > 0 else 0
+        sequence = _SEQUENCE + target
+        self.header[sequence] += 1
+        arrays = self.buffers[target]
+        arrays['meta'][:2] = (day, smart_contract.reputation_limit)
+        arrays['customer_coins'][:] = ledger.customer_coins(customer_addresses)
+        arrays['customer_reputation'][:] = smart_contract.calculate_customer_reputations(customer_addresses)
+        arrays['coin_purchases'][:] = smart_contract.get_coin_purchases(customer_addresses)
+        arrays['shop_reputation'][:] = smart_contract.calculate_shop_reputations(shop_addresses)
+        arrays['shop_coins'][:] = [shop.get_coin_count() for shop in sim_engine.shops]
+        arrays['meta'][2] = ledger.reputation_scale
+        if self.matrix:
+            _copy_reputation(ledger, int(customer_addresses[0]), int(shop_addresses[0]), arrays['reputation'])
+        self.header[sequence] += 1
+        self.header[_ACTIVE] = target
+
+    def finish(self):
+        self.header[_FINISHED] = 1
+        if self.path is not None:
+            self.block.flush()
+
+    def close(self, unlink=True):
+        # the segment is removed once every process has closed it, a memmap file is kept
+        self.header = self.customer_types = self.buffers = None
+        if self.segment is not None:
+            self.block = None
+            self.segment.close()
+            if unlink:
+                self.segment.unlink()
+            self.segment = None
+
+
+def _copy_reputation(ledger, first_customer, first_shop, target):
+    # customers and shops of an engine hold consecutive addresses, so the market is one block of the ledger; the
+    # stored values are copied, and of a dense matrix only the part of the block the ledger has used so far
+    num_customers, num_shops = target.shape
+    if isinstance(getattr(ledger, 'reputation', None), np.ndarray):
+        rows = max(0, min(num_customers, ledger.num_customers - first_customer))
+        columns = max(0, min(num_shops, ledger.num_shops - first_shop))
+        target[:rows, :columns] = ledger.reputation[first_customer:first_customer + rows,
+                                                    first_shop:first_shop + columns]
+        target[:rows, columns:] = 0
+        target[rows:] = 0
+        return
+    target[...] = 0
+    customers, shops, values = ledger._stored_reputation_entries()
+    customers = customers - first_customer
+    shops = shops - first_shop
+    inside = (customers >= 0) & (customers < num_customers) & (shops >= 0) & (shops < num_shops)
+    target[customers[inside], shops[inside]] = values[inside]
+
+
+class SharedMarketReader(SharedMarket):
+    """maps a block published by a SharedMarketWriter, by segment name or memmap file path"""
+
+    def __init__(self, source):
+        self.segment = None
+        if os.path.exists(source):
+            block = np.memmap(source, dtype=np.uint8, mode='r')
+        else:
+            self.segment = _attach_segment(source)
+            block = self.segment.buf
+        header = np.ndarray(_HEADER, dtype=np.int64, buffer=block)
+        if header[0] != _MAGIC:
+            raise ValueError('{} is not a shared market'.format(source))
+        self._map(block, int(header[1]), int(header[2]), bool(header[3]))
+        for arrays in self.buffers:
+            for array in arrays.values():
+                array.flags.writeable = False
+
+    def read(self, function):
+        # calls function with the arrays of the active buffer, in place; repeated if the writer reused the
+        # buffer meanwhile, so the result always belongs to a single day
+        while True:
+            active = int(self.header[_ACTIVE])
+            sequence = int(self.header[_SEQUENCE + active])
+            if sequence % 2 == 0:
+                result = function(self.buffers[active])
+                if self.header[_SEQUENCE + active] == sequence:
+                    return result
+            time.sleep(0)
+
+    def snapshot(self):
+        # a copy of the active buffer, in the form of Rendering.take_snapshot
+        snapshot = self.read(lambda arrays: dict((name, np.array(array)) for name, array in arrays.items()))
+        meta = snapshot.pop('meta')
+        snapshot['day'] = int(meta[0])
+        snapshot['reputation_limit'] = float(meta[1])
+        snapshot['reputation'] *= meta[2]
+        snapshot['customer_types'] = self.customer_types.view('S1').astype(str)
+        return snapshot
+
+    def close(self):
+        self.header = self.customer_types = self.buffers = None
+        if self.segment is not None:
+            self.block = None
+            self.segment.close()
+            self.segment = None
+
+
+def make_shared_market(shared_state, num_customers, num_shops, reputation_matrix=True):
+    # a writer, True for a new shared memory segment, or the path of a memmap file
+    if shared_state is None or shared_state is False or isinstance(shared_state, SharedMarketWriter):
+        return shared_state or None
+    if shared_state is True:
+        return SharedMarketWriter(num_customers, num_shops, reputation_matrix=reputation_matrix)
+    return SharedMarketWriter(num_customers, num_shops, path=shared_state, reputation_matrix=reputation_matrix)
+
+
+def _check_day(arrays):
+    # reads a day in place; the per customer and per shop totals have to agree with the matrix of the same day
+    reputation = arrays['reputation']
+    scale = arrays['meta'][2]
+    return (int(arrays['meta'][0]),
+            np.allclose(reputation.sum(axis=1)*scale, arrays['customer_reputation'], rtol=1e-6, atol=1e-6),
+            np.allclose(reputation.sum(axis=0)*scale, arrays['shop_reputation'], rtol=1e-6, atol=1e-6))
+
+
+def _follow(source, results):
+    reader = SharedMarketReader(source)
+    days = []
+    consistent = True
+    while True:
+        finished = reader.finished()
+        day, customers_agree, shops_agree = reader.read(_check_day)
+        consistent = consistent and customers_agree and shops_agree
+        new_day = not days or day != days[-1]
+        if new_day:
+            days.append(day)
+        if finished:
+            break
+        if not new_day:
+            time.sleep(0.001)
+    results.put((days, consistent, reader.snapshot()))
+    reader.close()
+
+
+def _stress_test(num_customers=20000, num_shops=20, sim_iters=60, seed=3, lazy_decay=True):
+    # a reader process follows a running simulation; every read it completes has to belong to a single day,
+    # and the last one has to be the market the engine ends with, its matrix scaled like the ledger reads it
+    import multiprocessing
+    from SimulationEngine import SimulationEngine
+
+    parameters = (num_customers, num_shops, sim_iters, 200000, 20000, 0.5, 30)
+    sim_engine = SimulationEngine(*parameters, batched=True, render='headless', seed=seed, shared_state=True,
+                                  lazy_decay=lazy_decay)
+    results = multiprocessing.Queue()
+    reader = multiprocessing.Process(target=_follow, args=(sim_engine.shared_state.name, results))
+    reader.start()
+    # the engine unlinks its segment when the run ends, the reader keeps the mapping it attached to
+    sim_engine.run()
+    days, consistent, snapshot = results.get()
+    reader.join()
+
+    expected = sim_engine._take_snapshot(sim_iters - 1)
+    assert consistent
+    assert days == sorted(days) and days[-1] == sim_iters - 1
+    for name in ('customer_reputation', 'shop_reputation', 'coin_purchases', 'shop_coins'):
+        assert np.allclose(snapshot[name], expected[name]), name
+    assert (snapshot['customer_types'] == expected['customer_types']).all()
+    customer_addresses = sim_engine.customers.addresses
+    shop_addresses = np.array([shop.get_shop_address() for shop in sim_engine.shops])
+    reputation = sim_engine.smart_contract.ledger.reputation_of(np.repeat(customer_addresses, num_shops),
+                                                                np.tile(shop_addresses, num_customers))
+    assert np.allclose(snapshot['reputation'], reputation.reshape(num_customers, num_shops))
+    print('reader saw {} of {} days, every read consistent'.format(len(days), sim_iters))
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) > 1:
+        # python SharedMarket.py <segment name or file> draws a running simulation
+        from Rendering import watch
+        watch(sys.argv[1])
+    else:
+        _stress_test()
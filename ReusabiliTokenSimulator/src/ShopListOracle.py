@@ -1,12 +1,13 @@
 """@package ShopListOracle
 Implementation of a simple shop list oracle
 """
+from AddressSet import AddressSet
 
 
 class ShopListOracle(object):
 
     def __init__(self):
-        self.shop_list = []
+        self.shop_list = AddressSet()
 
     def verify_shop(self, shop_address):
         if shop_address in self.shop_list:
@@ -14,6 +15,11 @@ class ShopListOracle(object):
         else:
             return False
 
+    def verify_shops(self, shop_addresses):
+        return self.shop_list.contains_many(shop_addresses)
+
     def register_new_shop(self, shop_address):
-        if shop_address not in self.shop_list:
-            self.shop_list.append(shop_address)
+        self.shop_list.add(shop_address)
+
+    def register_shops(self, shop_addresses):
+        self.shop_list.add_many(shop_addresses)
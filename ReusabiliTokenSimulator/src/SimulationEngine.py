@@ -1,125 +1,530 @@
 """@package SimulationEngine
 Implementation of a simulation Engine
 """
-from Customer import GoodCustomer, BadCustomer, NeutralCustomer
+from Customer import Customer
+from Population import Population
 from Shop import Shop
+from Ledger import DenseLedger, SparseLedger
 from ShopListOracle import ShopListOracle
 from SmartContract import SmartContract
 from SimulationTimeOracle import SimulationTimeOracle
+from Rendering import make_renderer, take_snapshot
+from RandomStreams import RandomStreams
+from TransactionLog import TransactionLog
+from Checkpoint import save_state, load_state
+from Metrics import make_recorder
+from SharedMarket import make_shared_market
+from Profiling import make_profiler
+from EventScheduler import EventScheduler, DUES, DEADLINE, DECAY
 import numpy as np
-from Visualization import visualize_market
-import matplotlib.pyplot as plt
 
 
 class SimulationEngine(object):
-    def __init__(self, num_customers, num_shops, sim_iters, coin_limit, rep_limit, coin_rep_factor, payment_due):
+    def __init__(self, num_customers, num_shops, sim_iters, coin_limit, rep_limit, coin_rep_factor, payment_due,
+                 batched=False, sparse_ledger=False, lazy_decay=False, render='live',
+                 customer_distribution=(0.2, 0.2, 0.6), seed=None, reward_curve_coefficient=0.0005,
+                 transaction_log=None, snapshot_every=None, checkpoint_every=None, checkpoint_path='checkpoint.npz',
+                 metrics=None, profile=False, event_driven=False, fast_forward=None, shared_state=None,
+                 customer_types=None):
         self.num_customers = num_customers
         self.num_shops = num_shops
         self.sim_iters = sim_iters
-        self.customers = self._create_customers([0.2, 0.2, 0.6])
+        self.batched = batched
+        self.sparse_ledger = sparse_ledger
+        self.lazy_decay = lazy_decay
+        # a resumed run continues at next_day, a checkpoint is saved every checkpoint_every days
+        self.next_day = 0
+        self.checkpoint_every = checkpoint_every
+        self.checkpoint_path = checkpoint_path
+        # every subsystem draws from its own stream derived from the seed
+        self.seed = seed
+        self.random_streams = RandomStreams(seed)
+        # see Rendering.make_renderer, 'headless' never loads matplotlib
+        self.renderer = make_renderer(render)
+        # see Metrics.make_recorder, one row per simulated day
+        self.metrics = make_recorder(metrics)
+        # see SharedMarket.make_shared_market, the market as other processes read it at day boundaries
+        self.shared_state = make_shared_market(shared_state, num_customers, num_shops,
+                                               reputation_matrix=not sparse_ledger)
+        # a writer passed in belongs to the caller, one the engine created is closed at the end of the run
+        self.owns_shared_state = self.shared_state is not shared_state
+        # per phase timing, a no-op unless profile is set
+        self.profiler = make_profiler(profile)
+        self.customer_distribution = list(customer_distribution)
+        # see CustomerBehaviour, the good, bad and neutral customers unless customer_types defines others
+        self.customers = self._create_customers(self.customer_distribution, customer_types)
+        self.days_run = 0
         self.shops = self._create_shops()
         self.time_oracle = SimulationTimeOracle()
         self.shop_list_oracle = ShopListOracle()
-        for shop in self.shops:
-            self.shop_list_oracle.register_new_shop(shop.get_shop_address())
-        self.address = np.random.randint(200000, 3300000, 1)
-        self.smart_contract = SmartContract(self.address[0])
+        self.shop_list_oracle.register_shops([shop.get_shop_address() for shop in self.shops])
+        self.address = self.random_streams.generator('address').integers(200000, 3300000, 1)
+        ledger_type = SparseLedger if sparse_ledger else DenseLedger
+        self.smart_contract = SmartContract(self.address[0], ledger_type(Customer.CUSTOMER_ID, Shop.SHOP_ID,
+                                                                         lazy_decay=lazy_decay))
         self.smart_contract.set_oracle(self.address, self.shop_list_oracle, self.time_oracle)
         self.smart_contract.set_coin_limit(self.address, coin_limit)
         self.coin_limit = coin_limit
         self.smart_contract.set_reputation_limit(self.address, rep_limit)
         self.rep_limit = rep_limit
+        self.smart_contract.set_reward_curve_coefficient(self.address, reward_curve_coefficient)
+        self.reward_curve_coefficient = reward_curve_coefficient
         self.smart_contract.set_payment_duration(self.address, payment_due)
         self.payment_due = payment_due
         self.smart_contract.set_coins_per_reputation_token(self.address, coin_rep_factor)
         self.coin_rep_factor = coin_rep_factor
+        self.transaction_log = None
+        if transaction_log:
+            self._open_transaction_log(transaction_log, snapshot_every)
+        # dues, payment deadlines and decay run as scheduled events instead of being polled every day
+        self.event_driven = event_driven
+        self.scheduler = None
+        if event_driven or fast_forward:
+            self._schedule_events()
+        # steps of up to fast_forward days, see _run_fast_forward
+        self.fast_forward = fast_forward
+        if fast_forward and self.transaction_log is not None:
+            raise ValueError('a fast forward run cannot be recorded in a transaction log')
+        self.profiler.count_calls(self.smart_contract, ('verify_claim', 'verify_claims', 'calculate_shop_reputation',
+                                                        'calculate_shop_reputations'))
 
     def run(self, claim_failure_probability=0.00001):
+        if self.fast_forward:
+            return self._run_fast_forward(claim_failure_probability)
+        if self.batched:
+            return self._run_batched(claim_failure_probability)
+
         shop_addresses = [shop.get_shop_address() for shop in self.shops]
-        ax = [None, None, None, None]
-        plt.ion()
-        for day in range(self.sim_iters):
+        profiler = self.profiler
+        self.renderer.start()
+        if self.metrics is not None:
+            self.metrics.start(self)
+        for day in range(self.next_day, self.sim_iters):
             self.time_oracle.increment_time()
 
             # check if there are any valid shops left in the smart contract
             if self.smart_contract.valid_shops_left(shop_addresses) is False:
-                print('\n' + '*' * 15 + '\n')
-                print('Tough luck. No shop earned enough coin to pay their dues.')
-                print('The experiment ran for {} days.'.format(day))
-                print('\n' + '*' * 15 + '\n')
+                self._stop_early(day)
                 return
 
-            # for every customer, choose a shop
-            for customer in self.customers:
-                chosen_shop = customer.choose_shop(self.num_shops)
-                shop_address = self.shops[chosen_shop].get_shop_address()
-                # choose whether the customer wants to pay by coin
-                buy_with_coins = customer.choose_to_pay_by_coin()
-                if buy_with_coins is True:
-                    # notify the smart contract
-                    self.smart_contract.customer_buys_with_coin(customer.get_address(),
-                                                                shop_address,
-                                                                customer.get_coin_spend())
-                    self.shops[chosen_shop].buy_with_coins(customer.get_coin_spend())
-
-                # for every decision, choose if a recycle happens
-                recyling_decision = customer.choose_to_recycle()
-
-                if recyling_decision is True:
-                    self.smart_contract.make_claim(shop_address, customer.get_address())
-
-                    if self._simulate_claim_failure(prob=claim_failure_probability):
-                        # simulate a failure by verifying with our own address
-                        self.smart_contract.verify_claim(self.address, customer.get_address())
-                        print('claim failed')
-                    else:
-                        res, coins, reps = self.smart_contract.verify_claim(shop_address, customer.get_address())
-                        if res is True:
-                            customer.transfer_coin(coins)
-
-                            if customer.get_reputation(shop_address) > self.smart_contract.reputation_limit:
-                                customer.set_reputation(shop_address, self.smart_contract.reputation_limit)
-                            else:
-                                customer.transfer_reputation(reps, shop_address)
-
-            if day != 0 and np.mod(day, self.payment_due):
-                for shop in self.shops:
-                    shop.pay_dues_to_smart_contract(self.smart_contract)
-
-                self.smart_contract.check_payments(self.address, day)
+            # the customers of the scalar loop are timed as one phase, entering a phase per customer would
+            # cost more than the work it measures
+            with profiler.phase('customer loop'):
+                # for every customer, choose a shop
+                for customer in self.customers:
+                    chosen_shop = customer.choose_shop(self.num_shops)
+                    shop_address = self.shops[chosen_shop].get_shop_address()
+                    # choose whether the customer wants to pay by coin
+                    buy_with_coins = customer.choose_to_pay_by_coin()
+                    if buy_with_coins is True:
+                        # notify the smart contract
+                        self.smart_contract.customer_buys_with_coin(customer.get_address(),
+                                                                    shop_address,
+                                                                    customer.get_coin_spend())
+                        self.shops[chosen_shop].buy_with_coins(customer.get_coin_spend())
 
-            # deteriorate customer reputation at every simulation step
-            self.smart_contract.deteriorate_customer_reputation(self.address, value=0.10)
+                    # for every decision, choose if a recycle happens
+                    recyling_decision = customer.choose_to_recycle()
+
+                    if recyling_decision is True:
+                        self.smart_contract.make_claim(shop_address, customer.get_address())
+
+                        if self._simulate_claim_failure(prob=claim_failure_probability):
+                            # simulate a failure by verifying with our own address
+                            self.smart_contract.verify_claim(self.address, customer.get_address())
+                            print('claim failed')
+                        else:
+                            res, coins, reps = self.smart_contract.verify_claim(shop_address, customer.get_address())
+                            if res is True:
+                                customer.transfer_coin(coins)
+
+                                if customer.get_reputation(shop_address) > self.smart_contract.reputation_limit:
+                                    customer.set_reputation(shop_address, self.smart_contract.reputation_limit)
+                                else:
+                                    customer.transfer_reputation(reps, shop_address)
+
+            self._end_of_day(day)
+
+        self._finish_run()
+
+    def _run_fast_forward(self, claim_failure_probability):
+        # Advances the market in steps of up to fast_forward days. Within a step every customer recycles a
+        # binomial number of times and spreads the visits uniformly over the shops it chooses from, customers with
+        # enough coins at the start of the step buy on every day of it, and each (customer, shop) pair settles its
+        # claims at evenly spaced days with the daily decay applied in closed form in between. Steps end at the
+        # next dues or deadline event, so payments are settled on their own day.
+        #
+        # Compared with stepping day by day the totals agree in expectation but not draw for draw: the days of
+        # the claims within a step are fixed instead of random, so the reputation and coins they earn and the day a
+        # customer crosses the buying threshold are those of evenly spaced visits, and the customer choice stream
+        # is consumed once per step. The error of the first grows with the step length; a step of one day is exact
+        # in distribution except for the claim failures, which never void other pending claims.
+        population = self.customers
+        shop_addresses = np.array([shop.get_shop_address() for shop in self.shops])
+        customer_addresses = population.addresses
+        wallets = population.coins
+        fast_forward_random = self.random_streams.generator('fast_forward')
+        decay_value = 0.10
+
+        profiler = self.profiler
+        self.renderer.start()
+        if self.metrics is not None:
+            self.metrics.start(self)
+        day = self.next_day
+        while day < self.sim_iters:
+            self.time_oracle.increment_time()
+            if self.smart_contract.valid_shops_left(shop_addresses) is False:
+                self._stop_early(day)
+                return
+
+            days = min(self.fast_forward, self.sim_iters - day)
+            next_event = self.scheduler.next_time(ignore=(DECAY,))
+            if next_event is not None:
+                days = max(1, min(days, next_event - day))
+
+            with profiler.phase('customer choice'):
+                # sets up the preferences of customers that have not chosen yet
+                population.draw_shop_choices(self.num_shops)
+                recycles = fast_forward_random.binomial(days, population.recycle_probs)
+                claim_rows, claim_shops, claims = self._spread_visits(
+                    fast_forward_random, population, np.flatnonzero(recycles), recycles[recycles > 0])
+            thresholds = population.coin_thresholds
+            buying = wallets > thresholds
+
+            with profiler.phase('claim verification'):
+                failed = fast_forward_random.binomial(claims, claim_failure_probability)
+                res, coins, reps, target_days = self.smart_contract.fast_forward_claims(
+                    self.address, shop_addresses[claim_shops], customer_addresses[claim_rows], claims - failed, failed,
+                    days, decay_value,
+                    np.where(buying[claim_rows], np.inf, thresholds[claim_rows] - wallets[claim_rows]))
+                wallets += np.bincount(claim_rows[res], weights=coins[res], minlength=self.num_customers)
+                # a customer starts buying the day after its claims took it over the threshold, the pairs of a
+                # customer all carry that day
+                first_buying_day = np.where(buying, 0, days)
+                new_buyers = res & ~buying[claim_rows]
+                first_buying_day[claim_rows[new_buyers]] = target_days[new_buyers] + 1
+                population.transfer_reputation(claim_rows[res], shop_addresses[claim_shops[res]], reps[res],
+                                               self.smart_contract.reputation_limit)
 
-            # visualize the market at every time step
-            ax = visualize_market(self.smart_contract, self.customers, self.shops, ax[0], ax[1], ax[2], ax[3])
-            plt.suptitle('Market after {} days'.format(day))
-            plt.pause(0.05)
-            plt.show()
+            with profiler.phase('customer choice'):
+                buyers = np.flatnonzero(first_buying_day < days)
+                purchase_rows, purchase_shops, purchases = self._spread_visits(
+                    fast_forward_random, population, buyers, days - first_buying_day[buyers])
 
+            with profiler.phase('coin purchases'):
+                bought = purchases > 0
+                if np.any(bought):
+                    purchase_rows, purchase_shops, purchases = \
+                        purchase_rows[bought], purchase_shops[bought], purchases[bought]
+                    spent = population.coin_spends[purchase_rows]*purchases
+                    self.smart_contract.customers_buy_with_coin(customer_addresses[purchase_rows],
+                                                                shop_addresses[purchase_shops],
+                                                                spent, purchases)
+                    shop_coins = np.bincount(purchase_shops, weights=spent, minlength=self.num_shops)
+                    for shop, coins in zip(self.shops, shop_coins.tolist()):
+                        shop.buy_with_coins(coins)
+
+            self.scheduler.advance(self.time_oracle, day + days, self._handle_fast_forward_event)
+            self._record_day(day + days - 1)
+            day += days
+
+        self._finish_run()
+
+    def _spread_visits(self, rng, population, rows, counts):
+        # spreads counts[i] visits of customer rows[i] over the shops it chooses from, returns the distinct
+        # (row, shop, visits) entries; customers with a single shop visit it every time
+        types = population.types[rows]
+        entries = []
+        for customer_type, behaviour in enumerate(population.behaviours):
+            of_type = types == customer_type
+            type_rows = rows[of_type]
+            candidates = behaviour.kernel.candidates(population, type_rows, self.num_shops, behaviour)
+            if candidates is not None and candidates.shape[1] == 1:
+                entries.append((type_rows, candidates[:, 0], counts[of_type]))
+                continue
+            num_choices = self.num_shops if candidates is None else candidates.shape[1]
+            index, choice, visits = _spread_counts(rng, counts[of_type], num_choices)
+            entries.append((type_rows[index], choice if candidates is None else candidates[index, choice], visits))
+        return tuple(np.concatenate([entry[i] for entry in entries]).astype(np.int64) for i in range(3))
+
+    def _handle_fast_forward_event(self, kind, shop_index):
+        # decay of a fast forward step has already been applied in closed form
+        if kind == DECAY:
+            self.scheduler.schedule(self.time_oracle.get_time() + 1, DECAY)
+            return
+        self._handle_event(kind, shop_index)
+
+    def _stop_early(self, day):
+        print('\n' + '*' * 15 + '\n')
+        print('Tough luck. No shop earned enough coin to pay their dues.')
+        print('The experiment ran for {} days.'.format(day))
+        print('\n' + '*' * 15 + '\n')
+        self.days_run = day
+        self._finish_rendering(day)
+        self._close_outputs()
+
+    def _finish_run(self):
+        self._finish_rendering(self.sim_iters - 1)
+        self._close_outputs()
         print('\n' + '*' * 15 + '\n')
         print('Customers recycled their goods and shops paid their dues.')
         print('The experiment ran successfully for {} days.'.format(self.sim_iters))
+        self.days_run = self.sim_iters
         print('\n' + '*' * 15 + '\n')
 
-    def _create_customers(self, customer_distribution):
-        customers = []
-        gc = 0
-        bc = 0
-        nc = 0
-        for i in range(self.num_customers):
-            # choose the type of customer to create
-            customer_type = np.argmax(np.random.multinomial(1, customer_distribution, 1))
-            if customer_type == 0:
-                customers.append(GoodCustomer())
-                gc += 1
-            elif customer_type == 1:
-                customers.append(BadCustomer())
-                bc += 1
-            else:
-                customers.append(NeutralCustomer())
-                nc += 1
-        print('gc: {}\tbc: {}\tnc: {}'.format(gc, bc, nc))
+    def _close_outputs(self):
+        if self.transaction_log is not None:
+            self.transaction_log.flush()
+        if self.metrics is not None:
+            self.metrics.close()
+        if self.shared_state is not None:
+            self.shared_state.finish()
+            if self.owns_shared_state:
+                self.shared_state.close()
+        if self.profiler.enabled:
+            self.profiler.report()
+
+    def _run_batched(self, claim_failure_probability):
+        # same market rules as the scalar loop in run(), but every customer decision of a day is drawn at once
+        population = self.customers
+        shop_addresses = np.array([shop.get_shop_address() for shop in self.shops])
+        customer_addresses = population.addresses
+        wallets = population.coins
+        claim_random = self.random_streams.buffer('claims')
+
+        profiler = self.profiler
+        self.renderer.start()
+        if self.metrics is not None:
+            self.metrics.start(self)
+        for day in range(self.next_day, self.sim_iters):
+            self.time_oracle.increment_time()
+
+            if self.smart_contract.valid_shops_left(shop_addresses) is False:
+                self._stop_early(day)
+                return
+
+            with profiler.phase('customer choice'):
+                chosen_shops = population.draw_shop_choices(self.num_shops)
+                chosen_addresses = shop_addresses[chosen_shops]
+
+            with profiler.phase('coin purchases'):
+                buy_with_coins = wallets > population.coin_thresholds
+                if np.any(buy_with_coins):
+                    spent = population.coin_spends[buy_with_coins]
+                    self.smart_contract.customers_buy_with_coin(customer_addresses[buy_with_coins],
+                                                                chosen_addresses[buy_with_coins], spent)
+                    shop_coins = np.bincount(chosen_shops[buy_with_coins], weights=spent, minlength=self.num_shops)
+                    for shop, coins in zip(self.shops, shop_coins.tolist()):
+                        shop.buy_with_coins(coins)
+
+            with profiler.phase('customer choice'):
+                recycling = population.draw_recycling()
+
+            with profiler.phase('claim verification'):
+                self.smart_contract.submit_claims(chosen_addresses[recycling], customer_addresses[recycling])
+                # simulate failures by verifying with our own address
+                failed = claim_random.take(len(recycling)) < claim_failure_probability
+                if np.any(failed):
+                    print('{} claims failed'.format(np.count_nonzero(failed)))
+                verifying_shops = np.where(failed, self.address[0], chosen_addresses[recycling])
+
+                res, coins, reps = self.smart_contract.verify_claims(verifying_shops, customer_addresses[recycling])
+                verified = recycling[res]
+                wallets[verified] += coins[res]
+                population.transfer_reputation(verified, chosen_addresses[verified], reps[res],
+                                               self.smart_contract.reputation_limit)
+
+            self._end_of_day(day)
+
+        self._finish_run()
+
+    def summary(self):
+        ledger = self.smart_contract.ledger
+        shop_addresses = [shop.get_shop_address() for shop in self.shops]
+        customer_types = self.customers.type_letters()
+        customer_reputation = self.smart_contract.calculate_customer_reputations(self.customers.addresses)
+        summary = {'days_run': self.days_run,
+                   'survived': self.days_run == self.sim_iters,
+                   'blacklisted_shops': len(self.smart_contract.black_listed_shops),
+                   'customer_coins': float(ledger.coins[:ledger.num_customers].sum()),
+                   'coin_purchases': int(ledger.purchases[:ledger.num_customers].sum()),
+                   'shop_coins': float(sum(shop.get_coin_count() for shop in self.shops)),
+                   'shop_reputation': float(self.smart_contract.calculate_shop_reputations(shop_addresses).sum())}
+        for customer_type in self.customers.letters.tolist():
+            is_type = customer_types == customer_type
+            summary['mean_reputation_' + customer_type] = \
+                float(customer_reputation[is_type].mean()) if np.any(is_type) else 0.0
+        return summary
+
+    def get_state(self):
+        parameters = {'num_customers': self.num_customers,
+                      'num_shops': self.num_shops,
+                      'sim_iters': self.sim_iters,
+                      'coin_limit': self.coin_limit,
+                      'rep_limit': self.rep_limit,
+                      'coin_rep_factor': self.coin_rep_factor,
+                      'payment_due': self.payment_due,
+                      'batched': self.batched,
+                      'sparse_ledger': self.sparse_ledger,
+                      'lazy_decay': self.lazy_decay,
+                      'customer_distribution': self.customer_distribution,
+                      'customer_types': self.customers.get_config(),
+                      'seed': self.seed,
+                      'reward_curve_coefficient': self.reward_curve_coefficient,
+                      'event_driven': self.event_driven,
+                      'fast_forward': self.fast_forward}
+        state = {'parameters': parameters,
+                 'customer_id': Customer.CUSTOMER_ID,
+                 'shop_id': Shop.SHOP_ID,
+                 'next_day': self.next_day,
+                 'days_run': self.days_run,
+                 'time': self.time_oracle.get_time(),
+                 'address': self.address,
+                 'shop_addresses': np.array([shop.get_shop_address() for shop in self.shops]),
+                 'shop_coins': np.array([shop.get_coin_count() for shop in self.shops]),
+                 'random_streams': self.random_streams.get_state(),
+                 'customers': self.customers.get_state(),
+                 'smart_contract': self.smart_contract.get_state()}
+        if self.scheduler is not None:
+            state['scheduler'] = self.scheduler.get_state()
+        return state
+
+    def _open_transaction_log(self, transaction_log, snapshot_every):
+        # True keeps the log in memory, a string is the path of the log file
+        self.transaction_log = TransactionLog(None if transaction_log is True else transaction_log, snapshot_every)
+        self.smart_contract.set_transaction_log(self.address, self.transaction_log)
+        self.transaction_log.take_snapshot(self.smart_contract, self.time_oracle.get_time())
+
+    def save_checkpoint(self, path):
+        save_state(path, self.get_state())
+
+    @classmethod
+    def from_checkpoint(cls, path, render='headless', checkpoint_every=None, checkpoint_path=None, profile=False,
+                        shared_state=None, metrics=None, transaction_log=None, snapshot_every=None):
+        # the engine is set up with the saved parameters and then takes over the saved state; metrics and a
+        # transaction log cover the resumed days, the log starts with a snapshot of the restored contract
+        state = load_state(path)
+        if transaction_log and state['parameters']['fast_forward']:
+            raise ValueError('a fast forward run cannot be recorded in a transaction log')
+        sim_engine = cls(render=render, checkpoint_every=checkpoint_every, profile=profile, shared_state=shared_state,
+                         checkpoint_path=checkpoint_path if checkpoint_path is not None else path, metrics=metrics,
+                         **state['parameters'])
+        Customer.CUSTOMER_ID = int(state['customer_id'])
+        Shop.SHOP_ID = int(state['shop_id'])
+        sim_engine.next_day = int(state['next_day'])
+        sim_engine.days_run = int(state['days_run'])
+        sim_engine.time_oracle.time = int(state['time'])
+        sim_engine.address = np.array(state['address'])
+        sim_engine.smart_contract.owner_address = sim_engine.address[0]
+        for shop, shop_address, coins in zip(sim_engine.shops, state['shop_addresses'].tolist(),
+                                             state['shop_coins'].tolist()):
+            shop.shop_id = shop_address
+            shop.coin_count = coins
+        sim_engine.shop_list_oracle = ShopListOracle()
+        sim_engine.shop_list_oracle.register_shops(state['shop_addresses'])
+        sim_engine.smart_contract.set_oracle(sim_engine.address, sim_engine.shop_list_oracle, sim_engine.time_oracle)
+        sim_engine.random_streams.set_state(state['random_streams'])
+        sim_engine.customers.set_state(state['customers'])
+        sim_engine.smart_contract.set_state(state['smart_contract'])
+        if sim_engine.scheduler is not None:
+            sim_engine.scheduler.set_state(state['scheduler'])
+        if transaction_log:
+            sim_engine._open_transaction_log(transaction_log, snapshot_every)
+        print('resuming at day {} of {}'.format(sim_engine.next_day, sim_engine.sim_iters))
+        return sim_engine
+
+    def _end_of_day(self, day):
+        # the part of a day that the scalar and the batched loop share
+        profiler = self.profiler
+        if self.scheduler is not None:
+            self.scheduler.advance(self.time_oracle, self.time_oracle.get_time(), self._handle_event)
+        else:
+            with profiler.phase('dues payment'):
+                if day != 0 and np.mod(day, self.payment_due):
+                    for shop in self.shops:
+                        shop.pay_dues_to_smart_contract(self.smart_contract)
+
+                    self.smart_contract.check_payments(self.address, day)
+
+            # deteriorate customer reputation at every simulation step
+            with profiler.phase('reputation decay'):
+                self.smart_contract.deteriorate_customer_reputation(self.address, value=0.10)
+        self._record_day(day)
+
+    def _record_day(self, day):
+        profiler = self.profiler
+        with profiler.phase('recording'):
+            if self.transaction_log is not None:
+                self.transaction_log.end_of_day(self.smart_contract, self.time_oracle.get_time())
+            if self.metrics is not None:
+                self.metrics.record(self, day)
+        with profiler.phase('shared state'):
+            if self.shared_state is not None:
+                self.shared_state.publish(self, day)
+
+        # visualize the market according to the render policy
+        with profiler.phase('visualization'):
+            self._render_day(day)
+        with profiler.phase('checkpoint'):
+            self._checkpoint_day(day)
+
+    def _schedule_events(self):
+        # every shop pays its dues each payment_due days and is checked once its payment is due, decay runs at
+        # the end of every day
+        self.scheduler = EventScheduler()
+        start = self.time_oracle.get_time()
+        for index in range(len(self.shops)):
+            self.scheduler.schedule(start + self.payment_due, DUES, index)
+            self.scheduler.schedule(start + self.payment_due, DEADLINE, index)
+        self.scheduler.schedule(start + 1, DECAY)
+
+    def _handle_event(self, kind, shop_index):
+        time = self.time_oracle.get_time()
+        if kind == DECAY:
+            with self.profiler.phase('reputation decay'):
+                self.smart_contract.deteriorate_customer_reputation(self.address, value=0.10)
+            self.scheduler.schedule(time + 1, DECAY)
+            return
+
+        shop = self.shops[shop_index]
+        shop_address = shop.get_shop_address()
+        with self.profiler.phase('dues payment'):
+            # blacklisting is final, so a blacklisted shop drops out of the schedule
+            if shop_address in self.smart_contract.black_listed_shops:
+                return
+            if kind == DUES:
+                shop.pay_dues_to_smart_contract(self.smart_contract)
+                self.scheduler.schedule(time + self.payment_due, DUES, shop_index)
+            elif self.smart_contract.check_payment(self.address, shop_address, time):
+                # the earliest time the shop can be overdue, a shop without a payment time is not known yet
+                last_payment = self.smart_contract.shop_payment_times.get(shop_address, time)
+                self.scheduler.schedule(last_payment + self.payment_due, DEADLINE, shop_index)
+
+    def _checkpoint_day(self, day):
+        # saves when the step that ended with day crossed a multiple of checkpoint_every
+        previous_day = self.next_day
+        self.next_day = day + 1
+        if self.checkpoint_every and self.next_day // self.checkpoint_every > previous_day // self.checkpoint_every \
+                and self.next_day < self.sim_iters:
+            self.save_checkpoint(self.checkpoint_path)
+
+    def _render_day(self, day):
+        if self.renderer.wants_frame(day):
+            self.renderer.submit(self._take_snapshot(day))
+
+    def _finish_rendering(self, day):
+        self.renderer.finish(self._take_snapshot(day) if self.renderer.wants_final_frame else None)
+
+    def _take_snapshot(self, day):
+        return take_snapshot(self.smart_contract, self.customers.addresses, self.customers.type_letters(),
+                             [shop.get_shop_address() for shop in self.shops],
+                             [shop.get_coin_count() for shop in self.shops], day)
+
+    def _create_customers(self, customer_distribution, customer_types):
+        # customers live in typed arrays, iterating the population yields per customer views
+        customers = Population(self.num_customers, customer_distribution, self.random_streams, customer_types)
+        print('\t'.join('{}c: {}'.format(letter, count)
+                        for letter, count in zip(customers.letters.tolist(), customers.type_counts().tolist())))
         return customers
 
     def _create_shops(self):
@@ -129,10 +534,29 @@ class SimulationEngine(object):
         return shops
 
     def _simulate_claim_failure(self, prob):
-        res = np.random.binomial(1, prob, 1)[0]
-        if res == 1:
+        if self.random_streams.buffer('claims').random() < prob:
             return True
         else:
             return False
 
 
+# up to this many choices visits are split by a chain of binomial draws, beyond it every visit is drawn on its own
+_SPLIT_LOOP_LIMIT = 16
+
+
+def _spread_counts(rng, counts, num_choices):
+    # splits counts[i] uniform draws over num_choices choices, returns (i, choice, draws) of the nonzero splits
+    if num_choices <= _SPLIT_LOOP_LIMIT:
+        index, choice, draws = [], [], []
+        remaining = counts
+        for c in range(num_choices):
+            taken = remaining if c == num_choices - 1 else rng.binomial(remaining, 1.0 / (num_choices - c))
+            remaining = remaining - taken
+            nonzero = np.flatnonzero(taken)
+            index.append(nonzero)
+            choice.append(np.full(len(nonzero), c, dtype=np.int64))
+            draws.append(taken[nonzero])
+        return np.concatenate(index), np.concatenate(choice), np.concatenate(draws)
+    rows = np.repeat(np.arange(len(counts)), counts)
+    keys, draws = np.unique(rows*num_choices + rng.integers(0, num_choices, len(rows)), return_counts=True)
+    return keys // num_choices, keys % num_choices, draws
@@ -2,36 +2,71 @@
 Implementation of a smart contract
 """
 import numpy as np
+from AddressSet import AddressSet
+from ClaimQueue import ClaimQueue
+from Ledger import DenseLedger
+from TransactionLog import PURCHASE, CLAIM, PAYMENT, BLACKLIST, DECAY
+
+COUNTERS = ('coins_issued', 'coins_spent', 'claims_made', 'claims_verified', 'claims_failed', 'blacklist_events',
+            'payments')
 
 
 class SmartContract(object):
 
-    def __init__(self, owner_address):
-        self.coin_map = {}
-        self.reputation_map = {}
-        self.customer_recycle_map = {}
-        self.shop_coin_map = {}
-        self.cus_buys_with_coin_map = {}
-        self.status = 'ready'
-        self.current_customer_address = -1
-        self.current_shop_address = -1
+    def __init__(self, owner_address, ledger=None):
+        # coins, reputation, recycle counts and coin purchases are kept in an array backed ledger
+        self.ledger = ledger if ledger is not None else DenseLedger()
+        # claims made by customers and not verified by their shop yet
+        self.pending_claims = ClaimQueue()
         self.owner_address = owner_address
         self.shop_oracle = None
         self.time_oracle = None
-        self.known_shops = []
-        self.black_listed_shops = []
+        self.known_shops = AddressSet()
+        self.black_listed_shops = AddressSet()
         self.shop_payment_times = {}
         # some default values
         self.reputation_limit = 100
         self.coin_limit = 100
         self.coins_per_reputation_token = 1
         self.payment_due_date = 30
+        # reputation earned on the n-th visit is reputation_limit - exp(log(reputation_limit) - coefficient*n),
+        # tabulated by visit count and rebuilt whenever the limit or the coefficient change
+        self.reward_curve_coefficient = 0.0005
+        self.reward_curve = np.zeros(0)
+        # when set, the running reputation totals are compared against a full recompute after every update
+        self.consistency_tolerance = None
+        # running totals for metrics, see COUNTERS
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        # when set, every state change is appended to this TransactionLog
+        self.transaction_log = None
 
     def set_oracle(self, sender_address, shop_oracle, time_oracle):
         if sender_address == self.owner_address:
             self.shop_oracle = shop_oracle
             self.time_oracle = time_oracle
 
+    def set_ledger(self, sender_address, ledger):
+        if sender_address == self.owner_address:
+            self.ledger = ledger
+
+    def set_consistency_checks(self, sender_address, tolerance=1e-6):
+        if sender_address == self.owner_address:
+            self.consistency_tolerance = tolerance
+
+    def set_transaction_log(self, sender_address, transaction_log):
+        if sender_address == self.owner_address:
+            self.transaction_log = transaction_log
+
+    def _log(self, kind, customer_addresses, shop_addresses, amounts=0, reputation=0):
+        time = self.time_oracle.get_time() if self.time_oracle is not None else 0
+        self.transaction_log.append(time, kind, customer_addresses, shop_addresses, amounts, reputation)
+
+    def check_reputation_totals(self):
+        error = self.ledger.reputation_totals_error()
+        if self.consistency_tolerance is not None and error > self.consistency_tolerance:
+            raise RuntimeError('reputation totals drifted from the ledger by {}'.format(error))
+        return error
+
     def set_coin_limit(self, sender_address, coin_limit):
         if self.owner_address == sender_address:
             self.coin_limit = coin_limit
@@ -39,6 +74,12 @@ class SmartContract(object):
     def set_reputation_limit(self, sender_address, reputation_limit):
         if self.owner_address == sender_address:
             self.reputation_limit = reputation_limit
+            self._build_reward_curve(len(self.reward_curve))
+
+    def set_reward_curve_coefficient(self, sender_address, coefficient):
+        if self.owner_address == sender_address:
+            self.reward_curve_coefficient = coefficient
+            self._build_reward_curve(len(self.reward_curve))
 
     def set_coins_per_reputation_token(self, sender_address, factor):
         if self.owner_address == sender_address:
@@ -53,10 +94,28 @@ class SmartContract(object):
             return False
 
         for shop_address in self.known_shops:
-            if current_time - self.shop_payment_times[shop_address] >= self.payment_due_date:
-                if shop_address not in self.black_listed_shops:
-                    self.black_listed_shops.append(shop_address)
-                    print('shop {} got blacklisted.'.format(shop_address))
+            self._check_payment(shop_address, current_time)
+
+    def check_payment(self, sender_address, shop_address, current_time):
+        # checks a single shop, True while the shop is in good standing
+        if sender_address != self.owner_address:
+            return False
+
+        return self._check_payment(shop_address, current_time)
+
+    def _check_payment(self, shop_address, current_time):
+        if shop_address in self.black_listed_shops:
+            return False
+        if shop_address not in self.known_shops:
+            return True
+        if current_time - self.shop_payment_times[shop_address] >= self.payment_due_date:
+            self.black_listed_shops.add(shop_address)
+            self.counters['blacklist_events'] += 1
+            if self.transaction_log is not None:
+                self._log(BLACKLIST, 0, shop_address)
+            print('shop {} got blacklisted.'.format(shop_address))
+            return False
+        return True
 
     def make_payment(self, shop_address, payment):
         if shop_address not in self.known_shops:
@@ -72,108 +131,245 @@ class SmartContract(object):
         if self.time_oracle is not None:
             payment_time = self.time_oracle.get_time()
             self.shop_payment_times[shop_address] = payment_time
+            self.counters['payments'] += 1
+            if self.transaction_log is not None:
+                self._log(PAYMENT, 0, shop_address, payment)
 
     def make_claim(self, shop_address, customer_address):
-        if self.status != 'ready':
-            return False
-        self.status = 'pending'
-        self.current_customer_address = customer_address
-        self.current_shop_address = shop_address
+        self.pending_claims.submit(customer_address, shop_address)
+        self.counters['claims_made'] += 1
         return True
 
+    def submit_claims(self, shop_addresses, customer_addresses):
+        self.pending_claims.submit(customer_addresses, shop_addresses)
+        self.counters['claims_made'] += len(shop_addresses)
+
     def verify_claim(self, shop_address, customer_address):
-        if self.status != 'pending':
+        result = self._verify_claim(shop_address, customer_address)
+        if result[0]:
+            self.counters['claims_verified'] += 1
+            self.counters['coins_issued'] += result[1]
+        else:
+            self.counters['claims_failed'] += 1
+        return result
+
+    def _verify_claim(self, shop_address, customer_address):
+        # check if this verification matches a previous customer claim, otherwise the customer's claims are void
+        if self.pending_claims.pending(customer_address, shop_address)[0] == 0:
+            self.pending_claims.drop_customers(customer_address)
             return False, -1, -1
+        self.pending_claims.remove(customer_address, shop_address)
 
         # verify if the shop_address is indeed a valid shop by asking an Oracle
         if self.shop_oracle is None:
-            self.status = 'ready'
             return False, -1, -1
 
         if shop_address not in self.known_shops:
             if (self.shop_oracle.verify_shop(shop_address=shop_address)) is False:
-                self.status = 'ready'
                 return False, -1, -1
             else:
-                self.known_shops.append(shop_address)
+                self.known_shops.add(shop_address)
 
         if shop_address in self.black_listed_shops:
-            self.status = 'ready'
             return False, -1, -1
 
-        # check if this verification matches a previous customer claim
-        if self.current_customer_address == customer_address and self.current_shop_address == shop_address:
-            self.status = 'ready'
+        # take note that this customer has recycled at this store
+        visits = self.ledger.increment_recycles(customer_address, shop_address)
+
+        # get customer reputation
+        customer_rep = self.ledger.reputation_of(customer_address, shop_address)
+        # calculate the number of coins to issue
+        new_coins = self._calculate_new_coins_for_customer(customer_rep)
+        new_rep = self._calculate_reputation_for_customer(customer_rep, visits)
+        # transfer coins and reputation to the customer
+        # if the coin balance >= self.coin_limit, one could cap it at self.coin_limit here
+        self.ledger.transfer_coins(customer_address, new_coins)
+        updated_rep = self._updated_reputation(customer_rep, new_rep, visits)
+        self.ledger.set_reputation(customer_address, shop_address, updated_rep)
+        if self.transaction_log is not None:
+            self._log(CLAIM, customer_address, shop_address, new_coins, updated_rep)
+        if self.consistency_tolerance is not None:
+            self.check_reputation_totals()
+
+        if not shop_address in self.shop_payment_times:
+            self.shop_payment_times[shop_address] = self.time_oracle.get_time()
+
+        return True, new_coins, new_rep
 
-            # take note that this customer has recycled at this store
-            if customer_address in self.customer_recycle_map:
-                if shop_address in self.customer_recycle_map[customer_address]:
-                    self.customer_recycle_map[customer_address][shop_address] += 1
-                else:
-                    self.customer_recycle_map[customer_address][shop_address] = 1
-            else:
-                self.customer_recycle_map[customer_address] = {}
-                self.customer_recycle_map[customer_address][shop_address] = 1
-
-            # get customer reputation
-            customer_rep = 0
-            if customer_address in self.reputation_map:
-                if shop_address in self.reputation_map[customer_address]:
-                    customer_rep = self.reputation_map[customer_address][shop_address]
-            # calculate the number of coins to issue
+    def customer_buys_with_coin(self, customer_address, shop_address, num_coins):
+        self.ledger.record_purchases(customer_address, shop_address, num_coins)
+        self.counters['coins_spent'] += num_coins
+        if self.transaction_log is not None:
+            self._log(PURCHASE, customer_address, shop_address, num_coins)
+
+    def customers_buy_with_coin(self, customer_addresses, shop_addresses, num_coins, num_purchases=1):
+        # num_purchases lets one entry stand for several purchases that spend num_coins in total
+        customer_addresses = np.asarray(customer_addresses, dtype=np.int64)
+        shop_addresses = np.asarray(shop_addresses, dtype=np.int64)
+        num_coins = np.broadcast_to(num_coins, customer_addresses.shape)
+        self.ledger.record_purchases(customer_addresses, shop_addresses, num_coins, num_purchases)
+        self.counters['coins_spent'] += num_coins.sum()
+        if self.transaction_log is not None:
+            self._log(PURCHASE, customer_addresses, shop_addresses, num_coins)
+
+    def verify_claims(self, shop_addresses, customer_addresses):
+        # batched verify_claim: every entry that matches a pending claim is settled, the others void the
+        # pending claims of their customer
+        shop_addresses = np.asarray(shop_addresses, dtype=np.int64)
+        customer_addresses = np.asarray(customer_addresses, dtype=np.int64)
+        rank = _occurrence_rank(ClaimQueue.make_keys(customer_addresses, shop_addresses))
+        matched = rank < self.pending_claims.pending(customer_addresses, shop_addresses)
+        self.pending_claims.remove(customer_addresses[matched], shop_addresses[matched])
+        if not np.all(matched):
+            self.pending_claims.drop_customers(customer_addresses[~matched])
+            self.counters['claims_failed'] += np.count_nonzero(~matched)
+
+        results = np.zeros(len(shop_addresses), dtype=bool)
+        coins = np.full(len(shop_addresses), -1.0)
+        reps = np.full(len(shop_addresses), -1.0)
+        results[matched], coins[matched], reps[matched] = self.settle_claims(shop_addresses[matched],
+                                                                             customer_addresses[matched])
+        return results, coins, reps
+
+    def settle_claims(self, shop_addresses, customer_addresses):
+        # settles every (shop, customer) entry as a claim that has been made, without going through the queue
+        shop_addresses = np.asarray(shop_addresses, dtype=np.int64)
+        customer_addresses = np.asarray(customer_addresses, dtype=np.int64)
+        results = np.zeros(len(shop_addresses), dtype=bool)
+        coins = np.full(len(shop_addresses), -1.0)
+        reps = np.full(len(shop_addresses), -1.0)
+        if self.shop_oracle is None or len(shop_addresses) == 0:
+            self.counters['claims_failed'] += len(shop_addresses)
+            return results, coins, reps
+
+        unique_shops, inverse = np.unique(shop_addresses, return_inverse=True)
+        shop_is_valid = self._verify_shops_for_claims(unique_shops)
+        results = shop_is_valid[inverse]
+        self.counters['claims_verified'] += np.count_nonzero(results)
+        self.counters['claims_failed'] += len(results) - np.count_nonzero(results)
+
+        # claims for the same (customer, shop) pair have to be applied one after another
+        rank = _occurrence_rank(customer_addresses * (unique_shops.max() + 1) + shop_addresses)
+        ledger = self.ledger
+        for r in range(rank.max() + 1 if len(rank) > 0 else 0):
+            idx = np.flatnonzero(results & (rank == r))
+            cus = customer_addresses[idx]
+            shp = shop_addresses[idx]
+            visits = ledger.increment_recycles(cus, shp)
+            customer_rep = ledger.reputation_of(cus, shp)
             new_coins = self._calculate_new_coins_for_customer(customer_rep)
-            new_rep = self._calculate_reputation_for_customer(customer_rep,
-                                                              self.customer_recycle_map[customer_address][shop_address])
-            # transfer coins and reputation to the customer
-            if customer_address in self.coin_map:
-                # if self.coin_map[customer_address] >= self.coin_limit:
-                #     self.coin_map[customer_address] = self.coin_limit
-                # else:
-                #     self.coin_map[customer_address] += new_coins
-                self.coin_map[customer_address] += new_coins
-            else:
-                self.coin_map[customer_address] = new_coins
-
-            if customer_address in self.reputation_map:
-                if shop_address in self.reputation_map[customer_address]:
-                    if self.reputation_map[customer_address][shop_address] >= self.reputation_limit:
-                        self.reputation_map[customer_address][shop_address] = self.reputation_limit
-                    else:
-                        self.reputation_map[customer_address][shop_address] += new_rep
-                else:
-                    self.reputation_map[customer_address][shop_address] = new_rep
-            else:
-                self.reputation_map[customer_address] = {}
-                self.reputation_map[customer_address][shop_address] = new_rep
-
-            if not shop_address in self.shop_payment_times:
+            new_rep = self._calculate_reputation_for_customer(customer_rep, visits)
+            ledger.transfer_coins(cus, new_coins)
+            updated_rep = self._updated_reputation(customer_rep, new_rep, visits)
+            ledger.set_reputation(cus, shp, updated_rep)
+            if self.transaction_log is not None:
+                self._log(CLAIM, cus, shp, new_coins, updated_rep)
+            coins[idx] = new_coins
+            self.counters['coins_issued'] += new_coins.sum()
+            reps[idx] = new_rep
+        if self.consistency_tolerance is not None:
+            self.check_reputation_totals()
+
+        for shop_address, valid in zip(unique_shops, shop_is_valid):
+            if valid and shop_address not in self.shop_payment_times:
                 self.shop_payment_times[shop_address] = self.time_oracle.get_time()
 
-            return True, new_coins, new_rep
-
-        return False, -1, -1
+        return results, coins, reps
 
-    def customer_buys_with_coin(self, customer_address, shop_address, num_coins):
-        self.coin_map[customer_address] -= num_coins
-        if shop_address in self.shop_coin_map:
-            self.shop_coin_map[shop_address] += num_coins
-        else:
-            self.shop_coin_map[shop_address] = num_coins
+    def fast_forward_claims(self, sender_address, shop_addresses, customer_addresses, claim_counts, failed_counts,
+                            days, decay_value, coin_targets=None):
+        # advances the contract by days days in one step: every distinct (shop, customer) pair makes claim_counts
+        # claims spread evenly over the days and failed_counts claims that fail, and the daily decay is applied
+        # between the claims of a pair and to the whole ledger in closed form. Returns per pair whether the claims
+        # were settled, the coins they earned, the sum of their new reputation and the day of the step on which
+        # the coins of their customer, summed over its pairs, first exceeded its coin target (days if they did
+        # not, coin_targets holds one target per pair and the pairs of a customer share it).
+        if sender_address != self.owner_address:
+            return False
 
-        if customer_address in self.cus_buys_with_coin_map:
-            self.cus_buys_with_coin_map[customer_address] += 1
-        else:
-            self.cus_buys_with_coin_map[customer_address] = 1
+        shop_addresses = np.asarray(shop_addresses, dtype=np.int64)
+        customer_addresses = np.asarray(customer_addresses, dtype=np.int64)
+        claim_counts = np.asarray(claim_counts, dtype=np.int64)
+        self.counters['claims_made'] += int(claim_counts.sum() + np.sum(failed_counts))
+        self.counters['claims_failed'] += int(np.sum(failed_counts))
+        results = np.zeros(len(shop_addresses), dtype=bool)
+        coins = np.zeros(len(shop_addresses))
+        reps = np.zeros(len(shop_addresses))
+        target_days = np.full(len(shop_addresses), days, dtype=np.int64)
+        keep = 1.0 - decay_value
+        if len(shop_addresses) > 0 and self.shop_oracle is not None:
+            unique_shops, inverse = np.unique(shop_addresses, return_inverse=True)
+            results = self._verify_shops_for_claims(unique_shops)[inverse] & (claim_counts > 0)
+        self.counters['claims_verified'] += int(claim_counts[results].sum())
+        self.counters['claims_failed'] += int(claim_counts[~results].sum())
+
+        # pairs with more claims first, so the pairs that still claim in round r are a prefix
+        idx = np.flatnonzero(results)
+        idx = idx[np.argsort(-claim_counts[idx], kind='stable')]
+        cus = customer_addresses[idx]
+        shp = shop_addresses[idx]
+        counts = claim_counts[idx]
+        ledger = self.ledger
+        ledger.ensure(cus, shp)
+        reputation = ledger.reputation_of(cus, shp)
+        first_visits = ledger.increment_recycles(cus, shp, counts) - counts
+        pair_coins = np.zeros(len(idx))
+        pair_reps = np.zeros(len(idx))
+        pair_targets = np.full(len(idx), np.inf) if coin_targets is None else np.asarray(coin_targets, float)[idx]
+        track = np.isfinite(pair_targets)
+        # (pair, day, coins) of the claims of customers with a target
+        tracked_claims = []
+        last_day = np.zeros(len(idx), dtype=np.int64)
+        descending = -counts
+        for r in range(counts[0] if len(counts) > 0 else 0):
+            a = np.searchsorted(descending, -r)
+            # the r-th of n claims is made on day (r + 1/2)*days/n of the step
+            claim_day = ((2*r + 1)*days) // (2*counts[:a])
+            customer_rep = reputation[:a]*keep**(claim_day - last_day[:a])
+            last_day[:a] = claim_day
+            visits = first_visits[:a] + (r + 1)
+            new_rep = self._calculate_reputation_for_customer(customer_rep, visits)
+            new_coins = self._calculate_new_coins_for_customer(customer_rep)
+            pair_coins[:a] += new_coins
+            tracked = np.flatnonzero(track[:a])
+            if len(tracked) > 0:
+                tracked_claims.append((tracked, claim_day[tracked], new_coins[tracked]))
+            pair_reps[:a] += new_rep
+            reputation[:a] = self._updated_reputation(customer_rep, new_rep, visits)
+        reputation *= keep**(days - last_day)
+
+        ledger.decay_reputation(1.0 - keep**days)
+        ledger.set_reputation(cus, shp, reputation)
+        ledger.transfer_coins(cus, pair_coins)
+        self.counters['coins_issued'] += pair_coins.sum()
+        coins[idx] = pair_coins
+        reps[idx] = pair_reps
+        if tracked_claims:
+            target_days[idx] = _target_days(cus, pair_targets, tracked_claims, days)
+        for shop_address in np.unique(shp).tolist():
+            if shop_address not in self.shop_payment_times:
+                self.shop_payment_times[shop_address] = self.time_oracle.get_time()
+        if self.consistency_tolerance is not None:
+            self.check_reputation_totals()
+        return results, coins, reps, target_days
+
+    def _verify_shops_for_claims(self, shop_addresses):
+        # shops the contract has not seen yet are asked for at the oracle, like in verify_claim
+        known = self.known_shops.contains_many(shop_addresses)
+        if not known.all():
+            known[~known] = self.shop_oracle.verify_shops(shop_addresses[~known])
+            self.known_shops.add_many(shop_addresses[known])
+        return known & ~self.black_listed_shops.contains_many(shop_addresses)
 
     def deteriorate_customer_reputation(self, sender_address, value=0.05):
         if sender_address != self.owner_address:
             return False
 
-        for customer in self.reputation_map:
-            for iter_shops in self.reputation_map[customer]:
-                curr_rep = self.reputation_map[customer][iter_shops]*value
-                if self.reputation_map[customer][iter_shops] >= curr_rep:
-                    self.reputation_map[customer][iter_shops] -= curr_rep
+        self.ledger.decay_reputation(value)
+        if self.transaction_log is not None:
+            self._log(DECAY, 0, 0, value)
+        if self.consistency_tolerance is not None:
+            self.check_reputation_totals()
 
     def _calculate_new_coins_for_customer(self, customer_reputation):
         new_coins = customer_reputation*self.coins_per_reputation_token
@@ -182,25 +378,39 @@ class SmartContract(object):
         # new_coins = self.coin_limit - np.exp(np.log(self.coin_limit) - 0.005*new_coins)
         return new_coins
 
+    def _updated_reputation(self, customer_rep, new_rep, visits):
+        # a first visit starts at new_rep, later visits add to it until the reputation limit is reached
+        return np.where(visits == 1, new_rep,
+                        np.where(customer_rep >= self.reputation_limit, self.reputation_limit, customer_rep + new_rep))
+
     def _calculate_reputation_for_customer(self, customer_reputation, visits):
         # new_rep = customer_reputation + 0.25
-        new_rep = self.reputation_limit - np.exp(np.log(self.reputation_limit) - 0.0005*visits)
+        new_rep = self.reputation_for_visits(visits)
         return new_rep
 
+    def reputation_for_visits(self, visits):
+        # reward curve lookup, for a single visit count or an array of them
+        max_visits = visits.max(initial=0) if isinstance(visits, np.ndarray) else visits
+        if max_visits >= len(self.reward_curve):
+            self._build_reward_curve(max(2*len(self.reward_curve), max_visits + 1, 256))
+        return self.reward_curve[visits]
+
+    def _build_reward_curve(self, size):
+        visits = np.arange(size)
+        self.reward_curve = self.reputation_limit - np.exp(np.log(self.reputation_limit) -
+                                                           self.reward_curve_coefficient*visits)
+
     def calculate_shop_reputation(self, shop_address):
-        reputation = 0
-        for customer in self.reputation_map:
-            for iter_shops in self.reputation_map[customer]:
-                if iter_shops == shop_address:
-                     reputation += self.reputation_map[customer][shop_address]
-        return reputation
+        return self.ledger.shop_reputation(shop_address)
 
     def calculate_customer_reputation(self, customer_address):
-        reputation = 0
-        if customer_address in self.reputation_map:
-            for iter_shops in self.reputation_map[customer_address]:
-                reputation += self.reputation_map[customer_address][iter_shops]
-        return reputation
+        return self.ledger.customer_reputation(customer_address)
+
+    def calculate_shop_reputations(self, shop_addresses):
+        return self.ledger.shop_reputations(shop_addresses)
+
+    def calculate_customer_reputations(self, customer_addresses):
+        return self.ledger.customer_reputations(customer_addresses)
 
     def valid_shops_left(self, shop_addresses):
         if len(self.black_listed_shops) == len(shop_addresses):
@@ -209,11 +419,67 @@ class SmartContract(object):
             return True
 
     def get_coin_map(self):
-        return self.coin_map
+        return self.ledger.coin_map()
 
     def get_reputation_map(self):
-        return self.reputation_map
+        return self.ledger.reputation_map()
 
     def get_coin_purchase_map(self):
-        return self.cus_buys_with_coin_map
-
+        return self.ledger.purchase_map()
+
+    def get_coin_purchases(self, customer_addresses):
+        return self.ledger.customer_purchases(customer_addresses)
+
+    def get_counters(self):
+        return dict((name, value.item() if isinstance(value, np.generic) else value)
+                    for name, value in self.counters.items())
+
+    def get_state(self):
+        # oracles and the transaction log are not part of the state, parameters are set by the owner
+        payment_shops = np.array(list(self.shop_payment_times), dtype=np.int64)
+        return {'ledger': self.ledger.get_state(),
+                'counters': self.get_counters(),
+                'known_shops': self.known_shops.get_state(),
+                'black_listed_shops': self.black_listed_shops.get_state(),
+                'pending_claims': self.pending_claims.get_state(),
+                'payment_shops': payment_shops,
+                'payment_times': np.array([self.shop_payment_times[shop] for shop in payment_shops.tolist()],
+                                          dtype=np.int64)}
+
+    def set_state(self, state):
+        self.ledger.set_state(state['ledger'])
+        self.known_shops.set_state(state['known_shops'])
+        self.black_listed_shops.set_state(state['black_listed_shops'])
+        self.pending_claims.set_state(state['pending_claims'])
+        self.shop_payment_times = dict(zip(state['payment_shops'].tolist(), state['payment_times'].tolist()))
+        self.counters.update(state.get('counters', {}))
+
+
+def _occurrence_rank(keys):
+    # how many times each key has already appeared earlier in the array
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    first = np.r_[True, sorted_keys[1:] != sorted_keys[:-1]]
+    start = np.maximum.accumulate(np.where(first, np.arange(len(keys)), 0))
+    rank = np.empty(len(keys), dtype=np.int64)
+    rank[order] = np.arange(len(keys)) - start
+    return rank
+
+
+def _target_days(customer_addresses, targets, tracked_claims, days):
+    # the claims of every customer in the order of their days, the day on which their running sum of coins first
+    # exceeds the target of the customer is handed to all pairs of that customer
+    pairs, claim_days, coins = [np.concatenate(values) for values in zip(*tracked_claims)]
+    customers = customer_addresses[pairs]
+    order = np.lexsort((claim_days, customers))
+    pairs, claim_days, coins, customers = pairs[order], claim_days[order], coins[order], customers[order]
+    starts = np.r_[True, customers[1:] != customers[:-1]]
+    group = np.cumsum(starts) - 1
+    running = np.cumsum(coins)
+    running -= (running - coins)[starts][group]
+    group_days = np.full(group[-1] + 1, days, dtype=np.int64)
+    over = running > targets[pairs]
+    np.minimum.at(group_days, group[over], claim_days[over])
+    target_days = np.full(len(customer_addresses), days, dtype=np.int64)
+    target_days[pairs] = group_days[group]
+    return target_days
@@ -0,0 +1,188 @@
+"""@package TransactionLog
+Implementation of an append only transaction log for the smart contract
+
+Every state change of a SmartContract (coin purchases, verified claims, payments, blacklisting and reputation
+decay) is appended as fixed width records to a NumPy structured array, optionally flushed to a binary file.
+All records written by one contract call share a batch number, so replaying a batch repeats that call on the
+ledger. Snapshots of the contract state are taken every few days; the state at any time is rebuilt from the
+nearest snapshot before it plus the records written after that snapshot. A snapshot is the get_state of the
+contract and its parameters, kept in memory or written as a checkpoint file (see Checkpoint).
+"""
+import glob
+import os
+import numpy as np
+from Checkpoint import save_state, load_state
+from Ledger import DenseLedger, SparseLedger
+
+PURCHASE = 0
+CLAIM = 1
+PAYMENT = 2
+BLACKLIST = 3
+DECAY = 4
+
+# amount: coins of a purchase or a claim, the payment of a shop, the decay value
+# reputation: the reputation stored for the (customer, shop) pair after a claim
+RECORD_DTYPE = np.dtype([('time', np.int32), ('batch', np.uint32), ('kind', np.uint8), ('customer', np.int32),
+                         ('shop', np.int32), ('amount', np.float64), ('reputation', np.float64)])
+
+_CONTRACT_PARAMETERS = ('owner_address', 'reputation_limit', 'coin_limit', 'coins_per_reputation_token',
+                        'payment_due_date', 'reward_curve_coefficient')
+
+
+def _copy_state(state):
+    # get_state returns views of the live arrays, a snapshot kept in memory needs its own copies
+    copied = {}
+    for name, value in state.items():
+        if isinstance(value, dict):
+            copied[name] = _copy_state(value)
+        elif isinstance(value, np.ndarray):
+            copied[name] = value.copy()
+        else:
+            copied[name] = value
+    return copied
+
+
+class TransactionLog(object):
+
+    def __init__(self, path=None, snapshot_every=None, buffer_size=1 << 16):
+        # with a path, records go to path and snapshots to path.<time>.<position>.snapshot, otherwise both stay
+        # in memory
+        self.path = path
+        self.snapshot_every = snapshot_every
+        self.buffer = np.zeros(buffer_size, dtype=RECORD_DTYPE)
+        self.size = 0
+        self.flushed = 0
+        self.batch = 0
+        self.snapshots = []
+        if path is not None:
+            open(path, 'wb').close()
+
+    @classmethod
+    def load(cls, path):
+        # opens the log of a finished run for analysis
+        log = cls.__new__(cls)
+        log.path = path
+        log.snapshot_every = None
+        log.buffer = np.zeros(0, dtype=RECORD_DTYPE)
+        log.size = 0
+        log.flushed = os.path.getsize(path) // RECORD_DTYPE.itemsize
+        log.batch = 0
+        log.snapshots = sorted(log._snapshot_entry(snapshot_path)
+                               for snapshot_path in glob.glob(glob.escape(path) + '.*.snapshot'))
+        return log
+
+    def __len__(self):
+        return self.flushed + self.size
+
+    def append(self, time, kind, customer_addresses, shop_addresses, amounts=0, reputation=0):
+        customer_addresses, shop_addresses, amounts, reputation = np.broadcast_arrays(
+            np.atleast_1d(customer_addresses), shop_addresses, amounts, reputation)
+        count = len(customer_addresses)
+        if self.size + count > len(self.buffer):
+            self.flush()
+        if self.size + count > len(self.buffer):
+            grown = np.zeros(max(2*len(self.buffer), self.size + count), dtype=RECORD_DTYPE)
+            grown[:self.size] = self.buffer[:self.size]
+            self.buffer = grown
+        records = self.buffer[self.size:self.size + count]
+        records['time'] = time
+        records['batch'] = self.batch
+        records['kind'] = kind
+        records['customer'] = customer_addresses
+        records['shop'] = shop_addresses
+        records['amount'] = amounts
+        records['reputation'] = reputation
+        self.size += count
+        self.batch += 1
+
+    def flush(self):
+        # in memory logs keep all records in the buffer
+        if self.path is None:
+            return
+        with open(self.path, 'ab') as f:
+            self.buffer[:self.size].tofile(f)
+        self.flushed += self.size
+        self.size = 0
+
+    def records(self, start=0):
+        if self.path is None:
+            return self.buffer[start:self.size]
+        self.flush()
+        if self.flushed == 0:
+            return np.zeros(0, dtype=RECORD_DTYPE)
+        return np.memmap(self.path, dtype=RECORD_DTYPE, mode='r')[start:]
+
+    def end_of_day(self, smart_contract, time):
+        if self.snapshot_every is not None and time % self.snapshot_every == 0:
+            self.take_snapshot(smart_contract, time)
+
+    def take_snapshot(self, smart_contract, time):
+        state = {'contract': smart_contract.get_state(),
+                 'sparse_ledger': isinstance(smart_contract.ledger, SparseLedger),
+                 'parameters': dict((name, getattr(smart_contract, name)) for name in _CONTRACT_PARAMETERS)}
+        if self.path is None:
+            self.snapshots.append((time, len(self), _copy_state(state)))
+            return
+        self.flush()
+        snapshot_path = '{}.{}.{}.snapshot'.format(self.path, time, len(self))
+        save_state(snapshot_path, state)
+        self.snapshots.append((time, len(self), snapshot_path))
+
+    @staticmethod
+    def _snapshot_entry(snapshot_path):
+        # time and log position are part of the file name, so opening a log reads no snapshot
+        time, position = snapshot_path.rsplit('.', 3)[1:3]
+        return int(time), int(position), snapshot_path
+
+    def rebuild(self, time):
+        # contract state at the end of the given time, with neither oracles nor a log attached
+        candidates = [snapshot for snapshot in self.snapshots if snapshot[0] <= time]
+        if not candidates:
+            raise ValueError('no snapshot at or before time {}'.format(time))
+        _, position, state = max(candidates, key=lambda snapshot: snapshot[0])
+        if not isinstance(state, dict):
+            state = load_state(state)
+
+        # set_state copies the arrays, the snapshot stays as it was
+        from SmartContract import SmartContract
+        parameters = state['parameters']
+        ledger_type = SparseLedger if state['sparse_ledger'] else DenseLedger
+        smart_contract = SmartContract(parameters['owner_address'], ledger_type())
+        for name in _CONTRACT_PARAMETERS:
+            setattr(smart_contract, name, parameters[name])
+        smart_contract.set_state(state['contract'])
+        records = self.records(position)
+        replay(smart_contract, records[:np.searchsorted(records['time'], time, side='right')])
+        return smart_contract
+
+
+def replay(smart_contract, records):
+    # applies the records batch by batch, the same way the contract applied them when they were logged
+    if len(records) == 0:
+        return
+    records = np.asarray(records)
+    ledger = smart_contract.ledger
+    starts = np.r_[0, np.flatnonzero(records['batch'][1:] != records['batch'][:-1]) + 1, len(records)]
+    for start, end in zip(starts[:-1], starts[1:]):
+        batch = records[start:end]
+        kind = batch['kind'][0]
+        time = int(batch['time'][0])
+        customers = batch['customer'].astype(np.int64)
+        shops = batch['shop'].astype(np.int64)
+        if kind == PURCHASE:
+            ledger.record_purchases(customers, shops, batch['amount'])
+        elif kind == CLAIM:
+            ledger.increment_recycles(customers, shops)
+            ledger.transfer_coins(customers, batch['amount'])
+            ledger.set_reputation(customers, shops, batch['reputation'])
+            smart_contract.known_shops.add_many(shops)
+            for shop_address in shops.tolist():
+                smart_contract.shop_payment_times.setdefault(shop_address, time)
+        elif kind == PAYMENT:
+            for shop_address in shops.tolist():
+                smart_contract.shop_payment_times[shop_address] = time
+        elif kind == BLACKLIST:
+            smart_contract.black_listed_shops.add_many(shops)
+        elif kind == DECAY:
+            for value in batch['amount']:
+                ledger.decay_reputation(value)
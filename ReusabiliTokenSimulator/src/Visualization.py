@@ -4,6 +4,7 @@ Implementation of a few visualizers
 import matplotlib.pyplot as plt
 import numpy as np
 import matplotlib.cm as cm
+from Rendering import take_snapshot
 
 
 def visualize_function(values, name, color, ax=None):
@@ -17,67 +18,122 @@ def visualize_function(values, name, color, ax=None):
 
 
 def visualize_market(smart_contract, customer_list, shop_list, ax_cus=None, ax_shop=None, ax_cp=None, ax_ca=None):
-    if ax_cus is None or ax_shop is None:
-        f = plt.figure()
-        ax_cus = f.add_subplot(2, 2, 1)
-        ax_shop = f.add_subplot(2, 2, 2)
-        ax_cp = f.add_subplot(2, 2, 3)
-        ax_ca = f.add_subplot(2, 2, 4)
-
-    cus_reps = []
-    shop_reps = []
-    customer_colors = []
-    for c in customer_list:
-        if c.get_type() == 'g':
-            customer_colors.append('green')
-        if c.get_type() == 'b':
-            customer_colors.append('red')
-        if c.get_type() == 'n':
-            customer_colors.append('yellow')
-
-    ax_cus.set_title('customer reputation')
-    ax_cus.grid(True)
-    cus_labels = ['c' + str(i) for i in range(len(customer_list))]
-    ax_cus.set_xticklabels(cus_labels)
-    for xtick, color in zip(ax_cus.get_xticklabels(), customer_colors):
-        xtick.set_color(color)
-    ax_cus.set_xticks(np.arange(len(customer_list)))
-    ax_cus.set_ylim(0, smart_contract.reputation_limit+100)
-    ax_shop.set_title('shop reputation')
-    ax_shop.grid(True)
-    shop_labels = ['s' + str(i) for i in range(len(shop_list))]
-    ax_shop.set_xticklabels(shop_labels)
-    ax_shop.set_xticks(np.arange(len(shop_list)))
-    ax_cp.set_title('coin purchases')
-    ax_cp.grid(True)
-    ax_cp.set_xticklabels(cus_labels)
-    for xtick, color in zip(ax_cp.get_xticklabels(), customer_colors):
-        xtick.set_color(color)
-    ax_cp.set_xticks(np.arange(len(customer_list)))
-    ax_ca.set_title('coins re-collected at shops')
-    ax_ca.grid(True)
-    ax_ca.set_xticklabels(shop_labels)
-    ax_ca.set_xticks(np.arange(len(shop_list)))
-
-    for customer in customer_list:
-        cus_reps.append(smart_contract.calculate_customer_reputation(customer.get_address()))
-
-    for shop in shop_list:
-        shop_reps.append(smart_contract.calculate_shop_reputation(shop.get_shop_address()))
-
-    cp_map = smart_contract.get_coin_purchase_map()
-    coin_purchases = np.zeros(len(customer_list))
-    for customer in cp_map:
-        coin_purchases[customer] = cp_map[customer]
-
-    coins_collected_in_shops = [shop.get_coin_count() for shop in shop_list]
-
-    ax_cus.bar(np.arange(len(customer_list)), cus_reps, color=customer_colors)
-    ax_shop.bar(np.arange(len(shop_list)), shop_reps, color='blue')
-    ax_cp.bar(np.arange(len(customer_list)), coin_purchases, color=customer_colors)
-    ax_ca.bar(np.arange(len(shop_list)), coins_collected_in_shops, color='magenta')
-    plt.tight_layout()
-    return ax_cus, ax_shop, ax_cp, ax_ca
+    snapshot = take_snapshot(smart_contract,
+                             [c.get_address() for c in customer_list],
+                             np.array([c.get_type() for c in customer_list]),
+                             [shop.get_shop_address() for shop in shop_list],
+                             [shop.get_coin_count() for shop in shop_list],
+                             day=None)
+    return visualize_snapshot(snapshot, ax_cus, ax_shop, ax_cp, ax_ca)
+
+
+def visualize_snapshot(snapshot, ax_cus=None, ax_shop=None, ax_cp=None, ax_ca=None):
+    # the bars are created with the first snapshot, later snapshots only update their heights
+    axes = (ax_cus, ax_shop, ax_cp, ax_ca)
+    if any(ax is None for ax in axes):
+        market_figure = MarketFigure(snapshot)
+    else:
+        market_figure = getattr(ax_cus, 'market_figure', None)
+        if market_figure is None or market_figure.axes != axes:
+            market_figure = MarketFigure(snapshot, axes=axes)
+    market_figure.update(snapshot)
+    return market_figure.axes
+
+
+_CUSTOMER_COLORS = {'g': 'green', 'b': 'red', 'n': 'yellow'}
+
+
+class MarketFigure(object):
+    """the four market bar charts, drawn once and then updated in place; on a new figure unless the four axes
+    are given, blitted unless the canvas cannot blit"""
+
+    def __init__(self, snapshot, blit=True, axes=None):
+        own_figure = axes is None
+        if own_figure:
+            self.figure = plt.figure()
+            axes = [self.figure.add_subplot(2, 2, i) for i in range(1, 5)]
+        else:
+            self.figure = axes[0].figure
+        ax_cus, ax_shop, ax_cp, ax_ca = axes
+        self.axes = tuple(axes)
+        ax_cus.market_figure = self
+        self.blit = blit and self.figure.canvas.supports_blit
+        blit = self.blit
+
+        num_customers = len(snapshot['customer_types'])
+        num_shops = len(snapshot['shop_reputation'])
+        customer_colors = [_CUSTOMER_COLORS.get(customer_type, 'gray') for customer_type in snapshot['customer_types']]
+        cus_labels = ['c' + str(i) for i in range(num_customers)]
+        shop_labels = ['s' + str(i) for i in range(num_shops)]
+
+        self._setup_axis(ax_cus, 'customer reputation', cus_labels, customer_colors)
+        self._setup_axis(ax_shop, 'shop reputation', shop_labels)
+        self._setup_axis(ax_cp, 'coin purchases', cus_labels, customer_colors)
+        self._setup_axis(ax_ca, 'coins re-collected at shops', shop_labels)
+
+        self.bars = [ax_cus.bar(np.arange(num_customers), np.zeros(num_customers), color=customer_colors,
+                                animated=blit),
+                     ax_shop.bar(np.arange(num_shops), np.zeros(num_shops), color='blue', animated=blit),
+                     ax_cp.bar(np.arange(num_customers), np.zeros(num_customers), color=customer_colors,
+                               animated=blit),
+                     ax_ca.bar(np.arange(num_shops), np.zeros(num_shops), color='magenta', animated=blit)]
+        for ax in self.axes:
+            ax.set_ylim(0, 1)
+        ax_cus.set_ylim(0, snapshot['reputation_limit']+100)
+        self.title = self.figure.suptitle('', animated=blit)
+        if own_figure:
+            self.figure.tight_layout()
+
+        self.background = None
+        if blit:
+            self.figure.canvas.mpl_connect('draw_event', self._on_draw)
+
+    @staticmethod
+    def _setup_axis(ax, title, labels, label_colors=None):
+        ax.set_title(title)
+        ax.grid(True)
+        ax.set_xticks(np.arange(len(labels)))
+        ax.set_xticklabels(labels)
+        if label_colors is not None:
+            for xtick, color in zip(ax.get_xticklabels(), label_colors):
+                xtick.set_color(color)
+
+    def update(self, snapshot):
+        values = [snapshot['customer_reputation'], snapshot['shop_reputation'], snapshot['coin_purchases'],
+                  snapshot['shop_coins']]
+        rescaled = False
+        for ax, bars, heights in zip(self.axes, self.bars, values):
+            for bar, height in zip(bars, heights):
+                bar.set_height(height)
+            top = np.max(heights, initial=0)
+            if top > ax.get_ylim()[1]:
+                # leave head room so a growing market only needs a full redraw every now and then
+                ax.set_ylim(0, 2*top)
+                rescaled = True
+        if snapshot['day'] is not None:
+            self.title.set_text('Market after {} days'.format(snapshot['day']))
+
+        canvas = self.figure.canvas
+        if not self.blit:
+            canvas.draw_idle()
+        elif rescaled or self.background is None:
+            # a full draw refreshes the background through _on_draw
+            canvas.draw()
+            canvas.blit(self.figure.bbox)
+        else:
+            canvas.restore_region(self.background)
+            self._draw_animated()
+            canvas.blit(self.figure.bbox)
+
+    def _on_draw(self, event):
+        self.background = self.figure.canvas.copy_from_bbox(self.figure.bbox)
+        self._draw_animated()
+
+    def _draw_animated(self):
+        for bars in self.bars:
+            for bar in bars:
+                self.figure.draw_artist(bar)
+        self.figure.draw_artist(self.title)
 
 
 def diminishing_returns(max_val, b1, num_samples=100):
@@ -1,39 +1,133 @@
 """@package app_reusabilityToken_simulator
 Simulates a market where resuabilty tokens are at work
+
+Every SimulationEngine parameter is an option; --config reads them from a JSON file keyed by the constructor
+parameter names, and options on the command line override the file. Only the modules a run needs are imported,
+plotting and profiling load when they are asked for.
 """
 import argparse
+import json
 from SimulationEngine import SimulationEngine
 
-num_iterations = 100
-num_customers = 3
-num_shops = 2
+# options that configure the run rather than the engine
+RUN_OPTIONS = ('config', 'resume', 'profile', 'watch', 'claim_failure_probability')
+
+engine_parameters = {}
+resume = None
+profile = None
+watch_source = None
+claim_failure_probability = 0.00001
 
 
-def setup_args():
-    global num_iterations, num_customers, num_shops
+def make_parser():
     parser = argparse.ArgumentParser('ReusabiliToken Simulator')
-    parser.add_argument('--num_iterations', type=int, help='Number of iterations', default=100)
-    parser.add_argument('--num_customers', type=int, help='Number of customers', default=100)
-    parser.add_argument('--num_shops', type=int, help='Number of shops', default=5)
-    args = parser.parse_args()
-    num_iterations = args.num_iterations
-    num_customers = args.num_customers
-    num_shops = args.num_shops
+    parser.add_argument('--config', type=str, default=None,
+                        help='JSON file with engine parameters by constructor name, options given here override it')
+    market = parser.add_argument_group('market')
+    market.add_argument('--num_iterations', dest='sim_iters', type=int, help='Number of iterations', default=100)
+    market.add_argument('--num_customers', type=int, help='Number of customers', default=100)
+    market.add_argument('--num_shops', type=int, help='Number of shops', default=5)
+    market.add_argument('--customer_distribution', type=float, nargs='+', default=[0.2, 0.2, 0.6], metavar='SHARE',
+                        help='Share of each customer type, good, bad and neutral unless --customer_types is given')
+    market.add_argument('--customer_types', type=json.loads, default=None,
+                        help='JSON list of customer types, see CustomerBehaviour; usually given in the --config file')
+    market.add_argument('--coin_limit', type=float, default=200000, help='Coin limit of the smart contract')
+    market.add_argument('--rep_limit', type=float, default=20000, help='Reputation limit of a customer at a shop')
+    market.add_argument('--coin_rep_factor', type=float, default=0.50, help='Coins issued per reputation token')
+    market.add_argument('--reward_curve_coefficient', type=float, default=0.0005,
+                        help='How fast the reputation reward of repeated visits saturates')
+    market.add_argument('--payment_due', type=int, default=30, help='Days a shop has to pay its dues')
+    market.add_argument('--seed', type=int, help='Seed for reproducible runs', default=None)
+    market.add_argument('--claim_failure_probability', type=float, default=0.00001,
+                        help='Probability that a claim fails verification')
+    engine = parser.add_argument_group('engine')
+    engine.add_argument('--batched', action=argparse.BooleanOptionalAction, default=False,
+                        help='Draw all customer decisions of a day at once')
+    engine.add_argument('--sparse_ledger', action=argparse.BooleanOptionalAction, default=False,
+                        help='Keep reputation as sparse (customer, shop) entries')
+    engine.add_argument('--lazy_decay', action=argparse.BooleanOptionalAction, default=False,
+                        help='Apply the daily reputation decay as a global scale')
+    engine.add_argument('--event_driven', action=argparse.BooleanOptionalAction, default=False,
+                        help='Run dues, payment deadlines and decay as scheduled events')
+    engine.add_argument('--fast_forward', type=int, default=None, help='Advance the market in steps of up to n days')
+    output = parser.add_argument_group('output')
+    output.add_argument('--render', type=str, default='live',
+                        help='Render policy: live, headless, end, process or the number of days between frames')
+    output.add_argument('--metrics', type=str, default=None,
+                        help='Write per day metrics to this .csv file, or to .npz chunks with this prefix')
+    output.add_argument('--transaction_log', type=str, default=None, help='Record every transaction to this file')
+    output.add_argument('--snapshot_every', type=int, default=None, help='Days between transaction log snapshots')
+    output.add_argument('--checkpoint_every', type=int, default=None, help='Save a checkpoint every n days')
+    output.add_argument('--checkpoint', dest='checkpoint_path', type=str, default=None,
+                        help='Checkpoint file, checkpoint.npz for a new run and the resumed file for --resume')
+    output.add_argument('--resume', type=str, default=None,
+                        help='Continue the run saved in this checkpoint file, the other market options are ignored')
+    output.add_argument('--profile', type=str, nargs='?', const='simulation.prof', default=None,
+                        help='Print the time spent per phase and dump cProfile stats to this file')
+    output.add_argument('--shared_state', type=str, default=None,
+                        help='Publish the market at every day boundary to this file, for --watch in another process')
+    output.add_argument('--watch', type=str, default=None,
+                        help='Draw the market a run with --shared_state publishes to this file, then exit')
+    return parser
+
+
+def setup_args(argv=None):
+    global engine_parameters, resume, profile, watch_source, claim_failure_probability
+    parser = make_parser()
+    config_path = parser.parse_known_args(argv)[0].config
+    if config_path is not None:
+        with open(config_path) as f:
+            config = json.load(f)
+        known = set(vars(parser.parse_args([])))
+        unknown = sorted(name for name in config if name not in known or name in RUN_OPTIONS)
+        if unknown:
+            parser.error('unknown parameters in {}: {}'.format(config_path, ', '.join(unknown)))
+        parser.set_defaults(**config)
+    args = vars(parser.parse_args(argv))
+    resume = args['resume']
+    profile = args['profile']
+    watch_source = args['watch']
+    claim_failure_probability = args['claim_failure_probability']
+    engine_parameters = dict((name, value) for name, value in args.items() if name not in RUN_OPTIONS)
+    engine_parameters['profile'] = profile is not None
 
 
 def run_simulator():
-    global num_iterations, num_customers, num_shops
-    sim_engine = SimulationEngine(num_customers=num_customers,
-                                  num_shops=num_shops,
-                                  sim_iters=num_iterations,
-                                  coin_limit=200000,
-                                  rep_limit=20000,
-                                  coin_rep_factor=0.50,
-                                  payment_due=30)
-    sim_engine.run()
+    global engine_parameters, resume, claim_failure_probability
+    if resume is not None:
+        sim_engine = SimulationEngine.from_checkpoint(resume, render=engine_parameters['render'],
+                                                      checkpoint_every=engine_parameters['checkpoint_every'],
+                                                      checkpoint_path=engine_parameters['checkpoint_path'],
+                                                      profile=engine_parameters['profile'],
+                                                      shared_state=engine_parameters['shared_state'],
+                                                      metrics=engine_parameters['metrics'],
+                                                      transaction_log=engine_parameters['transaction_log'],
+                                                      snapshot_every=engine_parameters['snapshot_every'])
+        sim_engine.run(claim_failure_probability)
+        return
+    parameters = dict(engine_parameters)
+    if parameters['checkpoint_path'] is None:
+        del parameters['checkpoint_path']
+    sim_engine = SimulationEngine(**parameters)
+    sim_engine.run(claim_failure_probability)
+
+
+def profile_simulator():
+    import cProfile
+    import pstats
+    profiler = cProfile.Profile()
+    profiler.runcall(run_simulator)
+    profiler.dump_stats(profile)
+    print('profile written to {}'.format(profile))
+    pstats.Stats(profiler).sort_stats('cumulative').print_stats(20)
 
 
 if __name__ == '__main__':
     setup_args()
-    run_simulator()
-
+    if watch_source is not None:
+        from Rendering import watch
+        watch(watch_source)
+    elif profile is not None:
+        profile_simulator()
+    else:
+        run_simulator()